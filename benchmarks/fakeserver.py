@@ -0,0 +1,624 @@
+# -*- coding: utf-8 -*-
+"""
+=============================================
+A local stand-in of the MarkLogic REST server
+=============================================
+
+Just enough of the MarkLogic 8 REST API to run mllib without a MarkLogic server, for the benchmarks and the
+experiments:
+
+- ``/v1/documents``: GET (single document, or multipart/mixed responses streamed with chunked encoding), HEAD,
+  PUT, DELETE and POST (multipart/mixed bulk writes), with the ``txid`` parameter, ETags and ``If-None-Match``
+- ``/v1/eval`` and ``/v1/invoke``: scripts can't be evaluated, the Python functions registered for their source
+  (see :meth:`FakeMarkLogicServer.register_script`) give the items of the result. The batch wrapper of
+  ``EvalService.eval_batch`` is emulated.
+- ``/v1/ext``: PUT of modules for ``/v1/invoke``
+- ``/v1/transactions``: creation, status, commit and rollback
+- Digest (MD5, qop=auth, with stale nonces), basic or no authentication
+
+This module does not depend on mllib, such that the benchmarks of any commit of mllib can run against it.
+
+Usage: python benchmarks/fakeserver.py [--port 8000] [--auth digest|basic|none] [--user admin:admin] [--latency 0]
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import BaseHTTPServer
+import base64
+import decimal
+import errno
+import hashlib
+import itertools
+import json
+import os
+import re
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+REALM = 'public'
+NONCE_LIFETIME = 60.0  # Seconds before a nonce gets stale
+MULTIPART_CHUNK_SIZE = 64 * 1024  # Bytes of the chunks of the streamed multipart responses
+
+ADDITION_XQY = """
+xquery version "1.0-ml";
+declare variable $value1 as xs:integer external;
+declare variable $value2 as xs:integer external;
+fn:sum(($value1, $value2));
+"""
+
+_BATCH_WRAPPER_VARS = frozenset(('script', 'language', 'inputs', 'marker'))
+_auth_param_rx = re.compile(r'(\w+)=(?:"([^"]*)"|([^,\s]*))')
+_disposition_filename_rx = re.compile(r'filename="((?:[^"\\]|\\.)*)"')
+_content_formats = (('json', 'json'), ('xml', 'xml'), ('text/', 'text'))
+
+
+def normalize_source(source):
+    """Scripts are matched without their spaces"""
+    if isinstance(source, bytes):
+        source = source.decode('utf-8')
+    return ' '.join(source.split())
+
+
+class FakeEvalError(Exception):
+    """Raised by the registered scripts to return a MarkLogic error"""
+    def __init__(self, code, message):
+        super(FakeEvalError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+
+
+class Document(object):
+    __slots__ = ('content', 'content_type', 'collections', 'version')
+
+    def __init__(self, content, content_type, collections, version):
+        self.content = content
+        self.content_type = content_type
+        self.collections = collections
+        self.version = version
+
+    @property
+    def etag(self):
+        return '"{0}"'.format(self.version)
+
+    @property
+    def format(self):
+        for marker, format_ in _content_formats:
+            if marker in self.content_type:
+                return format_
+        return 'binary'
+
+    def metadata(self):
+        return json.dumps({'collections': self.collections, 'permissions': [], 'properties': {}, 'quality': 0})
+
+
+def encode_item(value):
+    """(X-Primitive, Content-Type, bytes) of a Python value returned by a script"""
+    if isinstance(value, bool):
+        return 'boolean', 'text/plain', b'true' if value else b'false'
+    if isinstance(value, (int, long)):
+        return 'integer', 'text/plain', str(value).encode('ascii')
+    if isinstance(value, float):
+        return 'double', 'text/plain', repr(value).encode('ascii')
+    if isinstance(value, decimal.Decimal):
+        return 'decimal', 'text/plain', str(value).encode('ascii')
+    if isinstance(value, dict):
+        return 'map', 'application/json', json.dumps(value).encode('utf-8')
+    if isinstance(value, (list, tuple)):
+        return 'array', 'application/json', json.dumps(value).encode('utf-8')
+    if isinstance(value, bytes):
+        return 'string', 'text/plain', value
+    return 'string', 'text/plain', value.encode('utf-8')
+
+
+def addition(value1, value2):
+    return [int(value1) + int(value2)]
+
+
+class FakeMarkLogicServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server with the state of a MarkLogic database
+
+    .. code:: python
+
+       server = FakeMarkLogicServer(('127.0.0.1', 0))
+       server.register_script('fn:current-dateTime()', lambda: ['2016-01-01T00:00:00'])
+       server.start()
+       ds = DocumentsService('127.0.0.1', server.server_address[1], 'admin', 'admin')
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, users=None, auth='digest', latency=0.0):
+        """
+        :param server_address: (host, port), port 0 for any free port
+        :param users: {username: password, ...}, defaults to admin:admin
+        :param auth: 'digest', 'basic' or 'none'
+        :param latency: seconds added to the processing of each request
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, FakeMarkLogicHandler)
+        self.users = users if users is not None else {'admin': 'admin'}
+        self.auth = auth
+        self.latency = latency
+        self.documents = {}  # {uri: Document, ...}
+        self.transactions = {}  # {txid: {uri: Document or None if deleted, ...}, ...}
+        self.modules = {}  # {path: source, ...}
+        self.scripts = {}  # {normalized source: callable, ...}
+        self.nonces = {}  # {nonce: creation time, ...}
+        self.requests_count = 0
+        self.lock = threading.Lock()
+        self._versions = itertools.count(1)
+        self._txids = itertools.count(int(time.time() * 1000))
+        self.register_script(ADDITION_XQY, addition)
+
+    def register_script(self, source, func):
+        """Evaluates a script with a Python function
+
+        :param source: the XQuery or JavaScript source, spaces are not significant
+        :param func: a callable that gets the vars as named arguments, and returns an iterable of the items of
+          the result (int, float, bool, :class:`decimal.Decimal`, unicode, dict or list). It may raise a
+          :class:`FakeEvalError`.
+        """
+        self.scripts[normalize_source(source)] = func
+
+    def start(self):
+        """Serves in a daemon thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients that exit with idle keep-alive connections are not errors
+        exc = sys.exc_info()[1]
+        if isinstance(exc, socket.error) and exc.errno in (errno.ECONNRESET, errno.EPIPE):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    # Database state, lock held by callers
+
+    def read(self, uri, txid=None):
+        if txid is not None and uri in self.transactions.get(txid, {}):
+            return self.transactions[txid][uri]
+        return self.documents.get(uri)
+
+    def write(self, uri, document, txid=None):
+        if document is not None:
+            document.version = next(self._versions)
+        if txid is not None:
+            self.transactions[txid][uri] = document
+        elif document is None:
+            self.documents.pop(uri, None)
+        else:
+            self.documents[uri] = document
+
+    def new_transaction(self):
+        txid = '{0}'.format(next(self._txids))
+        self.transactions[txid] = {}
+        return txid
+
+    def end_transaction(self, txid, commit):
+        changes = self.transactions.pop(txid)
+        if commit:
+            for uri, document in changes.iteritems():
+                self.write(uri, document)
+
+    def new_nonce(self):
+        nonce = hashlib.md5(os.urandom(16)).hexdigest()
+        now = time.time()
+        self.nonces[nonce] = now
+        if len(self.nonces) > 10000:
+            self.nonces = {key: created for key, created in self.nonces.iteritems()
+                           if created + NONCE_LIFETIME > now}
+        return nonce
+
+
+class FakeMarkLogicHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MarkLogic'
+    # Headers and body in one segment, without Nagle delays
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    # Dispatching
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, verb):
+        self.body = self.read_body()
+        server = self.server
+        with server.lock:
+            server.requests_count += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if not self.authenticated(verb):
+            return
+        url = urlparse.urlparse(self.path)
+        self.params = urlparse.parse_qs(url.query)
+        path = url.path
+        if path == '/v1/documents':
+            handler = getattr(self, 'documents_' + verb.lower(), None)
+        elif path in ('/v1/eval', '/v1/invoke') and verb == 'POST':
+            handler = self.eval_post
+        elif path.startswith('/v1/ext/') and verb == 'PUT':
+            handler = self.ext_put
+        elif path.startswith('/v1/transactions'):
+            handler = getattr(self, 'transactions_' + verb.lower(), None)
+        else:
+            handler = None
+        if handler is None:
+            self.send_error_json(404, 'RESTAPI-INVALIDREQ', 'Unsupported {0} {1}'.format(verb, path))
+            return
+        try:
+            handler()
+        except FakeEvalError as exc:
+            self.send_error_json(500, exc.code, exc.message)
+
+    def param(self, name, default=None):
+        values = self.params.get(name)
+        return values[0].decode('utf-8') if values else default
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if not size:
+                    # Trailers
+                    while self.rfile.readline().strip():
+                        pass
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    # Authentication
+
+    def authenticated(self, verb):
+        server = self.server
+        if server.auth == 'none':
+            return True
+        authorization = self.headers.get('Authorization', '')
+        scheme, _, credentials = authorization.partition(' ')
+        if server.auth == 'basic':
+            if scheme.lower() == 'basic':
+                username, _, password = base64.b64decode(credentials).partition(b':')
+                if server.users.get(username.decode('utf-8')) == password.decode('utf-8'):
+                    return True
+            self.send_challenge('Basic realm="{0}"'.format(REALM))
+            return False
+
+        stale = False
+        if scheme.lower() == 'digest':
+            chal = {match.group(1): match.group(2) if match.group(2) is not None else match.group(3)
+                    for match in _auth_param_rx.finditer(credentials)}
+            with server.lock:
+                created = server.nonces.get(chal.get('nonce'))
+            password = server.users.get(chal.get('username'))
+            if created is None or created + NONCE_LIFETIME < time.time():
+                stale = password is not None
+            elif password is not None and chal.get('uri') == self.path:
+                ha1 = hashlib.md5('{0}:{1}:{2}'.format(chal['username'], REALM, password).encode('utf-8'))
+                ha2 = hashlib.md5('{0}:{1}'.format(verb, chal['uri']).encode('utf-8'))
+                expected = hashlib.md5('{0}:{1}:{2}:{3}:{4}:{5}'.format(
+                    ha1.hexdigest(), chal['nonce'], chal.get('nc'), chal.get('cnonce'), chal.get('qop'),
+                    ha2.hexdigest()).encode('utf-8')).hexdigest()
+                if chal.get('response') == expected:
+                    return True
+        with server.lock:
+            nonce = server.new_nonce()
+        self.send_challenge('Digest realm="{0}", qop="auth", nonce="{1}", opaque="{2}"{3}'.format(
+            REALM, nonce, hashlib.md5(REALM).hexdigest(), ', stale=true' if stale else ''))
+        return False
+
+    def send_challenge(self, challenge):
+        body = b'{"errorResponse": {"statusCode": 401, "status": "Unauthorized", "message": "401 Unauthorized"}}'
+        self.send_response(401)
+        self.send_header('WWW-Authenticate', challenge)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Responses
+
+    def send_body(self, status, body=b'', content_type='application/json', headers=()):
+        self.send_response(status)
+        if body or status not in (204, 304):
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, status, obj, headers=()):
+        self.send_body(status, json.dumps(obj).encode('utf-8'), 'application/json', headers)
+
+    def send_error_json(self, status, code, message):
+        self.send_json(status, {'errorResponse': {
+            'statusCode': status,
+            'status': self.responses.get(status, ('Error',))[0],
+            'messageCode': code,
+            'message': '{0}: {1}'.format(code, message)
+        }})
+
+    def send_multipart(self, parts):
+        """Streams (headers, body) parts with chunked encoding, like MarkLogic does"""
+        boundary = 'ML_BOUNDARY_' + hashlib.md5(os.urandom(8)).hexdigest()
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/mixed; boundary={0}'.format(boundary))
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        buffered = []
+        size = 0
+        for headers, body in parts:
+            lines = ['--' + boundary]
+            lines.extend('{0}: {1}'.format(name, value) for name, value in headers)
+            lines.append('Content-Length: {0}'.format(len(body)))
+            buffered.append(('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8'))
+            buffered.append(body)
+            buffered.append(b'\r\n')
+            size += len(buffered[-3]) + len(body) + 2
+            if size >= MULTIPART_CHUNK_SIZE:
+                self.write_chunk(b''.join(buffered))
+                buffered = []
+                size = 0
+        buffered.append('--{0}--\r\n'.format(boundary).encode('ascii'))
+        self.write_chunk(b''.join(buffered))
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, data):
+        self.wfile.write('{0:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+
+    # /v1/documents
+
+    def documents_get(self):
+        uris = [uri.decode('utf-8') for uri in self.params.get('uri', [])]
+        if not uris:
+            self.send_error_json(400, 'REST-REQUIREDPARAM', 'Required parameter: uri')
+            return
+        categories = frozenset(self.params.get('category', ['content']))
+        txid = self.param('txid')
+        with self.server.lock:
+            documents = [(uri, self.server.read(uri, txid)) for uri in uris]
+        if len(uris) == 1 and 'multipart/mixed' not in self.headers.get('Accept', ''):
+            document = documents[0][1]
+            if document is None:
+                self.send_error_json(404, 'RESTAPI-NODOCUMENT', 'Resource or document does not exist: ' + uris[0])
+            elif 'content' not in categories:
+                self.send_body(200, document.metadata().encode('utf-8'))
+            elif self.headers.get('If-None-Match') == document.etag:
+                self.send_body(304, headers=[('ETag', document.etag)])
+            else:
+                self.send_body(200, document.content, document.content_type,
+                               [('ETag', document.etag), ('vnd.marklogic.document-format', document.format)])
+            return
+
+        parts = []
+        for uri, document in documents:
+            if document is None:
+                continue
+            disposition = 'attachment; filename="{0}"; category='.format(uri.replace('"', '\\"'))
+            if 'metadata' in categories:
+                parts.append(([('Content-Type', 'application/json'),
+                               ('Content-Disposition', disposition + 'metadata; format=json')],
+                              document.metadata().encode('utf-8')))
+            if 'content' in categories:
+                parts.append(([('Content-Type', document.content_type),
+                               ('Content-Disposition', '{0}content; format={1}'.format(disposition, document.format))],
+                              document.content))
+        if not parts:
+            self.send_body(200, b'', 'multipart/mixed; boundary=ML_BOUNDARY_EMPTY')
+            return
+        self.send_multipart(parts)
+
+    def documents_head(self):
+        uri = self.param('uri')
+        with self.server.lock:
+            document = self.server.read(uri, self.param('txid')) if uri is not None else None
+        if document is None:
+            self.send_body(404 if uri is not None else 400)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', document.content_type)
+        self.send_header('Content-Length', str(len(document.content)))
+        self.send_header('ETag', document.etag)
+        self.end_headers()
+
+    def documents_put(self):
+        uri = self.param('uri')
+        if uri is None:
+            self.send_error_json(400, 'REST-REQUIREDPARAM', 'Required parameter: uri')
+            return
+        collections = [collection.decode('utf-8') for collection in self.params.get('collection', [])]
+        document = Document(self.body, self.headers.get('Content-Type', 'application/octet-stream'), collections, 0)
+        if not self.check_txid():
+            return
+        with self.server.lock:
+            created = self.server.read(uri, self.param('txid')) is None
+            self.server.write(uri, document, self.param('txid'))
+        if created:
+            self.send_body(201, headers=[('Location', self.path)])
+        else:
+            self.send_body(204)
+
+    def documents_delete(self):
+        if not self.check_txid():
+            return
+        with self.server.lock:
+            for uri in self.params.get('uri', []):
+                self.server.write(uri.decode('utf-8'), None, self.param('txid'))
+        self.send_body(204)
+
+    def documents_post(self):
+        """Bulk writes of a multipart/mixed body"""
+        boundary = self.headers.get('Content-Type', '').partition('boundary=')[2].strip('"')
+        if not boundary:
+            self.send_error_json(400, 'REST-INVALIDMIMETYPE', 'A multipart/mixed body is required')
+            return
+        if not self.check_txid():
+            return
+        written = {}  # {uri: {'uri': uri, 'mime-type': type, 'category': [...]}, ...}
+        metadata = {}
+        documents = []
+        delimiter = b'--' + boundary.encode('ascii')
+        for part in self.body.split(delimiter)[1:]:
+            if part.startswith(b'--'):
+                break
+            head, _, body = part.lstrip(b'\r\n').partition(b'\r\n\r\n')
+            headers = dict(line.split(b':', 1) for line in head.split(b'\r\n') if b':' in line)
+            headers = {name.strip().lower(): value.strip().decode('utf-8') for name, value in headers.items()}
+            body = body[:-2] if body.endswith(b'\r\n') else body
+            match = _disposition_filename_rx.search(headers.get('content-disposition', ''))
+            if match is None:
+                continue
+            uri = re.sub(r'\\(.)', r'\1', match.group(1))
+            report = written.setdefault(uri, {'uri': uri, 'mime-type': None, 'category': []})
+            if 'category=metadata' in headers['content-disposition']:
+                try:
+                    metadata[uri] = json.loads(body.decode('utf-8')).get('collections', [])
+                except ValueError:
+                    metadata[uri] = []  # XML metadata
+                report['category'].append('metadata')
+            else:
+                content_type = headers.get('content-type', 'application/octet-stream')
+                documents.append((uri, body, content_type))
+                report['mime-type'] = content_type
+                report['category'].append('content')
+        txid = self.param('txid')
+        with self.server.lock:
+            for uri, body, content_type in documents:
+                self.server.write(uri, Document(body, content_type, metadata.get(uri, []), 0), txid)
+        self.send_json(200, {'documents': list(written.values())})
+
+    def check_txid(self):
+        txid = self.param('txid')
+        if txid is not None and txid not in self.server.transactions:
+            self.send_error_json(400, 'XDMP-NOTXN', 'No transaction with identifier ' + txid)
+            return False
+        return True
+
+    # /v1/eval, /v1/invoke and /v1/ext
+
+    def eval_post(self):
+        form = urlparse.parse_qs(self.body)
+        get = lambda name: form[name][0].decode('utf-8') if name in form else None
+        vars_ = json.loads(get('vars') or '{}')
+        if self.path.startswith('/v1/invoke'):
+            module = get('module')
+            source = self.server.modules.get(module)
+            if source is None:
+                raise FakeEvalError('XDMP-MODNOTFOUND', 'Module {0} not found'.format(module))
+        else:
+            source = get('xquery') or get('javascript') or ''
+        if frozenset(vars_) == _BATCH_WRAPPER_VARS:
+            items = self.batch_items(vars_)
+        else:
+            items = self.evaluate(source, vars_)
+        parts = []
+        for value in items:
+            primitive, content_type, body = encode_item(value)
+            parts.append(([('Content-Type', content_type), ('X-Primitive', primitive)], body))
+        self.send_multipart(parts)
+
+    def evaluate(self, source, vars_):
+        func = self.server.scripts.get(normalize_source(source))
+        if func is None:
+            raise FakeEvalError('XDMP-UNEXPECTED', 'The fake server cannot evaluate unregistered scripts')
+        try:
+            return list(func(**vars_))
+        except TypeError as exc:
+            raise FakeEvalError('XDMP-EXTVAR', '{0}'.format(exc))
+
+    def batch_items(self, wrapper_vars):
+        """Like the batch wrapper of EvalService.eval_batch"""
+        marker = wrapper_vars['marker']
+        items = []
+        for index, vars_ in enumerate(json.loads(wrapper_vars['inputs'])):
+            items.append({marker: index})
+            try:
+                items.extend(self.evaluate(wrapper_vars['script'],
+                                           {name: '{0}'.format(value) for name, value in vars_.items()}))
+            except FakeEvalError as exc:
+                items.append({marker: index, 'code': exc.code, 'message': exc.message})
+        return items
+
+    def ext_put(self):
+        with self.server.lock:
+            self.server.modules[urlparse.urlparse(self.path).path[len('/v1'):]] = self.body.decode('utf-8')
+        self.send_body(204)
+
+    # /v1/transactions
+
+    def transactions_post(self):
+        txid = self.path.split('?')[0][len('/v1/transactions/'):]
+        with self.server.lock:
+            if not txid:
+                txid = self.server.new_transaction()
+                created = True
+            elif txid in self.server.transactions:
+                self.server.end_transaction(txid, self.param('result') == 'commit')
+                created = False
+            else:
+                txid = None
+        if txid is None:
+            self.send_error_json(400, 'XDMP-NOTXN', 'No transaction with identifier ' + self.path)
+        elif created:
+            self.send_body(303, headers=[('Location', '/v1/transactions/' + txid)])
+        else:
+            self.send_body(204)
+
+    def transactions_get(self):
+        txid = self.path.split('?')[0][len('/v1/transactions/'):]
+        if txid not in self.server.transactions:
+            self.send_error_json(404, 'XDMP-NOTXN', 'No transaction with identifier ' + txid)
+            return
+        self.send_json(200, {'transaction-status': {'transaction-id': txid, 'transaction-mode': 'update'}})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="A local stand-in of the MarkLogic REST server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000, help="0 for any free port")
+    parser.add_argument('--auth', choices=('digest', 'basic', 'none'), default='digest')
+    parser.add_argument('--user', default='admin:admin', help="username:password")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each request")
+    options = parser.parse_args(argv)
+    username, _, password = options.user.partition(':')
+    server = FakeMarkLogicServer((options.host, options.port), {username: password}, options.auth, options.latency)
+    print("Listening on {0}:{1}".format(*server.server_address))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+======================================
+Parameters marshalling micro-benchmark
+======================================
+
+Compares the cost of the named arguments validation of a ``document_put`` call when the
+:class:`mllib.utils.KwargsSerializer` is built for each request (as services did before) and when it is
+built once per endpoint.
+
+Usage: python benchmarks/kwargs_serializer.py [number]
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import sys
+import timeit
+
+from mllib.documents import DocumentsService
+from mllib.utils import KwargsSerializer
+
+SPECS = DocumentsService._document_put_params.specs
+COMPILED = DocumentsService._document_put_params
+KWARGS = {
+    'uri': '/python_demo/sample1/doc2.json',
+    'collection': ('books', 'manuals'),
+    'database': 'Documents',
+    'prop': {'author': 'Joe', 'status': 'draft'},
+    'txid': '1234567890'
+}
+
+
+def per_request():
+    return KwargsSerializer(SPECS).request_params(dict(KWARGS))
+
+
+def compiled():
+    return COMPILED.request_params(dict(KWARGS))
+
+
+def main(number=100000):
+    assert per_request() == compiled()
+    results = {}
+    for func in (per_request, compiled):
+        results[func.__name__] = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print("{0:12s} {1:8.2f} us/call".format(func.__name__, results[func.__name__] * 1e6))
+    print("Speedup: x{0:.2f}".format(results['per_request'] / results['compiled']))
+    return results
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
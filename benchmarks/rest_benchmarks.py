@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+===========================
+REST client benchmark suite
+===========================
+
+Measures the throughput (operations per second), the latency percentiles and the peak memory of the main mllib
+operations against the stand-in MarkLogic server of ``fakeserver.py``, started in its own process, or against a
+real server. Each scenario runs in its own process such that its memory is measured alone.
+
+Usage::
+
+  # Run the suite, save the results of the working tree
+  python benchmarks/rest_benchmarks.py --save before.json
+  # Compare with saved results, exits with status 1 on regressions beyond the threshold
+  python benchmarks/rest_benchmarks.py --compare before.json --threshold 0.1
+  # Run the suite on commits checked out in temporary git worktrees, and compare them to the first one
+  python benchmarks/rest_benchmarks.py --commits master~3 master
+  # Against a MarkLogic server
+  python benchmarks/rest_benchmarks.py --server localhost:8000:admin:admin --scenario document_put
+
+Scenarios that need a feature missing from a benchmarked commit are skipped.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import collections
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import timeit
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SOURCES_DIRECTORY = os.path.join(os.path.dirname(BENCHMARKS_DIRECTORY), 'src')
+
+# Operations per scenario at scale 1, scaled down by --quick
+SIZES = {
+    'document_put': 2000,
+    'document_put_concurrent': 4000,
+    'document_get_multi': 300,
+    'iter_parts': 20,
+    'bulk_load': 10000,
+    'eval': 2000
+}
+QUICK_SCALE = 0.1
+GET_URIS = 50  # URIs per multi documents request
+PARSED_PARTS = 2000  # Parts of the body parsed by the iter_parts scenario
+BULK_BATCH_SIZE = 100
+THREADS = 8
+
+# Compared metrics: (name, True if higher is better)
+METRICS = (('ops_per_sec', True), ('p50_ms', False), ('p99_ms', False), ('peak_rss_kb', False))
+MIN_RSS_CHANGE_KB = 2048  # Smaller memory changes are noise
+
+
+class Skipped(Exception):
+    """The benchmarked commit lacks a feature of the scenario"""
+
+
+def xml_document(size):
+    text = ''.join(random.choice('abcdefghij ') for _ in range(size))
+    return '<doc><title>Benchmark</title><body>{0}</body></doc>'.format(text).encode('utf-8')
+
+
+def timed(func, count):
+    """Latencies (seconds) of count calls of func(index)"""
+    latencies = []
+    timer = timeit.default_timer
+    for index in xrange(count):
+        started = timer()
+        func(index)
+        latencies.append(timer() - started)
+    return latencies
+
+
+def concurrently(func, count, threads=THREADS):
+    """Latencies of count calls of func(index) by threads"""
+    latencies = []
+    indexes = iter(xrange(count))
+    lock = threading.Lock()
+
+    def work():
+        timer = timeit.default_timer
+        mine = []
+        while True:
+            with lock:
+                index = next(indexes, None)
+            if index is None:
+                break
+            started = timer()
+            func(index)
+            mine.append(timer() - started)
+        with lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies
+
+
+def load_documents(ds, prefix, count, size=1024):
+    """Writes count documents, with bulk requests when available"""
+    body = xml_document(size)
+    uris = ['{0}{1}.xml'.format(prefix, index) for index in xrange(count)]
+    if hasattr(ds, 'document_post'):
+        for start in xrange(0, count, BULK_BATCH_SIZE):
+            ds.document_post([(uri, body, None) for uri in uris[start:start + BULK_BATCH_SIZE]],
+                             batch_size=BULK_BATCH_SIZE)
+    else:
+        for uri in uris:
+            ds.document_put(io.BytesIO(body), uri=uri)
+    return uris
+
+
+# Scenarios: set up, then return a run() callable that returns (latencies, operations, extra)
+
+def scenario_document_put(server, size):
+    from mllib.documents import DocumentsService
+    ds = DocumentsService(*server)
+    body = xml_document(2048)
+
+    def run():
+        latencies = timed(lambda index: ds.document_put(io.BytesIO(body), uri='/bench/put/{0}.xml'.format(index)),
+                          size)
+        return latencies, size, {}
+    return run
+
+
+def scenario_document_put_concurrent(server, size):
+    from mllib.documents import DocumentsService
+    try:
+        ds = DocumentsService(*server, pool_maxsize=THREADS)
+    except TypeError:
+        raise Skipped("No connections pool")
+    body = xml_document(2048)
+
+    def run():
+        latencies = concurrently(
+            lambda index: ds.document_put(io.BytesIO(body), uri='/bench/putc/{0}.xml'.format(index)), size)
+        return latencies, size, {'threads': THREADS}
+    return run
+
+
+def scenario_document_get_multi(server, size):
+    from mllib.documents import DocumentsService
+    ds = DocumentsService(*server)
+    uris = load_documents(ds, '/bench/get/', 1000)
+    rng = random.Random(42)
+    requests_uris = [rng.sample(uris, GET_URIS) for _ in xrange(size)]
+    received = [0]
+
+    def get(index):
+        for headers, body in ds.document_get(uri=requests_uris[index]).iter_parts():
+            received[0] += len(body)
+
+    def run():
+        latencies = timed(get, size)
+        return latencies, size, {'documents_per_sec': size * GET_URIS / sum(latencies), 'bytes': received[0]}
+    return run
+
+
+def scenario_iter_parts(server, size):
+    """Client side parsing of a multipart/mixed body, no request"""
+    import requests
+    from mllib.utils import ResponseAdapter
+    part = xml_document(4000)
+    chunks = []
+    for index in xrange(PARSED_PARTS):
+        chunks.append(b'--BOUNDARY\r\nContent-Type: application/xml\r\n'
+                      b'Content-Disposition: attachment; filename="/doc' + str(index).encode('ascii') +
+                      b'.xml"; category=content; format=xml\r\nContent-Length: ' + str(len(part)).encode('ascii') +
+                      b'\r\n\r\n' + part + b'\r\n')
+    chunks.append(b'--BOUNDARY--\r\n')
+    body = b''.join(chunks)
+
+    def parse(index):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'multipart/mixed; boundary=BOUNDARY'
+        response.raw = io.BytesIO(body)
+        count = sum(1 for _ in ResponseAdapter(response).iter_parts())
+        assert count == PARSED_PARTS, count
+
+    def run():
+        latencies = timed(parse, size)
+        return latencies, size, {'mb_per_sec': size * len(body) / 2.0 ** 20 / sum(latencies)}
+    return run
+
+
+def scenario_bulk_load(server, size):
+    from mllib.documents import DocumentsService
+    ds = DocumentsService(*server)
+    if not hasattr(ds, 'document_post'):
+        raise Skipped("No bulk writes")
+    body = xml_document(1024)
+    batches = (size + BULK_BATCH_SIZE - 1) // BULK_BATCH_SIZE
+
+    def write(index):
+        ds.document_post([('/bench/bulk/{0}-{1}.xml'.format(index, position), body, None)
+                          for position in xrange(BULK_BATCH_SIZE)], batch_size=BULK_BATCH_SIZE)
+
+    def run():
+        latencies = timed(write, batches)
+        return latencies, batches, {'documents_per_sec': batches * BULK_BATCH_SIZE / sum(latencies)}
+    return run
+
+
+def scenario_eval(server, size):
+    from fakeserver import ADDITION_XQY
+    from mllib.eval import EvalService
+    es = EvalService(*server)
+
+    def evaluate(index):
+        response = es.eval_post(xquery=ADDITION_XQY, vars={'value1': index, 'value2': 1})
+        for headers, body in response.iter_parts():
+            assert int(body) == index + 1
+
+    def run():
+        return timed(evaluate, size), size, {}
+    return run
+
+
+SCENARIOS = collections.OrderedDict((name[len('scenario_'):], func) for name, func in sorted(globals().items())
+                                    if name.startswith('scenario_'))
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_scenario(name, server, scale):
+    """Runs a scenario in this process
+
+    :return: the measures as a dict
+    """
+    size = max(1, int(SIZES[name] * scale))
+    try:
+        run = SCENARIOS[name](server, size)
+    except Skipped as exc:
+        return {'skipped': '{0}'.format(exc)}
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = timeit.default_timer()
+    latencies, operations, extra = run()
+    elapsed = timeit.default_timer() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ordered = sorted(latencies)
+    result = {
+        'operations': operations,
+        'elapsed': elapsed,
+        'ops_per_sec': operations / elapsed,
+        'p50_ms': percentile(ordered, 0.5) * 1000,
+        'p90_ms': percentile(ordered, 0.9) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+        'max_ms': ordered[-1] * 1000,
+        'peak_rss_kb': rss_after - rss_before
+    }
+    result.update(extra)
+    return result
+
+
+def start_fake_server():
+    """Starts fakeserver.py in a process
+
+    :return: (process, (host, port, username, password))
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIRECTORY, 'fakeserver.py'), '--port', '0'],
+                               stdout=subprocess.PIPE)
+    line = process.stdout.readline().decode('utf-8')
+    host, port = line.split()[-1].rsplit(':', 1)
+    return process, (host, port, 'admin', 'admin')
+
+
+def current_commit(sources):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=sources).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_suite(server, scenarios, scale, sources):
+    """Runs the scenarios, each in a subprocess that imports mllib from sources
+
+    :return: the results as a dict
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join((sources, BENCHMARKS_DIRECTORY)))
+    results = collections.OrderedDict()
+    for name in scenarios:
+        command = [sys.executable, os.path.abspath(__file__), '--run-scenario', name, '--scale', repr(scale),
+                   '--server', ':'.join(server)]
+        output = subprocess.check_output(command, env=env).decode('utf-8')
+        results[name] = json.loads(output.strip().splitlines()[-1])
+        print(format_result(name, results[name]))
+        sys.stdout.flush()
+    return {'commit': current_commit(sources), 'python': sys.version.split()[0], 'scale': scale,
+            'scenarios': results}
+
+
+def format_result(name, result):
+    if 'skipped' in result:
+        return '{0:24s} skipped: {1}'.format(name, result['skipped'])
+    return '{0:24s} {1:10.1f} ops/s  p50 {2:8.3f} ms  p90 {3:8.3f} ms  p99 {4:8.3f} ms  rss +{5} KB'.format(
+        name, result['ops_per_sec'], result['p50_ms'], result['p90_ms'], result['p99_ms'], result['peak_rss_kb'])
+
+
+def compare(baseline, current, threshold):
+    """Prints the changes of the metrics between two results
+
+    :return: the list of the regressions as (scenario, metric, change) tuples
+    """
+    regressions = []
+    print('\n{0} -> {1}'.format(baseline['commit'], current['commit']))
+    for name, result in current['scenarios'].items():
+        base = baseline['scenarios'].get(name)
+        if base is None or 'skipped' in base or 'skipped' in result:
+            continue
+        for metric, higher_is_better in METRICS:
+            old, new = base[metric], result[metric]
+            if metric == 'peak_rss_kb' and abs(new - old) < MIN_RSS_CHANGE_KB:
+                change = 0.0
+            else:
+                change = (new - old) / float(old) if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = 'REGRESSION'
+                regressions.append((name, metric, change))
+            elif worse < -threshold:
+                flag = 'improved'
+            print('{0:24s} {1:12s} {2:12.3f} {3:12.3f} {4:+8.1%} {5}'.format(name, metric, old, new, change, flag))
+    return regressions
+
+
+def run_commits(revisions, options):
+    """Runs the suite on commits checked out in temporary git worktrees
+
+    :return: the results of each commit
+    """
+    repository = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'],
+                                         cwd=BENCHMARKS_DIRECTORY).decode('utf-8').strip()
+    all_results = []
+    for revision in revisions:
+        worktree = tempfile.mkdtemp(prefix='mllib-bench-')
+        os.rmdir(worktree)
+        subprocess.check_call(['git', 'worktree', 'add', '--detach', worktree, revision], cwd=repository)
+        try:
+            print('\n== {0}'.format(revision))
+            all_results.append(run_suite(options.server, options.scenario, options.scale,
+                                         os.path.join(worktree, 'src')))
+        finally:
+            subprocess.check_call(['git', 'worktree', 'remove', '--force', worktree], cwd=repository)
+            shutil.rmtree(worktree, ignore_errors=True)
+    return all_results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="mllib benchmarks")
+    parser.add_argument('--server', help="host:port:username:password[:authtype] of a MarkLogic server, "
+                                         "the stand-in server by default")
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help="scenario to run (repeatable), all by default")
+    parser.add_argument('--quick', action='store_true', help="smaller runs, for smoke tests")
+    parser.add_argument('--scale', type=float, default=1.0, help=argparse.SUPPRESS)
+    parser.add_argument('--save', metavar='FILE', help="save the results as JSON")
+    parser.add_argument('--compare', metavar='FILE', help="compare with saved results")
+    parser.add_argument('--commits', nargs='+', metavar='REVISION', help="benchmark these commits")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative change flagged as regression")
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+    if options.quick:
+        options.scale *= QUICK_SCALE
+    if options.run_scenario:
+        server = options.server.split(':')
+        print(json.dumps(run_scenario(options.run_scenario, server, options.scale)))
+        return 0
+
+    options.scenario = options.scenario or list(SCENARIOS)
+    process = None
+    if options.server:
+        options.server = options.server.split(':')
+    else:
+        process, options.server = start_fake_server()
+    try:
+        if options.commits:
+            all_results = run_commits(options.commits, options)
+        else:
+            all_results = [run_suite(options.server, options.scenario, options.scale, SOURCES_DIRECTORY)]
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if options.save:
+        with open(options.save, 'w') as fh:
+            json.dump(all_results[-1] if len(all_results) == 1 else all_results, fh, indent=2)
+    regressions = []
+    if options.compare:
+        with open(options.compare) as fh:
+            regressions += compare(json.load(fh), all_results[-1], options.threshold)
+    for results in all_results[1:]:
+        regressions += compare(all_results[0], results, options.threshold)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
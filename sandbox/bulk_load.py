@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+=========================================
+Loading a directory tree with BulkLoader
+=========================================
+
+Usage: python bulk_load.py /path/to/directory [uri/prefix/]
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import logging
+import os
+import sys
+
+from mllib.bulk import BulkLoader, iter_directory
+from mllib.documents import DocumentsService
+
+logging.basicConfig(level=logging.WARNING)  # Try "INFO" then "DEBUG" for more verbosity
+
+WORKERS = 8
+
+if 'MLLIB_TEST_SERVER' not in os.environ:
+    os.environ['MLLIB_TEST_SERVER'] = 'localhost:8000:admin:admin'
+
+root = sys.argv[1]
+uri_prefix = sys.argv[2] if len(sys.argv) > 2 else '/python_demo/bulk/'
+
+# All workers share the connections of this service
+ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', pool_maxsize=WORKERS)
+
+
+def show_progress(result):
+    print(result)
+
+loader = BulkLoader(ds, workers=WORKERS, batch_size=100, callback=show_progress)
+report = loader.load(iter_directory(root, uri_prefix=uri_prefix))
+
+print("{0} document(s) loaded in {1:.2f}s, {2} retries, {3} failed batches".format(
+    report.documents, report.elapsed, report.retries, len(report.failed)))
@@ -6,19 +6,16 @@ Cleaning up your tests database
 """
 from __future__ import print_function, unicode_literals, absolute_import
 
-import json
 import os
 
 from mllib.documents import DocumentsService
 from mllib.eval import EvalService
 
-ALL_URIS_JS = r"""
-var res = [];
-for (var x of fn.doc()) {
-  res.push(fn.documentUri(x))
-    }
-res;
+ALL_URIS_XQ = """
+for $doc in fn:doc()
+return xdmp:node-uri($doc)
 """
+BATCH_SIZE = 1000
 
 
 def hit_return():
@@ -31,10 +28,15 @@ hit_return()
 
 es = EvalService.from_envvar('MLLIB_TEST_SERVER')
 ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER')
-response = es.eval_post(javascript=ALL_URIS_JS)
-headers, document = response.iter_parts().next()
-uris = json.loads(document)
-
-if uris:
-    ds.document_delete(uri=uris)
-print(len(uris), "document(s) deleted.")
+count = 0
+batch = []
+for uri in es.eval_items(xquery=ALL_URIS_XQ):
+    batch.append(uri)
+    if len(batch) == BATCH_SIZE:
+        ds.document_delete(uri=batch)
+        count += len(batch)
+        batch = []
+if batch:
+    ds.document_delete(uri=batch)
+    count += len(batch)
+print(count, "document(s) deleted.")
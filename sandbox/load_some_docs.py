@@ -125,7 +125,8 @@ def ml_int_addition(value1, value2):
     """A simple and useless server side operation
     """
     es = EvalService.from_envvar('MLLIB_TEST_SERVER')
-    response = es.eval_post(xquery=ADDITION_XQY, vars={'value1': value1, 'value2': value2})
+    # Installed once as a module, then invoked with the vars only
+    response = es.eval_prepared(xquery=ADDITION_XQY, vars={'value1': value1, 'value2': value2})
     headers, document = response.iter_parts().next()
     assert headers['X-Primitive'] == 'integer'
     return int(document)
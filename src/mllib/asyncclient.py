@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+=================
+mllib.asyncclient
+=================
+
+Non blocking services: requests are run by a bounded pool of workers and their methods return
+:class:`Future` objects immediately.
+
+.. code:: python
+
+   ds = AsyncDocumentsService.from_envvar('MLLIB_TEST_SERVER', max_concurrency=32)
+   futures = [ds.document_get(uri=uri) for uri in uris]
+   for future in as_completed(futures):
+       print(future.result().text)
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import Queue
+import sys
+import threading
+
+from . import LOG
+from .config import ASYNC_MAX_CONCURRENCY
+from .documents import DocumentsService
+from .eval import EvalService
+from .restclient import RESTClient
+from .transactions import TransactionsService
+from .utils import ResponseAdapter
+
+_STOP = object()  # Tells a worker to exit
+_END = object()  # End of parts
+
+
+class Future(object):
+    """The result of an operation run by a worker"""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """The result of the operation, waiting for it if needed. Exceptions of the operation are raised.
+
+        :param timeout: max seconds to wait
+        :raise: :class:`mllib.asyncclient.TimeoutError` when the timeout expires
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Operation not done after {0} seconds".format(timeout))
+        exc_info = self._exc_info
+        if exc_info is not None:
+            # With the traceback of the worker
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """The exception raised by the operation or None"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Operation not done after {0} seconds".format(timeout))
+        return None if self._exc_info is None else self._exc_info[1]
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) when done (immediately if already done)"""
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            LOG.exception("Future callback %r failed", callback)
+
+
+class TimeoutError(Exception):
+    """A future is not done in time"""
+
+
+def as_completed(futures, timeout=None):
+    """Yields the futures as they are done
+
+    :param futures: iterable of :class:`Future` objects
+    :param timeout: max seconds to wait for each future
+    """
+    done = Queue.Queue()
+    futures = list(futures)
+    for future in futures:
+        future.add_done_callback(done.put)
+    for _ in futures:
+        try:
+            yield done.get(timeout=timeout)
+        except Queue.Empty:
+            raise TimeoutError("No operation done after {0} seconds".format(timeout))
+
+
+class Executor(object):
+    """Runs functions with a fixed number of worker threads. Pending calls wait in a queue, hence the number of
+    concurrent requests (and connections) is bounded by ``max_workers``.
+    """
+    def __init__(self, max_workers=ASYNC_MAX_CONCURRENCY):
+        if max_workers < 1:
+            raise ValueError("max_workers must be a positive integer, got: {0}".format(max_workers))
+        self.max_workers = max_workers
+        self._jobs = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        """Schedules func(*args, **kwargs)
+
+        :return: a :class:`Future`
+        """
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot schedule new calls after shutdown")
+            self._jobs.put((future, func, args, kwargs))
+            # Workers are started on demand
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return future
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is _STOP:
+                return
+            future, func, args, kwargs = job
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+            del job, future, func, args, kwargs
+
+    def shutdown(self, wait=True):
+        """Stops the workers after pending calls"""
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            for _ in self._threads:
+                self._jobs.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+
+class AsyncResponseAdapter(object):
+    """Parts of a multipart response, read by a reader thread while they are consumed"""
+    def __init__(self, adapter, executor, max_pending=ASYNC_MAX_CONCURRENCY):
+        """
+        :param adapter: a :class:`mllib.utils.ResponseAdapter`
+        :param executor: the :class:`Executor` of :meth:`parts`
+        :param max_pending: max number of parts read in advance
+        """
+        self.adapter = adapter
+        self.response = adapter.response
+        self.executor = executor
+        self.max_pending = max_pending
+
+    def iter_parts(self):
+        """Yields (headers, body) tuples. A reader thread of its own reads and parses the response meanwhile, such
+        that slow consumers do not hold the workers of the executor.
+        """
+        parts = Queue.Queue(maxsize=self.max_pending)
+        abandoned = threading.Event()
+        future = Future()
+
+        def pump():
+            try:
+                for part in self.adapter.iter_parts():
+                    if abandoned.is_set():
+                        break
+                    parts.put(part)
+            except BaseException:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(None)
+            finally:
+                parts.put(_END)
+
+        reader = threading.Thread(target=pump)
+        reader.daemon = True
+        reader.start()
+        finished = False
+        try:
+            while True:
+                part = parts.get()
+                if part is _END:
+                    finished = True
+                    break
+                yield part
+        finally:
+            if not finished:
+                # Unblocks the reader
+                abandoned.set()
+                while parts.get() is not _END:
+                    pass
+                # The reader is done with the response
+                self.adapter.close()
+        future.result()  # Raises the parsing errors
+
+    def parts(self):
+        """A :class:`Future` of the list of all (headers, body) tuples"""
+        return self.executor.submit(lambda: list(self.adapter.iter_parts()))
+
+    def close(self):
+        self.adapter.close()
+
+
+def _async_method(name):
+    """A method that runs the method of the synchronous service in a worker"""
+    def method(self, *args, **kwargs):
+        return self.executor.submit(self._call_service, name, *args, **kwargs)
+    method.__name__ = str(name)
+    method.__doc__ = "Non blocking :meth:`{0}`, returns a :class:`Future` of its result".format(name)
+    return method
+
+
+class AsyncRESTClient(object):
+    """Non blocking variant of :class:`mllib.restclient.RESTClient`. Methods of the synchronous service
+    (``service_class`` attribute) are run by an :class:`Executor` of ``max_concurrency`` workers which share its
+    pooled connections.
+    """
+    service_class = RESTClient
+
+    def __init__(self, hostname, port, username, password, authtype='digest',
+                 max_concurrency=ASYNC_MAX_CONCURRENCY, **kwargs):
+        """
+        :param max_concurrency: max number of requests run at once
+        :param kwargs: other arguments of :class:`mllib.restclient.RESTClient`
+        """
+        kwargs.setdefault('pool_maxsize', max_concurrency)
+        self.service = self.service_class(hostname, port, username, password, authtype, **kwargs)
+        self.executor = Executor(max_concurrency)
+
+    @classmethod
+    def from_envvar(cls, varname, **kwargs):
+        """See :meth:`mllib.restclient.RESTClient.from_envvar`"""
+        features = os.environ[varname]
+        return cls(*features.split(':'), **kwargs)
+
+    @property
+    def base_url(self):
+        return self.service.base_url
+
+    def _call_service(self, name, *args, **kwargs):
+        result = getattr(self.service, name)(*args, **kwargs)
+        if isinstance(result, ResponseAdapter):
+            result = AsyncResponseAdapter(result, self.executor)
+        return result
+
+    def close(self):
+        """Waits for pending requests and closes the connections"""
+        self.executor.shutdown()
+        self.service.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    rest_get = _async_method('rest_get')
+    rest_post = _async_method('rest_post')
+    rest_patch = _async_method('rest_patch')
+    rest_put = _async_method('rest_put')
+    rest_delete = _async_method('rest_delete')
+
+
+class AsyncDocumentsService(AsyncRESTClient):
+    """Non blocking :class:`mllib.documents.DocumentsService`"""
+    service_class = DocumentsService
+
+    document_put = _async_method('document_put')
+    document_get = _async_method('document_get')
+    document_delete = _async_method('document_delete')
+    document_patch = _async_method('document_patch')
+    document_post = _async_method('document_post')
+
+
+class AsyncEvalService(AsyncRESTClient):
+    """Non blocking :class:`mllib.eval.EvalService`"""
+    service_class = EvalService
+
+    eval_post = _async_method('eval_post')
+    invoke_post = _async_method('invoke_post')
+    eval_prepared = _async_method('eval_prepared')
+
+
+class AsyncTransactionsService(AsyncRESTClient):
+    """Non blocking :class:`mllib.transactions.TransactionsService`"""
+    service_class = TransactionsService
+
+    transactions_post = _async_method('transactions_post')
+    transactions_txid_get = _async_method('transactions_txid_get')
+    transactions_txid_post = _async_method('transactions_txid_post')
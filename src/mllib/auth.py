@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+==========
+mllib.auth
+==========
+
+HTTP authentication helpers for the MarkLogic REST server
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import hashlib
+import os
+import threading
+import time
+from urlparse import urlparse
+
+import requests.auth
+from requests.cookies import extract_cookies_to_jar
+from requests.utils import parse_dict_header
+
+from . import LOG
+
+HASH_FUNCTIONS = {
+    'MD5': hashlib.md5,
+    'MD5-SESS': hashlib.md5,
+    'SHA': hashlib.sha1,
+    'SHA-256': hashlib.sha256,
+    'SHA-512': hashlib.sha512
+}
+
+
+def _hexdigest(hash_func, text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return hash_func(text).hexdigest()
+
+
+class _RequestState(object):
+    """Authentication state of one logical request (survives its 401 retry)"""
+    def __init__(self, body, body_position):
+        # Streamed bodies (generators...) cannot be sent twice, unless rewindable (see mllib.retry.RewindableBody)
+        self.replayable = (body_position is not None or body is None or isinstance(body, (bytes, unicode))
+                           or getattr(body, 'replayable', False))
+        self.body_position = body_position
+        self.sent_nonce = None
+        self.retried = False
+
+
+class CachingDigestAuth(requests.auth.AuthBase):
+    """HTTP Digest authentication that keeps the last challenge of each server and reuses its nonce for the next
+    requests, with an incremented nonce count. Only the very first request to a server, and the requests that get
+    a new challenge (stale nonce), pay the extra 401 round-trip.
+
+    One instance may be shared by all threads that use the same client. Statistics are available in the
+    ``challenges`` (401 challenges answered), ``reused_nonces`` (requests authenticated upfront with the
+    cached nonce) and ``stale_nonces`` (cached nonces refused as stale by the server) attributes.
+    """
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self._lock = threading.Lock()
+        self._chals = {}  # {netloc: [challenge, nonce count], ...}
+        self.challenges = 0
+        self.reused_nonces = 0
+        self.stale_nonces = 0
+
+    @property
+    def stats(self):
+        """A dict snapshot of the counters"""
+        return {
+            'challenges': self.challenges,
+            'reused_nonces': self.reused_nonces,
+            'stale_nonces': self.stale_nonces
+        }
+
+    @property
+    def has_challenge(self):
+        """True when requests can be authenticated upfront"""
+        return bool(self._chals)
+
+    def has_challenge_for(self, url):
+        """True when requests to the server of an URL can be authenticated upfront"""
+        return urlparse(url).netloc in self._chals
+
+    def reset(self):
+        """Forgets the cached challenges"""
+        with self._lock:
+            self._chals = {}
+
+    def _next_nonce(self, netloc):
+        """The cached challenge of a server with its next nonce count, or ``(None, None)``"""
+        with self._lock:
+            cached = self._chals.get(netloc)
+            if cached is None:
+                return None, None
+            cached[1] += 1
+            return cached[0], cached[1]
+
+    def _store_challenge(self, chal, netloc):
+        with self._lock:
+            self._chals[netloc] = [chal, 0]
+            self.challenges += 1
+
+    def make_cnonce(self, nonce_count):
+        """A random client nonce"""
+        seed = '{0}:{1}:{2}'.format(nonce_count, time.time(), os.urandom(8).encode('hex'))
+        return hashlib.sha1(seed.encode('ascii')).hexdigest()[:16]
+
+    def build_digest_header(self, method, url, chal, nonce_count):
+        """The value of the ``Authorization`` header
+
+        :param method: HTTP verb of the request
+        :param url: full URL of the request
+        :param chal: server challenge as dict
+        :param nonce_count: count of requests sent with the nonce of this challenge
+        :return: header value or None if the challenge is not supported
+        """
+        realm = chal['realm']
+        nonce = chal['nonce']
+        qop = chal.get('qop')
+        algorithm = chal.get('algorithm', 'MD5').upper()
+        opaque = chal.get('opaque')
+        hash_func = HASH_FUNCTIONS.get(algorithm)
+        if hash_func is None:
+            LOG.warning("Unsupported digest algorithm %s", algorithm)
+            return None
+
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        ha1 = _hexdigest(hash_func, '{0}:{1}:{2}'.format(self.username, realm, self.password))
+        ha2 = _hexdigest(hash_func, '{0}:{1}'.format(method, path))
+        ncvalue = '{0:08x}'.format(nonce_count)
+        cnonce = self.make_cnonce(nonce_count)
+        if algorithm == 'MD5-SESS':
+            ha1 = _hexdigest(hash_func, '{0}:{1}:{2}'.format(ha1, nonce, cnonce))
+
+        if not qop:
+            respdig = _hexdigest(hash_func, '{0}:{1}:{2}'.format(ha1, nonce, ha2))
+        elif 'auth' in [q.strip() for q in qop.split(',')]:
+            respdig = _hexdigest(hash_func, '{0}:{1}:{2}:{3}:{4}:{5}'.format(ha1, nonce, ncvalue, cnonce, 'auth', ha2))
+        else:
+            LOG.warning("Unsupported digest qop %s", qop)
+            return None
+
+        base = 'username="{0}", realm="{1}", nonce="{2}", uri="{3}", response="{4}"'.format(
+            self.username, realm, nonce, path, respdig)
+        if opaque:
+            base += ', opaque="{0}"'.format(opaque)
+        if algorithm:
+            base += ', algorithm="{0}"'.format(algorithm)
+        if qop:
+            base += ', qop="auth", nc={0}, cnonce="{1}"'.format(ncvalue, cnonce)
+        return 'Digest {0}'.format(base)
+
+    def __call__(self, r):
+        try:
+            body_position = r.body.tell()
+        except AttributeError:
+            body_position = None
+        state = _RequestState(r.body, body_position)
+
+        chal, nonce_count = self._next_nonce(urlparse(r.url).netloc)
+        if chal is not None:
+            header = self.build_digest_header(r.method, r.url, chal, nonce_count)
+            if header is not None:
+                r.headers['Authorization'] = header
+                state.sent_nonce = chal['nonce']
+                with self._lock:
+                    self.reused_nonces += 1
+        r.register_hook('response', lambda response, **kwargs: self.handle_401(state, response, **kwargs))
+        return r
+
+    def handle_401(self, state, r, **kwargs):
+        """Answers a digest challenge once per request"""
+        if r.status_code != 401 or state.retried:
+            return r
+        s_auth = r.headers.get('www-authenticate', '')
+        if 'digest' not in s_auth.lower():
+            return r
+
+        chal = parse_dict_header(s_auth.split(' ', 1)[-1])
+        if state.sent_nonce is not None:
+            if chal.get('stale', '').lower() == 'true':
+                with self._lock:
+                    self.stale_nonces += 1
+            elif chal.get('nonce') == state.sent_nonce:
+                # Our nonce is still valid: bad credentials
+                return r
+        netloc = urlparse(r.request.url).netloc
+        self._store_challenge(chal, netloc)
+        state.retried = True
+        if not state.replayable:
+            LOG.warning("Cannot replay a streamed request body after a digest challenge")
+            return r
+
+        if state.body_position is not None:
+            r.request.body.seek(state.body_position)
+
+        # Consume content and release the original connection to allow our new request to reuse it.
+        r.content
+        r.close()
+        prep = r.request.copy()
+        extract_cookies_to_jar(prep._cookies, r.request, r.raw)
+        prep.prepare_cookies(prep._cookies)
+
+        chal, nonce_count = self._next_nonce(netloc)
+        header = self.build_digest_header(prep.method, prep.url, chal, nonce_count)
+        if header is None:
+            return r
+        prep.headers['Authorization'] = header
+        _r = r.connection.send(prep, **kwargs)
+        _r.history.append(r)
+        _r.request = prep
+        return _r
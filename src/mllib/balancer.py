@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+==============
+mllib.balancer
+==============
+
+Spreading the requests of a client over the nodes of a MarkLogic cluster
+
+.. code:: python
+
+   ds = DocumentsService(['node1', 'node2', 'node3'], 8000, 'admin', 'admin', balancing='least-inflight')
+   # Or with MLLIB_TEST_SERVER=node1,node2,node3:8000:admin:admin
+   ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', balancing='latency')
+
+Nodes that fail (connection errors, 502, 503, 504 responses) ``max_failures`` times in a row are ejected for
+``ejection_time`` seconds. The requests of a multi statements transaction go to the node that created it.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import collections
+import itertools
+import random
+import re
+import threading
+import time
+
+import requests
+
+from .config import BALANCER_EJECTION_TIME, BALANCER_MAX_FAILURES, BALANCER_MAX_TRANSACTIONS
+from .mlexceptions import MarkLogicServerError
+
+STRATEGIES = ('round-robin', 'least-inflight', 'latency')
+NODE_FAILURE_CODES = frozenset((502, 503, 504))
+_txid_path_rx = re.compile(r'^/v1/transactions/([^/?]+)')
+
+
+class Node(object):
+    """A node of the cluster and its health"""
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.inflight = 0
+        self.latency = None  # Moving average in seconds
+        self.failures = 0  # In a row
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.ejections = 0
+
+    def __repr__(self):
+        return '<Node {0}: {1} in flight, {2} failures>'.format(self.base_url, self.inflight, self.failures)
+
+
+def is_node_failure(exc):
+    """Errors that tell that a node is unhealthy"""
+    if isinstance(exc, MarkLogicServerError):
+        return exc.http_code in NODE_FAILURE_CODES
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+def request_txid(service_path, kwargs):
+    """The transaction of a request, None out of transactions
+
+    .. code:: pycon
+
+       >>> request_txid('/v1/documents', {'params': {'uri': '/a.xml', 'txid': '123'}})
+       u'123'
+       >>> request_txid('/v1/transactions/456', {})
+       u'456'
+    """
+    params = kwargs.get('params') or {}
+    txid = params.get('txid')
+    if txid is not None:
+        return txid
+    match = _txid_path_rx.match(service_path)
+    if match is not None:
+        return match.group(1)
+    return None
+
+
+class Balancer(object):
+    """Chooses the node of each request"""
+    def __init__(self, base_urls, strategy='round-robin', max_failures=BALANCER_MAX_FAILURES,
+                 ejection_time=BALANCER_EJECTION_TIME, smoothing=0.2, clock=time.time):
+        """
+        :param base_urls: sequence of the base URLs of the nodes, like 'http://node1:8000'
+        :param strategy: 'round-robin', 'least-inflight' or 'latency' (the fastest nodes, weighted by their
+          requests in flight)
+        :param max_failures: failures in a row that eject a node
+        :param ejection_time: seconds an ejected node gets no request
+        :param smoothing: weight of each latency sample in the moving average of the nodes
+        :param clock: a callable that returns the current time in seconds
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError("strategy must be one of {0}, got: {1}".format(', '.join(STRATEGIES), strategy))
+        if not base_urls:
+            raise ValueError("At least one node is required")
+        self.nodes = [Node(base_url) for base_url in base_urls]
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.ejection_time = ejection_time
+        self.smoothing = smoothing
+        self.clock = clock
+        self._counter = itertools.count()
+        self._transactions = collections.OrderedDict()  # {txid: node, ...}
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """{base_url: {'inflight': n, 'latency': s, 'failures': n, 'ejected': bool, 'requests': n,
+        'ejections': n}, ...}
+        """
+        now = self.clock()
+        return {node.base_url: {'inflight': node.inflight, 'latency': node.latency, 'failures': node.failures,
+                                'ejected': node.ejected_until > now, 'requests': node.requests,
+                                'ejections': node.ejections}
+                for node in self.nodes}
+
+    def _choose(self):
+        now = self.clock()
+        healthy = [node for node in self.nodes if node.ejected_until <= now]
+        if not healthy:
+            # Better try a node than fail: the one that comes back first
+            return min(self.nodes, key=lambda node: node.ejected_until)
+        if self.strategy == 'round-robin':
+            return healthy[next(self._counter) % len(healthy)]
+        if self.strategy == 'least-inflight':
+            fewest = min(node.inflight for node in healthy)
+            return random.choice([node for node in healthy if node.inflight == fewest])
+        # Nodes without latency yet are tried first
+        return min(healthy, key=lambda node: ((node.latency or 0.0) * (node.inflight + 1), random.random()))
+
+    def acquire(self, txid=None):
+        """The node for a request, to be released with :meth:`release`
+
+        :param txid: the transaction of the request, None out of transactions
+        """
+        with self._lock:
+            node = self._transactions.get(txid) if txid is not None else None
+            if node is None:
+                node = self._choose()
+            node.inflight += 1
+            node.requests += 1
+            return node
+
+    def release(self, node, latency=None, failed=False):
+        """Accounts the outcome of a request
+
+        :param node: the :class:`Node` of the request
+        :param latency: seconds of the successful requests
+        :param failed: True when the node seems unhealthy
+        """
+        with self._lock:
+            node.inflight -= 1
+            if failed:
+                node.failures += 1
+                if node.failures >= self.max_failures:
+                    node.ejected_until = self.clock() + self.ejection_time
+                    node.ejections += 1
+                    node.failures = 0
+                return
+            node.failures = 0
+            if latency is not None:
+                if node.latency is None:
+                    node.latency = latency
+                else:
+                    node.latency += self.smoothing * (latency - node.latency)
+
+    def pin(self, txid, node):
+        """Sends the next requests of a transaction to a node"""
+        with self._lock:
+            self._transactions[txid] = node
+            while len(self._transactions) > BALANCER_MAX_TRANSACTIONS:
+                self._transactions.popitem(last=False)
+
+    def unpin(self, txid):
+        with self._lock:
+            self._transactions.pop(txid, None)
@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+==========
+mllib.bulk
+==========
+
+Loading lots of documents with parallel bulk requests, and buffering frequent writes
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import atexit
+import collections
+import itertools
+import os
+import Queue
+import threading
+import time
+import weakref
+
+import requests
+
+from . import LOG
+from .config import BULK_BATCH_SIZE, WRITE_BEHIND_MAX_DOCUMENTS, WRITE_BEHIND_MAX_BYTES, WRITE_BEHIND_INTERVAL
+from .metrics import REGISTRY
+from .mlexceptions import MarkLogicServerError
+
+_STOP = object()  # Tells a worker to exit
+
+
+class LazyFile(object):
+    """A file that is opened on the first read and closed at EOF. Many of them may wait in batches without
+    exhausting the file descriptors.
+    """
+    def __init__(self, path):
+        self.name = path
+        self._file = None
+
+    def read(self, size=-1):
+        if self._file is None:
+            self._file = open(self.name, 'rb')
+        data = self._file.read(size)
+        if not data:
+            self.close()
+        return data
+
+    def seek(self, offset):
+        """Only rewinding is supported"""
+        assert offset == 0, "LazyFile can only be rewound"
+        self.close()
+
+    def tell(self):
+        return 0 if self._file is None else self._file.tell()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def iter_directory(root, uri_prefix='/', metadata=None):
+    """Yields the (uri, content, metadata) tuples of all files of a directory tree
+
+    :param root: path to the directory
+    :param uri_prefix: prepended to the relative path of each file to make its URI
+    :param metadata: the metadata of all documents (see :meth:`mllib.documents.DocumentsService.document_post`)
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, root).replace(os.sep, '/')
+            yield uri_prefix + relpath, LazyFile(path), metadata
+
+
+class BatchResult(object):
+    """The outcome of a batch of documents"""
+    def __init__(self, index, uris):
+        """
+        :param index: sequence number of the batch in the load
+        :param uris: URIs of the documents of the batch
+        """
+        self.index = index
+        self.uris = uris
+        self.attempts = 0
+        self.response = None
+        self.error = None
+        self.elapsed = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<BatchResult #{0}: {1} documents, {2} attempt(s), {3}>'.format(
+            self.index, len(self.uris), self.attempts, 'ok' if self.ok else repr(self.error))
+
+
+class LoadReport(object):
+    """Summary of a bulk load"""
+    def __init__(self):
+        self.batches = 0
+        self.documents = 0
+        self.retries = 0
+        self.failed = []  # BatchResult objects of failed batches
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, result):
+        with self._lock:
+            self.batches += 1
+            self.retries += result.attempts - 1
+            if result.ok:
+                self.documents += len(result.uris)
+            else:
+                self.failed.append(result)
+
+    @property
+    def ok(self):
+        return len(self.failed) == 0
+
+
+class BulkLoader(object):
+    """Writes a stream of documents with a pool of threads that run parallel bulk requests on one
+    :class:`mllib.documents.DocumentsService`, which pooled connections are shared by the workers (give it a
+    ``pool_maxsize`` not less than ``workers``).
+
+    At most ``max_pending`` batches wait for a worker: the reading of the documents stream is blocked meanwhile.
+
+    .. code:: python
+
+       ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', pool_maxsize=8)
+       loader = BulkLoader(ds, workers=8, batch_size=200, database='Documents')
+       report = loader.load(iter_directory('/data/docs', uri_prefix='/docs/'))
+    """
+    def __init__(self, client, workers=4, batch_size=BULK_BATCH_SIZE, max_pending=None, retries=2,
+                 retry_delay=1.0, callback=None, **kwargs):
+        """
+        :param client: a :class:`mllib.documents.DocumentsService` object
+        :param workers: number of parallel requests
+        :param batch_size: max number of documents of each request
+        :param max_pending: max number of batches waiting for a worker, defaults to twice ``workers``
+        :param retries: number of attempts after the first failure of a batch
+        :param retry_delay: seconds before the first retry, doubled for each other retry
+        :param callback: a callable that gets the :class:`BatchResult` of each batch (called by the workers)
+        :param kwargs: other named arguments for :meth:`mllib.documents.DocumentsService.document_post`
+        """
+        if workers < 1:
+            raise ValueError("workers must be a positive integer, got: {0}".format(workers))
+        post_params = getattr(client, '_document_post_params', None)
+        if post_params is not None:
+            # Bad options fail now rather than in each batch
+            post_params.request_params(kwargs)
+        self.client = client
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.callback = callback
+        self.post_kwargs = kwargs
+
+    def load(self, documents):
+        """Writes the documents
+
+        :param documents: iterable of (uri, content, metadata) tuples, see
+          :meth:`mllib.documents.DocumentsService.document_post`
+        :return: a :class:`LoadReport`
+        """
+        report = LoadReport()
+        started = time.time()
+        self.client.prime_authentication()
+        pending = Queue.Queue(maxsize=self.max_pending)
+        threads = [threading.Thread(target=self._work, args=(pending, report)) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for index, batch in enumerate(self._iter_batches(documents)):
+                pending.put((index, batch))
+        finally:
+            for _ in threads:
+                pending.put(_STOP)
+            for thread in threads:
+                thread.join()
+        report.elapsed = time.time() - started
+        return report
+
+    def _iter_batches(self, documents):
+        batch = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _work(self, pending, report):
+        while True:
+            job = pending.get()
+            if job is _STOP:
+                return
+            result = self.run_batch(*job)
+            report.add(result)
+            if self.callback is not None:
+                try:
+                    self.callback(result)
+                except Exception:
+                    LOG.exception("Bulk load callback failed for %r", result)
+
+    def run_batch(self, index, batch):
+        """Like :meth:`write_batch`, unexpected errors (unreadable content...) fail the batch rather than being
+        raised
+        """
+        try:
+            return self.write_batch(index, batch)
+        except Exception as exc:
+            LOG.exception("Batch #%s failed", index)
+            result = BatchResult(index, [document[0] for document in batch])
+            result.attempts = 1
+            result.error = exc
+            return result
+
+    def write_batch(self, index, batch):
+        """Writes a batch with retries
+
+        :param index: sequence number of the batch
+        :param batch: list of (uri, content, metadata) tuples
+        :return: a :class:`BatchResult`
+        """
+        result = BatchResult(index, [document[0] for document in batch])
+        positions = [_tell(content) for _, content, _ in batch]
+        delay = self.retry_delay
+        started = time.time()
+        while True:
+            result.attempts += 1
+            try:
+                responses = self.client.document_post(batch, batch_size=len(batch), **self.post_kwargs)
+                result.response = responses[0]
+                result.error = None
+                break
+            except (MarkLogicServerError, requests.RequestException) as exc:
+                result.error = exc
+                if result.attempts > self.retries or not is_transient(exc):
+                    LOG.error("Batch #%s failed after %s attempts: %s", index, result.attempts, exc)
+                    break
+                LOG.warning("Batch #%s failed (%s), retrying in %ss", index, exc, delay)
+                time.sleep(delay)
+                delay *= 2
+                REGISTRY.inc('mllib_retries_total', kind='bulk_batch')
+                for (_, content, _), position in zip(batch, positions):
+                    if position is not None:
+                        content.seek(position)
+        result.elapsed = time.time() - started
+        return result
+
+
+class WriteBehindBuffer(object):
+    """Accepts document writes immediately and sends them later with bulk requests of a
+    :class:`mllib.documents.DocumentsService`. Writes to a URI that is still pending replace the previous one,
+    such that only the latest content of hot documents is sent.
+
+    The pending documents are flushed by a background thread every ``interval`` seconds, as soon as there are
+    ``max_documents`` of them or ``max_bytes`` of string contents, by :meth:`flush` and by :meth:`close`. Writers
+    of new URIs are blocked while the buffer is full and the previous flush is running, such that at most twice
+    these limits sit in memory. Reads don't see the pending documents.
+
+    .. code:: python
+
+       ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER')
+       with ds.write_behind(interval=0.5, callback=report_failures) as buffer:
+           for event in events:
+               buffer.put('/status/{0}.json'.format(event.source), event.json)
+    """
+    def __init__(self, client, max_documents=WRITE_BEHIND_MAX_DOCUMENTS, max_bytes=WRITE_BEHIND_MAX_BYTES,
+                 interval=WRITE_BEHIND_INTERVAL, batch_size=BULK_BATCH_SIZE, retries=2, retry_delay=1.0,
+                 callback=None, **kwargs):
+        """
+        :param client: a :class:`mllib.documents.DocumentsService` object
+        :param max_documents: number of pending documents that triggers a flush
+        :param max_bytes: size of the pending string contents that triggers a flush
+        :param interval: max seconds between two flushes
+        :param batch_size: max number of documents of each request
+        :param retries: number of attempts after the first failure of a batch
+        :param retry_delay: seconds before the first retry, doubled for each other retry
+        :param callback: a callable that gets the :class:`BatchResult` of each flushed batch, failed or not. It may
+          :meth:`put` the documents of failed batches again, even in a full buffer, but not after :meth:`close`.
+        :param kwargs: other named arguments for :meth:`mllib.documents.DocumentsService.document_post`
+        """
+        if max_documents < 1:
+            raise ValueError("max_documents must be a positive integer, got: {0}".format(max_documents))
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.callback = callback
+        self.report = LoadReport()
+        self.coalesced = 0  # Writes replaced by a later one before being sent
+        self._loader = BulkLoader(client, workers=1, batch_size=batch_size, retries=retries,
+                                  retry_delay=retry_delay, **kwargs)
+        self._pending = collections.OrderedDict()  # {uri: (content, metadata, size), ...}
+        self._bytes = 0
+        self._closed = False
+        self._batches = itertools.count()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()  # Flushes in order, older contents never overwrite newer ones
+        self._local = threading.local()  # in_callback: puts of the callbacks do not wait for room
+        self._thread = threading.Thread(target=self._run, name='write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+        _open_buffers.add(self)
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def put(self, uri, content, metadata=None):
+        """Writes a document later
+
+        :param uri: of the document
+        :param content: a string, a file object opened in 'rb' mode or None (metadata only)
+        :param metadata: a mapping, an XML or JSON string or None, see
+          :meth:`mllib.documents.DocumentsService.document_post`
+        """
+        size = len(content) if isinstance(content, basestring) else 0
+        with self._cond:
+            # The callbacks run in the flushing threads, they would wait for themselves
+            in_callback = getattr(self._local, 'in_callback', False)
+            while uri not in self._pending and self._full() and not self._closed and not in_callback:
+                self._cond.wait()
+            if self._closed:
+                raise RuntimeError("Write behind buffer closed")
+            previous = self._pending.pop(uri, None)
+            if previous is not None:
+                self.coalesced += 1
+                self._bytes -= previous[2]
+            self._pending[uri] = (content, metadata, size)
+            self._bytes += size
+            if self._full():
+                self._cond.notify_all()
+
+    def flush(self):
+        """Writes the pending documents now
+
+        :return: the list of the :class:`BatchResult` of the written batches
+        """
+        with self._flush_lock:
+            with self._cond:
+                pending, self._pending = self._pending, collections.OrderedDict()
+                self._bytes = 0
+                self._cond.notify_all()
+            documents = [(uri, content, metadata) for uri, (content, metadata, _) in pending.iteritems()]
+            results = []
+            for batch in self._loader._iter_batches(documents):
+                result = self._loader.run_batch(next(self._batches), batch)
+                self.report.add(result)
+                results.append(result)
+        # Out of the flush lock, the callbacks may put documents again
+        if self.callback is not None:
+            self._local.in_callback = True
+            try:
+                for result in results:
+                    try:
+                        self.callback(result)
+                    except Exception:
+                        LOG.exception("Write behind callback failed for %r", result)
+            finally:
+                self._local.in_callback = False
+        return results
+
+    def close(self):
+        """Stops the background flushes and writes the pending documents
+
+        :return: the list of the :class:`BatchResult` of the last flush
+        :raise: :class:`WriteBehindError` when some of these documents could not be written
+        """
+        with self._cond:
+            if self._closed:
+                return []
+            self._closed = True
+            self._cond.notify_all()
+        _open_buffers.discard(self)
+        self._thread.join()
+        results = self.flush()
+        failed = [result for result in results if not result.ok]
+        if failed:
+            raise WriteBehindError(failed)
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except WriteBehindError:
+            # The original exception matters more
+            LOG.exception("Closing the write behind buffer failed")
+
+    def _full(self):
+        return len(self._pending) >= self.max_documents or self._bytes >= self.max_bytes
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and not self._full():
+                    self._cond.wait(self.interval)
+                if self._closed:
+                    return
+                if not self._pending:
+                    continue
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception("Write behind flush failed")
+
+
+class WriteBehindError(Exception):
+    """Documents of a :class:`WriteBehindBuffer` could not be written when closing it"""
+    def __init__(self, failed):
+        """
+        :param failed: the :class:`BatchResult` objects of the failed batches
+        """
+        super(WriteBehindError, self).__init__(failed)
+        self.failed = failed
+
+    def __str__(self):
+        return "{0} documents not written: {1}".format(sum(len(result.uris) for result in self.failed),
+                                                       self.failed[0].error)
+
+
+_open_buffers = weakref.WeakSet()  # WriteBehindBuffer objects to close at exit
+
+
+@atexit.register
+def _close_open_buffers():
+    """Writes the documents still pending when the interpreter exits"""
+    for buffer in list(_open_buffers):
+        try:
+            buffer.close()
+        except WriteBehindError:
+            LOG.exception("Documents lost at exit")
+
+
+def is_transient(exc):
+    """Errors that may not happen again: connection errors and server side (5xx) errors"""
+    if isinstance(exc, MarkLogicServerError):
+        return exc.http_code >= 500
+    return True
+
+
+def _tell(content):
+    """Position of a file like content, None for strings"""
+    try:
+        return content.tell()
+    except (AttributeError, IOError, OSError):
+        return None
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+===========
+mllib.cache
+===========
+
+Client side cache of the documents read with :meth:`mllib.documents.DocumentsService.document_get`
+
+Entries are served as they are during ``ttl`` seconds, then revalidated with an ``If-None-Match`` request that
+gets a cheap "304 Not Modified" when the document did not change. This requires the content versioning of the
+REST server (``update-policy`` property), otherwise expired entries are read again.
+
+.. code:: python
+
+   ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', cache=DocumentCache(max_bytes=50 * 2 ** 20, ttl=5))
+   response = ds.document_get(uri='/config/taxonomy.xml')  # Same response as long as the document is unchanged
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import collections
+import threading
+import time
+
+from .config import DOCUMENT_CACHE_MAX_BYTES, DOCUMENT_CACHE_MAX_ENTRIES, DOCUMENT_CACHE_TTL
+
+
+class CacheEntry(object):
+    """A cached response"""
+    __slots__ = ('uri', 'response', 'etag', 'size', 'expires')
+
+    def __init__(self, uri, response, etag, size, expires):
+        self.uri = uri
+        self.response = response
+        self.etag = etag
+        self.size = size
+        self.expires = expires
+
+
+class DocumentCache(object):
+    """LRU cache of single document responses, bounded in number of entries and in bytes of content.
+
+    One instance may be shared by the threads (and the services) that read the same server. Statistics are
+    available in the ``hits`` (served without request), ``revalidated`` (304 responses), ``misses`` (documents
+    read) and ``evictions`` attributes.
+    """
+    def __init__(self, max_entries=DOCUMENT_CACHE_MAX_ENTRIES, max_bytes=DOCUMENT_CACHE_MAX_BYTES,
+                 ttl=DOCUMENT_CACHE_TTL, clock=time.time):
+        """
+        :param max_entries: max number of cached documents
+        :param max_bytes: max total size of the cached contents, larger documents are not cached
+        :param ttl: seconds an entry is used without revalidation, 0 to revalidate each time
+        :param clock: a callable that returns the current time in seconds
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = collections.OrderedDict()  # {key: CacheEntry, ...} least recently used first
+        self._keys_by_uri = collections.defaultdict(set)
+        self._size = 0
+        self._generation = 0  # Incremented by invalidations
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def stats(self):
+        """A dict snapshot of the counters"""
+        return {
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._size
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(params):
+        """Cache key of the request params of a document (database, uri, category, format, transform...)"""
+        return tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                            for name, value in params.iteritems()))
+
+    def get(self, key, uri, fetch):
+        """The response of a document, from the cache or fetched
+
+        :param key: see :meth:`make_key`
+        :param uri: URI of the document
+        :param fetch: a callable that gets the request headers (with ``If-None-Match`` when revalidating) and
+          returns a :class:`requests.Response`
+        :return: a :class:`requests.Response`
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = self._entries.pop(key)  # Most recently used
+                if self.clock() < entry.expires:
+                    self.hits += 1
+                    return entry.response
+            generation = self._generation
+
+        headers = {}
+        if entry is not None and entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
+        response = fetch(headers)
+        if response.status_code == 304 and entry is not None:
+            with self._lock:
+                self.revalidated += 1
+                entry.expires = self.clock() + self.ttl
+            return entry.response
+
+        with self._lock:
+            self.misses += 1
+        if response.status_code == 200:
+            self._store(key, uri, response, generation)
+        return response
+
+    def _store(self, key, uri, response, generation):
+        size = len(response.content)
+        if size > self.max_bytes:
+            return
+        entry = CacheEntry(uri, response, response.headers.get('ETag'), size, self.clock() + self.ttl)
+        with self._lock:
+            if generation != self._generation:
+                # The document may have been written meanwhile
+                return
+            self._remove(key)
+            self._entries[key] = entry
+            self._keys_by_uri[uri].add(key)
+            self._size += size
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._size -= entry.size
+        keys = self._keys_by_uri[entry.uri]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_uri[entry.uri]
+
+    def invalidate(self, uris):
+        """Forgets the documents (all databases and categories)
+
+        :param uris: an URI or a sequence of URIs
+        """
+        if isinstance(uris, basestring):
+            uris = (uris,)
+        with self._lock:
+            self._generation += 1
+            for uri in uris:
+                for key in list(self._keys_by_uri.get(uri, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """Forgets all documents"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys_by_uri.clear()
+            self._size = 0
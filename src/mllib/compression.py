@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+=================
+mllib.compression
+=================
+
+Compression of the request and response bodies
+
+:class:`CompressionHook` compresses the request bodies of ``compress_min_size`` bytes or more (files and iterables
+as they are streamed), and decodes gzip or deflate responses as they are read, multipart responses included, such
+that the bytes on the wire, the bytes of the bodies and the CPU time spent in zlib are known. The CPU time is the
+one of the process (:func:`time.clock`), threads running meanwhile are accounted too.
+
+.. code:: python
+
+   compression = CompressionHook(encoding='gzip')
+   ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', hooks=[compression])
+   for headers, body in ds.document_get(uri=uris).iter_parts():
+       ...
+   print(compression.stats['response']['ratio'])
+
+The MarkLogic REST server compresses its responses when it is configured to. Compressed request bodies need a
+server, or a proxy in front of it, that accepts a ``Content-Encoding``: request compression is off by default.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+import time
+import zlib
+
+import requests
+
+from .config import COMPRESSION_LEVEL, COMPRESSION_MIN_SIZE, STREAM_CHUNK_SIZE
+from .hooks import RequestHook
+from .metrics import REGISTRY
+from .utils import mappable_size
+
+# zlib window bits of the encodings, decoders detect the gzip or zlib header
+ENCODING_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS
+}
+_DECODING_WBITS = 32 + zlib.MAX_WBITS
+
+
+def body_size(data):
+    """Bytes of a request body, None for streams of unknown size"""
+    if isinstance(data, bytes):
+        return len(data)
+    if hasattr(data, '__len__') and hasattr(data, 'read'):
+        # A mllib.utils.MappedFile
+        return len(data) - data.tell()
+    return mappable_size(data)
+
+
+class CompressionCounters(object):
+    """Bytes and CPU seconds of one direction"""
+    def __init__(self, direction):
+        self.direction = direction
+        self.bodies = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, raw_bytes, compressed_bytes, cpu_seconds, body=False):
+        """Accounts a chunk of a body
+
+        :param body: True for the first chunk of a body
+        """
+        with self._lock:
+            self.bodies += body
+            self.raw_bytes += raw_bytes
+            self.compressed_bytes += compressed_bytes
+            self.cpu_seconds += cpu_seconds
+        REGISTRY.inc('mllib_compression_bytes_total', raw_bytes, direction=self.direction, state='raw')
+        REGISTRY.inc('mllib_compression_bytes_total', compressed_bytes, direction=self.direction,
+                     state='compressed')
+        REGISTRY.inc('mllib_compression_cpu_seconds_total', cpu_seconds, direction=self.direction)
+
+    @property
+    def stats(self):
+        """{'bodies': n, 'raw_bytes': n, 'compressed_bytes': n, 'ratio': compressed / raw, 'cpu_seconds': s}"""
+        with self._lock:
+            ratio = float(self.compressed_bytes) / self.raw_bytes if self.raw_bytes else None
+            return {'bodies': self.bodies, 'raw_bytes': self.raw_bytes, 'compressed_bytes': self.compressed_bytes,
+                    'ratio': ratio, 'cpu_seconds': self.cpu_seconds}
+
+
+class DecodingResponse(object):
+    """The urllib3 response of a compressed body for :meth:`requests.Response.iter_content`, which chunks are
+    decoded and accounted as they are read. Other attributes are the ones of the urllib3 response.
+    """
+    def __init__(self, raw, counters):
+        """
+        :param raw: the :class:`urllib3.response.HTTPResponse`
+        :param counters: the :class:`CompressionCounters` of the responses
+        """
+        self._raw = raw
+        self._counters = counters
+        self._decoder = zlib.decompressobj(_DECODING_WBITS)
+        self._first = True
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def stream(self, amt=STREAM_CHUNK_SIZE, decode_content=True):
+        for chunk in self._raw.stream(amt, decode_content=False):
+            data = self._decode(chunk, self._decoder.decompress)
+            if data:
+                yield data
+        data = self._decode(b'', lambda chunk: self._decoder.flush())
+        if data:
+            yield data
+
+    def read(self, amt=None, decode_content=True, **kwargs):
+        chunk = self._raw.read(amt, decode_content=False, **kwargs)
+        if chunk:
+            return self._decode(chunk, self._decoder.decompress)
+        return self._decode(b'', lambda chunk: self._decoder.flush())
+
+    def _decode(self, chunk, decode):
+        started = time.clock()
+        try:
+            data = decode(chunk)
+        except zlib.error as exc:
+            raise requests.exceptions.ContentDecodingError("Failed to decode the response: {0}".format(exc))
+        self._counters.add(len(data), len(chunk), time.clock() - started, body=self._first)
+        self._first = False
+        return data
+
+
+class CompressionHook(RequestHook):
+    """A hook that compresses request bodies and decodes compressed responses with statistics. Put it last in
+    the hooks of the client such that its ``after_receive`` is called before the other hooks read the responses.
+    """
+    def __init__(self, encoding=None, compress_min_size=COMPRESSION_MIN_SIZE, level=COMPRESSION_LEVEL,
+                 accept_encoding='gzip, deflate'):
+        """
+        :param encoding: 'gzip' or 'deflate' to compress request bodies, None to send them as is
+        :param compress_min_size: min bytes of the compressed bodies. Streams of unknown size are compressed.
+        :param level: zlib compression level, 1 (fast) to 9 (small)
+        :param accept_encoding: the encodings of the responses, None to get uncompressed responses
+        """
+        if encoding is not None and encoding not in ENCODING_WBITS:
+            raise ValueError("encoding must be one of {0}, got: {1}".format(sorted(ENCODING_WBITS), encoding))
+        self.encoding = encoding
+        self.compress_min_size = compress_min_size
+        self.level = level
+        self.accept_encoding = accept_encoding
+        self.requests = CompressionCounters('request')
+        self.responses = CompressionCounters('response')
+
+    @property
+    def stats(self):
+        """{'request': {...}, 'response': {...}}, see :attr:`CompressionCounters.stats`"""
+        return {'request': self.requests.stats, 'response': self.responses.stats}
+
+    def before_send(self, context):
+        kwargs = context.kwargs
+        headers = kwargs['headers']
+        headers['Accept-Encoding'] = self.accept_encoding or 'identity'
+        if self.accept_encoding is not None:
+            # Responses are decoded by after_receive
+            context.data['compression_stream'] = kwargs.get('stream', False)
+            kwargs['stream'] = True
+        data = kwargs.get('data')
+        if self.encoding is None or data is None or context.verb not in ('put', 'post', 'patch'):
+            return
+        if isinstance(data, (dict, list, tuple)):
+            # Form fields, encoded like requests does
+            data = requests.models.RequestEncodingMixin._encode_params(data)
+            if not any(name.lower() == 'content-type' for name in headers):
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        size = body_size(data)
+        if size is not None and size < self.compress_min_size:
+            return
+        if isinstance(data, bytes):
+            kwargs['data'] = self.compress(data)
+        elif hasattr(data, 'read') or hasattr(data, '__iter__'):
+            # A digest challenge cannot be answered with a streamed body
+            context.client.prime_authentication()
+            kwargs['data'] = self.iter_compress(data)
+        else:
+            return
+        headers['Content-Encoding'] = self.encoding
+
+    def after_receive(self, context):
+        response = context.response
+        stream = context.data.pop('compression_stream', None)
+        if stream is None:
+            return
+        if response.headers.get('Content-Encoding', '').lower() in ENCODING_WBITS:
+            response.raw = DecodingResponse(response.raw, self.responses)
+        if not stream:
+            response.content
+
+    def compress(self, data):
+        """The compressed bytes of a body"""
+        compressor = self._compressor()
+        started = time.clock()
+        compressed = compressor.compress(data) + compressor.flush()
+        self.requests.add(len(data), len(compressed), time.clock() - started, body=True)
+        return compressed
+
+    def iter_compress(self, data):
+        """Yields the compressed chunks of a file or an iterable of chunks as they are read"""
+        if hasattr(data, 'read'):
+            chunks = iter(lambda: data.read(STREAM_CHUNK_SIZE), b'')
+        else:
+            chunks = iter(data)
+        compressor = self._compressor()
+        first = True
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            started = time.clock()
+            compressed = compressor.compress(chunk)
+            self.requests.add(len(chunk), len(compressed), time.clock() - started, body=first)
+            first = False
+            if compressed:
+                yield compressed
+        started = time.clock()
+        compressed = compressor.flush()
+        self.requests.add(0, len(compressed), time.clock() - started, body=first)
+        yield compressed
+
+    def _compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, ENCODING_WBITS[self.encoding])
@@ -14,4 +14,36 @@ DEFAULT_CHARSET = 'utf-8'
 DEBUG = False  # Do NOT commit/push with "True"
 HAVE_PYTHON3 = sys.version_info[0] == 3
 UNKNOWN_MIMETYPE = 'application/octet-stream'
-STREAM_LINE_MAX_SIZE = 100000  # Max allowed size for each line when reading a multipart/mixed response
+STREAM_CHUNK_SIZE = 65536  # Size of chunks read from files or responses streamed to / from the server
+BULK_BATCH_SIZE = 100  # Default max number of documents written by each bulk request
+HTTP_POOL_CONNECTIONS = 10  # Number of connection pools cached by each client session
+HTTP_POOL_MAXSIZE = 10  # Max connections kept alive per host by each client session
+MEMOIZE_CACHE_SIZE = 4096  # Max number of results kept by each memoized validator or MIME type lookup
+ASYNC_MAX_CONCURRENCY = 10  # Default max number of concurrent requests of the non blocking services
+MULTI_GET_MAX_URIS = 200  # Default max number of documents fetched by each request of DocumentsService.document_get_many
+MAX_URL_LENGTH = 8000  # Max length of the URLs of requests with lots of parameters
+DOCUMENT_CACHE_MAX_ENTRIES = 1000  # Default max number of documents of a mllib.cache.DocumentCache
+DOCUMENT_CACHE_MAX_BYTES = 32 * 2 ** 20  # Default max size of the contents of a mllib.cache.DocumentCache
+DOCUMENT_CACHE_TTL = 0  # Default seconds a cached document is used without revalidation
+TIMING_HISTORY_SIZE = 1000  # Default number of measures kept by mllib.instrumentation.TimingHook
+METRICS_EXPORT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+METRICS_MAX_SHARDS = 64  # Per thread shards of a mllib.metrics.MetricsRegistry before merging the dead ones
+RETRY_MAX_ATTEMPTS = 3  # Default attempts of a request with a mllib.retry.RetryPolicy
+RETRY_BACKOFF = 0.1  # Default seconds before the first retry, doubled for the next ones
+RETRY_MAX_BACKOFF = 5.0  # Default max seconds between two attempts
+LIMITER_INITIAL = 10  # Default initial concurrent requests of a mllib.limiter.AIMDLimit
+LIMITER_MIN = 1  # Default min concurrent requests of a mllib.limiter.AIMDLimit
+LIMITER_MAX = 200  # Default max concurrent requests of a mllib.limiter.AIMDLimit
+BALANCER_MAX_FAILURES = 3  # Default failures in a row that eject a node from a mllib.balancer.Balancer
+BALANCER_EJECTION_TIME = 30.0  # Default seconds a failing node is ejected
+BALANCER_MAX_TRANSACTIONS = 10000  # Max number of transactions pinned to their node by a mllib.balancer.Balancer
+PREPARED_MODULES_DIRECTORY = 'mllib/prepared'  # Where mllib.eval.EvalService.prepare installs its modules, under /ext/
+EVAL_BATCH_SIZE = 1000  # Default max number of variable sets evaluated by each request of EvalService.eval_batch
+TRANSACTION_STATUS_MAX_AGE = 5.0  # Default seconds the status of a mllib.transactions.Transaction is cached
+WRITE_BEHIND_MAX_DOCUMENTS = 1000  # Default pending documents that trigger a flush of a mllib.bulk.WriteBehindBuffer
+WRITE_BEHIND_MAX_BYTES = 16 * 2 ** 20  # Default size of the pending string contents that trigger a flush
+WRITE_BEHIND_INTERVAL = 1.0  # Default max seconds a document waits in a mllib.bulk.WriteBehindBuffer
+MAPPED_UPLOAD_THRESHOLD = 8 * 2 ** 20  # Min size of the files memory mapped by DocumentsService.document_put
+MAPPED_UPLOAD_CHUNK_SIZE = 4 * 2 ** 20  # Bytes handed to the socket at once by a mllib.utils.MappedFile
+COMPRESSION_MIN_SIZE = 4096  # Default min bytes of the request bodies compressed by mllib.compression.CompressionHook
+COMPRESSION_LEVEL = 6  # Default zlib level of the request bodies compressed by mllib.compression.CompressionHook
@@ -10,100 +10,229 @@ http://docs.marklogic.com/REST/client/management
 
 from __future__ import unicode_literals, print_function, absolute_import
 
+import itertools
+import urllib
+
+from .bulk import WriteBehindBuffer
 from .restclient import RESTClient
-from .utils import KwargsSerializer, guess_mimetype, is_sequence, ResponseAdapter
-from .config import UNKNOWN_MIMETYPE
+from .multipart import make_boundary, iter_documents_body, part_filename, rewindable_documents_body
+from .utils import (KwargsSerializer, MappedFile, concurrent_map, guess_mimetype, is_sequence, mappable_size,
+                    ResponseAdapter)
+from .config import (UNKNOWN_MIMETYPE, BULK_BATCH_SIZE, MULTI_GET_MAX_URIS, MAX_URL_LENGTH,
+                     MAPPED_UPLOAD_THRESHOLD)
+
+
+def split_uris(uris, max_count, max_length):
+    """Yields lists of URIs which "uri=..." query parameters are not longer than max_length
+
+    .. code:: pycon
+
+       >>> list(split_uris(['a', 'b', 'c', 'd/e'], 2, 14))
+       [[u'a', u'b'], [u'c'], [u'd/e']]
+
+    :param uris: iterable of URIs
+    :param max_count: max number of URIs per list
+    :param max_length: max length of the URL encoded parameters of a list (a single longer URI is alone)
+    """
+    chunk = []
+    length = 0
+    for uri in uris:
+        size = len(urllib.urlencode({'uri': uri.encode('utf-8')})) + 1  # with the '&'
+        if chunk and (len(chunk) >= max_count or length + size > max_length):
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(uri)
+        length += size
+    if chunk:
+        yield chunk
+
+
+def _recording_uris(documents, uris):
+    """Yields the (uri, content, metadata) documents, appending their URIs to uris"""
+    for document in documents:
+        uris.append(document[0])
+        yield document
 
 
 class DocumentsService(RESTClient):
+    def __init__(self, hostname, port, username, password, authtype='digest', cache=None, **kwargs):
+        """
+        :param cache: a :class:`mllib.cache.DocumentCache` for the single document reads, None for no cache.
+          It is invalidated by the writes of this service.
+        :param kwargs: other arguments of :class:`mllib.restclient.RESTClient`
+        """
+        super(DocumentsService, self).__init__(hostname, port, username, password, authtype, **kwargs)
+        self.cache = cache
+
+    txid_methods = frozenset(['document_put', 'document_get', 'document_get_many', 'document_delete',
+                              'document_patch', 'document_post'])
+
+    # Compiled once for all the requests
+    _document_put_params = KwargsSerializer({
+        'uri': '!',
+        'category': '*',
+        'database': '?',
+        'format': '?',
+        'collection': '*',
+        'quality': '?',
+        'perm': '?',
+        'prop': '?',
+        'extract': '?',
+        'repair': '?',
+        'transform': '?',
+        'trans': '?',
+        'txid': '?',
+        'lang': '?',
+        'forest-name': '?',
+        'temporal-collection': '?',
+        'system-time': '?'
+    })
+
+    _document_get_params = KwargsSerializer({
+        'uri': '+',
+        'database': '?',
+        'category': '*',
+        'format': '?',
+        'transform': '?',
+        'trans': '?',
+        'txid': '?'
+    })
+
+    _document_delete_params = KwargsSerializer({
+        'uri': '+',
+        'category': '*',
+        'database': '?',
+        'txid': '?',
+        'temporal-collection': '?',
+        'system-time': '?'
+    })
+
+    _document_patch_params = KwargsSerializer({
+        'uri': '!',
+        'category': '*',
+        'database': '?',
+        'format': '?',
+        'txid': '?'
+    })
 
-    def document_put(self, file_, **kwargs):
+    _document_post_params = KwargsSerializer({
+        'database': '?',
+        'transform': '?',
+        'trans': '?',
+        'txid': '?',
+        'temporal-collection': '?',
+        'system-time': '?'
+    })
+
+    def document_put(self, file_, progress=None, mapped_threshold=MAPPED_UPLOAD_THRESHOLD, **kwargs):
         """Insert or update document contents and/or metadata, at a caller-supplied document URI.
         http://docs.marklogic.com/REST/PUT/v1/documents
 
-        :param file_: A path to a file or an opened file object in 'rb' mode.
-        :param kwargs: Named arguments from the dict ``requirements`` below
+        Regular files of ``mapped_threshold`` bytes or more are memory mapped and sent by big zero copy chunks with
+        their Content-Length, see :class:`mllib.utils.MappedFile`.
+
+        :param file_: The content as string or an opened file object in 'rb' mode.
+        :param progress: a callable that gets (bytes sent, total bytes) while a mapped file is sent. Files of any
+          size are mapped when provided.
+        :param mapped_threshold: min size of the mapped files, None to never map them
+        :param kwargs: Named arguments from ``_document_put_params`` above
         :return: a :class:`requests.Response` object
         :raise: a :class:`mllib.mlexceptions.MarkLogicServerError` on bad requests
         """
-        requirements = {
-            'uri': '!',
-            'category': '*',
-            'database': '?',
-            'format': '?',
-            'collection': '*',
-            'quality': '?',
-            'perm': '?',
-            'prop': '?',
-            'extract': '?',
-            'repair': '?',
-            'transform': '?',
-            'trans': '?',
-            'txid': '?',
-            'lang': '?',
-            'forest-name': '?',
-            'temporal-collection': '?',
-            'system-time': '?'
-        }
-        tool = KwargsSerializer(requirements)
-        params, ignored = tool.request_params(kwargs)
+        params, ignored = self._document_put_params.request_params(kwargs)
 
         if hasattr(file_, 'name'):
             ct = guess_mimetype(file_.name)
         else:
             ct = UNKNOWN_MIMETYPE
         headers = {'Content-type': ct}
-        response = self.rest_put('/v1/documents', params=params, data=file_, headers=headers)
+        data = file_
+        size = mappable_size(file_)
+        if size and mapped_threshold is not None and (size >= mapped_threshold or progress is not None):
+            data = MappedFile(file_, progress=progress)
+        try:
+            response = self.rest_put('/v1/documents', params=params, data=data, headers=headers)
+        finally:
+            if data is not file_:
+                data.close()
+            self._invalidate(params['uri'])
         return response
 
     def document_get(self, **kwargs):
         """Retrieve document content and/or metadata from the database.
         http://docs.marklogic.com/REST/GET/v1/documents
 
-        :param kwargs: Named arguments from the dict ``requirements`` below
+        :param kwargs: Named arguments from ``_document_get_params`` above
         :return: a :class:`requests.Response` object or a :class:`mllib.utils.ResponseAdapter` when multiple
-          documents are returned
+          documents are returned. Single documents out of a transaction may come from the cache of the service.
         :raise: a :class:`mllib.mlexceptions.MarkLogicServerError` on bad requests
         """
-        requirements = {
-            'uri': '+',
-            'database': '?',
-            'category': '*',
-            'format': '?',
-            'transform': '?',
-            'trans': '?',
-            'txid': '?'
-        }
-        tool = KwargsSerializer(requirements)
-        params, ignored = tool.request_params(kwargs)
+        params, ignored = self._document_get_params.request_params(kwargs)
         category = params.get('category', [])
         if is_sequence(params['uri']) or ({'content', 'metadata'} <= frozenset(category)):
             headers = {'Accept': 'multipart/mixed'}
             response_adapter = ResponseAdapter
+            stream = True  # Parts are read on demand
         else:
             headers = {}
             response_adapter = lambda x: x  # Neutral adapter
-        response = self.rest_get('/v1/documents', params=params, headers=headers)
+            stream = False
+        if self.cache is not None and not stream and 'txid' not in params:
+            # Documents of a transaction are not cached
+            return self.cache.get(self.cache.make_key(params), params['uri'],
+                                  lambda headers: self.rest_get('/v1/documents', params=params, headers=headers))
+        response = self.rest_get('/v1/documents', params=params, headers=headers, stream=stream)
         return response_adapter(response)
 
+    def document_get_many(self, uris, ordered=True, workers=4, max_uris=MULTI_GET_MAX_URIS,
+                          max_url_length=MAX_URL_LENGTH, **kwargs):
+        """Retrieve lots of documents with concurrent multi documents requests. The URIs are split in chunks
+        that keep the URLs short enough, fetched by ``workers`` threads sharing the connections of this service
+        (make its ``pool_maxsize`` not less than ``workers``).
+
+        :param uris: iterable of URIs
+        :param ordered: yields the parts in the order of the URIs if True, as they are received otherwise
+        :param workers: number of concurrent requests
+        :param max_uris: max number of URIs per request
+        :param max_url_length: max length of the URL of a request
+        :param kwargs: other named arguments of :meth:`document_get`
+        :return: iterator of (headers, body) tuples like :meth:`mllib.utils.ResponseAdapter.iter_parts`. Missing
+          documents are skipped by MarkLogic.
+        :raise: a :class:`mllib.mlexceptions.MarkLogicServerError` on bad requests
+        """
+        if 'uri' in kwargs:
+            raise ValueError("URIs must be provided in the uris argument")
+        params, ignored = self._document_get_params.request_params(dict(kwargs, uri=()))
+        other_params = urllib.urlencode([(k, v.encode('utf-8') if isinstance(v, unicode) else v)
+                                         for k, v in params.iteritems() if k != 'uri'], doseq=True)
+        max_length = max_url_length - len(max(self.base_urls, key=len) + '/v1/documents?' + other_params) - 1
+
+        def fetch(chunk):
+            response = self.document_get(uri=chunk, **kwargs)
+            parts = list(response.iter_parts())
+            if ordered:
+                positions = {uri: i for i, uri in enumerate(chunk)}
+                parts.sort(key=lambda part: positions.get(part_filename(part[0]), len(chunk)))
+            return parts
+
+        chunks = split_uris(uris, max_uris, max_length)
+        for parts in concurrent_map(fetch, chunks, workers, ordered=ordered):
+            for part in parts:
+                yield part
+
     def document_delete(self, **kwargs):
         """Remove documents, or reset document metadata.
         http://docs.marklogic.com/REST/DELETE/v1/documents
 
-        :param kwargs: Named arguments from the dict ``requirements`` below
+        :param kwargs: Named arguments from ``_document_delete_params`` above
         :return: a :class:`requests.Response` object
         """
-        requirements = {
-            'uri': '+',
-            'category': '*',
-            'database': '?',
-            'txid': '?',
-            'temporal-collection': '?',
-            'system-time': '?'
-        }
-        tool = KwargsSerializer(requirements)
-        params, ignored = tool.request_params(kwargs)
-        response = self.rest_delete('/v1/documents', params=params)
+        params, ignored = self._document_delete_params.request_params(kwargs)
+        try:
+            response = self.rest_delete('/v1/documents', params=params)
+        finally:
+            self._invalidate(params['uri'])
         return response
 
     def document_patch(self, file_, **kwargs):
@@ -111,18 +240,10 @@ class DocumentsService(RESTClient):
         http://docs.marklogic.com/REST/PATCH/v1/documents
 
         :param file_: The content of the patch, see http://docs.marklogic.com/guide/rest-dev/documents#id_15775
-        :param kwargs: Named arguments from the dict ``requirements`` below
+        :param kwargs: Named arguments from ``_document_patch_params`` above
         :return: a :class:`requests.Response` object
         """
-        requirements = {
-            'uri': '!',
-            'category': '*',
-            'database': '?',
-            'format': '?',
-            'txid': '?'
-        }
-        tool = KwargsSerializer(requirements)
-        params, ignored = tool.request_params(kwargs)
+        params, ignored = self._document_patch_params.request_params(kwargs)
 
         if hasattr(file_, 'name'):
             ct = guess_mimetype(file_.name)
@@ -130,15 +251,69 @@ class DocumentsService(RESTClient):
             ct = UNKNOWN_MIMETYPE
         headers = {'Content-type': ct}
 
-        response = self.rest_patch('/v1/documents', params=params, data=file_, headers=headers)
+        try:
+            response = self.rest_patch('/v1/documents', params=params, data=file_, headers=headers)
+        finally:
+            self._invalidate(params['uri'])
         return response
 
-    def document_post(self, **kwargs):
+    def document_post(self, documents, batch_size=BULK_BATCH_SIZE, **kwargs):
         """Insert or update content and/or metadata for multiple documents in a single request.
         http://docs.marklogic.com/REST/POST/v1/documents
 
-        :param kwargs:
-        :return:
+        The multipart/mixed body of each request is streamed from ``documents`` such that a batch never sits in
+        memory. With a retry policy, the (uri, content, metadata) tuples of a batch are kept and its file contents
+        are rewound before a retry.
+
+        :param documents: iterable of (uri, content, metadata) tuples. ``content`` is a string, a file object
+          opened in 'rb' mode or None (metadata only). ``metadata`` is a mapping, an XML or JSON string or None.
+        :param batch_size: max number of documents written by each request
+        :param kwargs: Named arguments from ``_document_post_params`` above
+        :return: list of :class:`requests.Response` objects, one per batch
+        :raise: a :class:`mllib.mlexceptions.MarkLogicServerError` on bad requests
         """
-        # FIXME: continue Here
-        return
+        params, ignored = self._document_post_params.request_params(kwargs)
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer, got: {0}".format(batch_size))
+
+        self.prime_authentication()
+        documents = iter(documents)
+        responses = []
+        while True:
+            batch = itertools.islice(documents, batch_size)
+            try:
+                first = next(batch)
+            except StopIteration:
+                break
+            boundary = make_boundary()
+            headers = {
+                'Content-Type': 'multipart/mixed; boundary={0}'.format(boundary.decode('ascii')),
+                'Accept': 'application/json'
+            }
+            batch = itertools.chain((first,), batch)
+            if self.retry_policy is None:
+                written = []
+                body = iter_documents_body(_recording_uris(batch, written), boundary)
+            else:
+                # Kept to be sent again
+                batch = list(batch)
+                written = [document[0] for document in batch]
+                body = rewindable_documents_body(batch, boundary)
+            try:
+                responses.append(self.rest_post('/v1/documents', params=params, data=body, headers=headers))
+            finally:
+                self._invalidate(written)
+        return responses
+
+    def write_behind(self, **kwargs):
+        """A buffer of writes sent later by bulk requests of this service, only the latest write of a URI is sent
+
+        :param kwargs: named arguments of :class:`mllib.bulk.WriteBehindBuffer`
+        :return: a :class:`mllib.bulk.WriteBehindBuffer`, to be closed to write its last documents
+        """
+        return WriteBehindBuffer(self, **kwargs)
+
+    def _invalidate(self, uris):
+        """Removes written documents from the cache"""
+        if self.cache is not None:
+            self.cache.invalidate(uris)
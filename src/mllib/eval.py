@@ -5,30 +5,332 @@ mllib.eval
 ==========
 
 http://docs.marklogic.com/REST/POST/v1/eval
+
+Each item of the result sequence is a part of the multipart/mixed response, typed by its ``X-Primitive`` header.
+:meth:`EvalService.eval_items` yields them as Python values, one at a time, such that huge sequences are consumed
+in constant memory:
+
+.. code:: python
+
+   es = EvalService.from_envvar('MLLIB_TEST_SERVER')
+   for uri in es.eval_items(xquery='cts:uris()'):
+       print(uri)
+
+Scripts that are evaluated again and again may be prepared: they are installed once as modules of the REST server
+(the user needs the ``rest-admin`` role), then invoked with their variables only, which saves the upload of their
+source and their compilation by the server:
+
+.. code:: python
+
+   for value1, value2 in pairs:
+       response = es.eval_prepared(xquery=ADDITION_XQY, vars={'value1': value1, 'value2': value2})
+
+Many small evaluations of a script are better sent in batches, the items of each set of variables (or its error)
+are split from the result of the batch:
+
+.. code:: python
+
+   vars_list = [{'value1': value1, 'value2': value2} for value1, value2 in pairs]
+   for result in es.eval_batch(vars_list, xquery=ADDITION_XQY):
+       if isinstance(result, MarkLogicEvalError):
+           print(result.index, result.mlcode)
+       else:
+           print(result[0])
 """
 
 from __future__ import unicode_literals, print_function, absolute_import
 
+import decimal
+import hashlib
+import itertools
 import json
+import uuid
 
+from .config import DEFAULT_CHARSET, EVAL_BATCH_SIZE, PREPARED_MODULES_DIRECTORY
+from .mlexceptions import MarkLogicEvalError, MarkLogicServerError
 from .restclient import RESTClient
-from .utils import KwargsSerializer, ResponseAdapter, dict_pop
+from .utils import KwargsSerializer, ResponseAdapter, dict_pop, parse_mimetype
+
+INTEGER_PRIMITIVES = frozenset((
+    'integer', 'int', 'long', 'short', 'byte', 'nonNegativeInteger', 'nonPositiveInteger', 'negativeInteger',
+    'positiveInteger', 'unsignedLong', 'unsignedInt', 'unsignedShort', 'unsignedByte'
+))
+FLOAT_PRIMITIVES = frozenset(('double', 'float'))
+JSON_PRIMITIVES = frozenset((
+    'map', 'array', 'object-node()', 'array-node()', 'number-node()', 'boolean-node()', 'null-node()'
+))
+_special_floats = {'INF': 'inf', '-INF': '-inf', 'NaN': 'nan'}
+# {language: (module extension, content type), ...}
+MODULE_TYPES = {
+    'xquery': ('xqy', 'application/xquery'),
+    'javascript': ('sjs', 'application/vnd.marklogic-javascript')
+}
+
+# Evaluates a script once per set of variables. The items of each set follow a marker map, an error is reported by a
+# second marker map with the MarkLogic error code and message. Variables are cast from strings as with /v1/eval.
+# The scripts run in the transaction of the request with the 'same-statement' isolation, each one in its own
+# transaction with 'different-transaction'.
+BATCH_WRAPPER_XQY = """xquery version "1.0-ml";
+declare namespace error = "http://marklogic.com/xdmp/error";
+
+declare variable $script as xs:string external;
+declare variable $language as xs:string external;
+declare variable $inputs as xs:string external;
+declare variable $marker as xs:string external;
+declare variable $isolation as xs:string external;
+
+declare function local:bindings($vars as map:map) as map:map {
+  map:new(
+    for $name in map:keys($vars)
+    return map:entry($name, xs:untypedAtomic(fn:string(map:get($vars, $name))))
+  )
+};
+
+for $vars at $index in json:array-values(xdmp:from-json-string($inputs))
+return (
+  map:entry($marker, $index - 1),
+  try {
+    let $options := <options xmlns="xdmp:eval"><isolation>{$isolation}</isolation></options>
+    return
+      if ($language eq "javascript")
+      then xdmp:javascript-eval($script, local:bindings($vars), $options)
+      else xdmp:eval($script, local:bindings($vars), $options)
+  } catch ($error) {
+    map:new((
+      map:entry($marker, $index - 1),
+      map:entry("code", fn:string(($error/error:code, $error/error:name)[1])),
+      map:entry("message", fn:string(($error/error:format-string, $error/error:message)[1]))
+    ))
+  }
+)
+"""
+
+
+def decode_item(headers, body):
+    """The Python value of an item of an eval result
+
+    - integers as int, decimals as :class:`decimal.Decimal`, doubles and floats as float, booleans as bool
+    - JSON nodes, maps and arrays (and any ``application/json`` part) as decoded JSON
+    - other text items (strings, dates, XML nodes...) as unicode
+    - binary nodes as bytes
+
+    .. code:: pycon
+
+       >>> decode_item({'X-Primitive': 'integer'}, b'42')
+       42
+       >>> decode_item({'X-Primitive': 'boolean'}, b'false')
+       False
+       >>> decode_item({'Content-Type': 'application/json', 'X-Primitive': 'map'}, b'{"a": [1]}')
+       {u'a': [1]}
+
+    :param headers: headers of the part
+    :param body: bytes of the part
+    """
+    primitive = headers.get('X-Primitive', '')
+    if primitive in INTEGER_PRIMITIVES:
+        return int(body)
+    if primitive in FLOAT_PRIMITIVES:
+        return float(_special_floats.get(body, body))
+    if primitive == 'decimal':
+        return decimal.Decimal(body.decode('ascii'))
+    if primitive == 'boolean':
+        return body == b'true'
+    maintype, subtype, suffix, options = parse_mimetype(headers.get('Content-Type'))
+    charset = options.get('charset', DEFAULT_CHARSET)
+    if primitive in JSON_PRIMITIVES or subtype == 'json' or suffix == 'json':
+        return json.loads(body.decode(charset))
+    if primitive == 'binary()' or (maintype, subtype) == ('application', 'octet-stream'):
+        return body
+    return body.decode(charset)
+
+
+def iter_items(response):
+    """Yields the decoded items of an eval response, see :func:`decode_item`. The response is closed when the
+    iteration ends, even if abandoned.
+
+    :param response: a :class:`mllib.utils.ResponseAdapter` over a streamed response
+    """
+    try:
+        for headers, body in response.iter_parts():
+            yield decode_item(headers, body)
+    finally:
+        response.close()
+
+
+def prepared_module_path(language, source):
+    """The path of the module of a prepared script, named after the hash of its source
+
+    .. code:: pycon
+
+       >>> prepared_module_path('xquery', '1 + 1')
+       u'/ext/mllib/prepared/3ea48e58952a26efd359a5762ef088ce3605501e.xqy'
+    """
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    digest = hashlib.sha1(language.encode('ascii') + b'\0' + source).hexdigest()
+    return '/ext/{0}/{1}.{2}'.format(PREPARED_MODULES_DIRECTORY, digest, MODULE_TYPES[language][0])
+
+
+def split_batch_items(items, marker, offset=0):
+    """Yields the results of each set of variables from the items of a batch, see :data:`BATCH_WRAPPER_XQY`
+
+    .. code:: pycon
+
+       >>> items = [{'M': 0}, 1, 2, {'M': 1}, {'M': 1, 'code': 'XDMP-AS', 'message': 'Bad type'}, {'M': 2}]
+       >>> list(split_batch_items(items, 'M', 10))
+       [[1, 2], MarkLogicEvalError(11, u'XDMP-AS', u'Bad type'), []]
+
+    :param items: the decoded items of the batch
+    :param marker: the key of the marker maps
+    :param offset: index of the first set of variables of the batch
+    :return: the list of the items of each set of variables, or its :class:`mllib.mlexceptions.MarkLogicEvalError`
+    """
+    result = None
+    for item in items:
+        if isinstance(item, dict) and marker in item:
+            if 'code' in item:
+                result = MarkLogicEvalError(offset + item[marker], item['code'], item.get('message', ''))
+                continue
+            if result is not None:
+                yield result
+            result = []
+        elif isinstance(result, list):
+            result.append(item)
+    if result is not None:
+        yield result
 
 
 class EvalService(RESTClient):
+    # Compiled once for all the requests
+    _eval_post_params = KwargsSerializer({
+        'xquery': '?',
+        'javascript': '?',
+        'vars': '?',
+        'database': '?',
+        'txid': '?'
+    })
+    _invoke_post_params = KwargsSerializer({
+        'module': '!',
+        'vars': '?',
+        'database': '?',
+        'txid': '?'
+    })
+
+    def __init__(self, hostname, port, username, password, authtype='digest', **kwargs):
+        """
+        See :class:`mllib.restclient.RESTClient` for the arguments
+        """
+        super(EvalService, self).__init__(hostname, port, username, password, authtype, **kwargs)
+        self.prepared_modules = set()  # Paths of the modules installed by this client
+
+    txid_methods = frozenset(['eval_post', 'invoke_post', 'eval_prepared', 'eval_batch', 'eval_items'])
+
     def eval_post(self, **kwargs):
-        requirements = {
-            'xquery': '?',
-            'javascript': '?',
-            'vars': '?',
-            'database': '?',
-            'txid': '?'
-        }
-        tool = KwargsSerializer(requirements)
-        params, ignored = tool.request_params(kwargs)
+        params, ignored = self._eval_post_params.request_params(kwargs)
         headers = {'Accept': 'multipart/mixed', 'Content-type': 'application/x-www-form-urlencoded'}
         data = dict_pop(params, 'xquery', 'javascript', 'vars', 'database')
         if 'vars' in data:
             data['vars'] = json.dumps(dict(data['vars']))
         response = self.rest_post('/v1/eval', params=params, data=data, headers=headers, stream=True)
         return ResponseAdapter(response)
+
+    def invoke_post(self, **kwargs):
+        """Evaluates a module of the modules database of the REST server
+        http://docs.marklogic.com/REST/POST/v1/invoke
+
+        :param kwargs: ``module`` (path of the module) and like :meth:`eval_post`: ``vars``, ``database``, ``txid``
+        :return: a :class:`mllib.utils.ResponseAdapter`
+        """
+        params, ignored = self._invoke_post_params.request_params(kwargs)
+        headers = {'Accept': 'multipart/mixed', 'Content-type': 'application/x-www-form-urlencoded'}
+        data = dict_pop(params, 'module', 'vars', 'database')
+        if 'vars' in data:
+            data['vars'] = json.dumps(dict(data['vars']))
+        response = self.rest_post('/v1/invoke', params=params, data=data, headers=headers, stream=True)
+        return ResponseAdapter(response)
+
+    def prepare(self, xquery=None, javascript=None):
+        """Installs a script as a module of the REST server, once per client
+
+        :param xquery: source of an XQuery main module
+        :param javascript: or source of a server side JavaScript module
+        :return: the path of the module, for :meth:`invoke_post`
+        """
+        if (xquery is None) == (javascript is None):
+            raise ValueError("One of xquery or javascript keyword arguments must be provided")
+        language, source = ('xquery', xquery) if xquery is not None else ('javascript', javascript)
+        module = prepared_module_path(language, source)
+        if module not in self.prepared_modules:
+            # Installing the same module concurrently is harmless
+            headers = {'Content-Type': MODULE_TYPES[language][1]}
+            self.rest_put('/v1' + module, data=source, headers=headers)
+            self.prepared_modules.add(module)
+        return module
+
+    def eval_prepared(self, xquery=None, javascript=None, **kwargs):
+        """Like :meth:`eval_post` with a script prepared by :meth:`prepare`. The module is installed again when
+        it is missing from the server (modules database cleared...).
+
+        :return: a :class:`mllib.utils.ResponseAdapter`
+        """
+        module = self.prepare(xquery, javascript)
+        try:
+            return self.invoke_post(module=module, **kwargs)
+        except MarkLogicServerError as exc:
+            if exc.mlcode != 'XDMP-MODNOTFOUND':
+                raise
+        self.prepared_modules.discard(module)
+        return self.invoke_post(module=self.prepare(xquery, javascript), **kwargs)
+
+    def eval_batch(self, vars_list, xquery=None, javascript=None, batch_size=EVAL_BATCH_SIZE, prepared=False,
+                   **kwargs):
+        """Evaluates a script once per set of variables, with one request per batch of sets. Requests are sent as
+        the results are consumed.
+
+        :param vars_list: iterable of the sets of variables as mappings, like the ``vars`` of :meth:`eval_post`
+        :param xquery: source of an XQuery main module
+        :param javascript: or source of a server side JavaScript module
+        :param batch_size: max number of sets of variables evaluated by each request
+        :param prepared: True to install the batch wrapper as a module, see :meth:`eval_prepared`
+        :param kwargs: other named arguments of :meth:`eval_post` (``database``, ``txid``). With a ``txid``, the
+          updates of the script are part of the transaction, otherwise each set of variables is committed apart.
+        :return: an iterator of the result of each set of variables, in order: the list of its items (see
+          :func:`decode_item`), or a :class:`mllib.mlexceptions.MarkLogicEvalError`
+        :raise: a :class:`mllib.mlexceptions.MarkLogicServerError` when a batch fails as a whole
+        """
+        if (xquery is None) == (javascript is None):
+            raise ValueError("One of xquery or javascript keyword arguments must be provided")
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer, got: {0}".format(batch_size))
+        language, script = ('xquery', xquery) if xquery is not None else ('javascript', javascript)
+        if isinstance(script, bytes):
+            script = script.decode('utf-8')
+        evaluate = self.eval_prepared if prepared else self.eval_post
+        return self._iter_batches(iter(vars_list), language, script, batch_size, evaluate, kwargs)
+
+    def _iter_batches(self, vars_list, language, script, batch_size, evaluate, kwargs):
+        # Updates of a batch in a multi-statement transaction belong to it
+        isolation = 'same-statement' if kwargs.get('txid') is not None else 'different-transaction'
+        offset = 0
+        while True:
+            batch = [dict(vars_) for vars_ in itertools.islice(vars_list, batch_size)]
+            if not batch:
+                return
+            marker = uuid.uuid4().hex
+            wrapper_vars = {'script': script, 'language': language, 'inputs': json.dumps(batch), 'marker': marker,
+                            'isolation': isolation}
+            response = evaluate(xquery=BATCH_WRAPPER_XQY, vars=wrapper_vars, **kwargs)
+            for result in split_batch_items(iter_items(response), marker, offset):
+                yield result
+            offset += len(batch)
+
+    def eval_items(self, prepared=False, **kwargs):
+        """Like :meth:`eval_post`, yielding the items of the result as Python values, see :func:`decode_item`
+
+        :param prepared: True to run the script as a prepared module, see :meth:`eval_prepared`
+        :param kwargs: named arguments of :meth:`eval_post`
+        :return: an iterator of the items
+        """
+        if prepared:
+            return iter_items(self.eval_prepared(**kwargs))
+        return iter_items(self.eval_post(**kwargs))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+===========
+mllib.hooks
+===========
+
+Middleware hooks around the requests of :meth:`mllib.restclient.RESTClient.rest_do`
+
+.. code:: python
+
+   class Tracer(RequestHook):
+       def before_send(self, context):
+           context.kwargs['headers']['X-Trace-Id'] = new_trace_id()
+
+   ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', hooks=[Tracer(), TimingHook()])
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import re
+
+_id_segment_rx = re.compile(r'/\d+(?=/|$)')
+
+
+def normalize_path(service_path):
+    """The service path with its numeric segments (transaction ids...) replaced, suitable to tag measures
+
+    .. code:: pycon
+
+       >>> normalize_path('/v1/transactions/8327449276395217/')
+       u'/v1/transactions/{id}/'
+    """
+    return _id_segment_rx.sub('/{id}', service_path)
+
+
+class RequestContext(object):
+    """A request passed through the hooks"""
+    def __init__(self, client, verb, service_path, url, args, kwargs):
+        """
+        :param client: the :class:`mllib.restclient.RESTClient` that sends the request
+        :param verb: 'get', 'post', ...
+        :param service_path: path of the REST service like '/v1/documents'
+        :param url: full URL of the request
+        :param args: positional arguments of the :class:`requests.Session` method
+        :param kwargs: named arguments of the :class:`requests.Session` method (params, headers, data...)
+        """
+        self.client = client
+        self.verb = verb
+        self.service_path = service_path
+        self.url = url
+        self.args = args
+        self.kwargs = kwargs
+        self.response = None  # The requests.Response when received
+        self.error = None  # The exception raised by the request, if any
+        self.started = None  # Timer values around the session call
+        self.finished = None
+        self.data = {}  # Free for the hooks
+
+    @property
+    def path_tag(self):
+        """The service path as a tag, see :func:`normalize_path`"""
+        return normalize_path(self.service_path)
+
+    @property
+    def base_url(self):
+        """Base URL of the host of the request, which may be one of the hosts of a cluster"""
+        if self.url.endswith(self.service_path):
+            return self.url[:len(self.url) - len(self.service_path)]
+        return self.client.base_url
+
+    @property
+    def status_code(self):
+        if self.response is not None:
+            return self.response.status_code
+        return getattr(self.error, 'http_code', None)
+
+
+class RequestHook(object):
+    """Base class of the hooks of a client. ``before_send`` hooks are called in order, ``after_receive`` and
+    ``on_error`` hooks in reverse order. Exceptions raised by the hooks go to the caller.
+    """
+    def before_send(self, context):
+        """Called before sending the request, may change ``context.url`` or ``context.kwargs``
+
+        :param context: a :class:`RequestContext`
+        """
+
+    def after_receive(self, context):
+        """Called when a response is received, even with an error status code
+
+        :param context: a :class:`RequestContext` with its ``response``
+        """
+
+    def on_error(self, context):
+        """Called when the request fails (no response or error status code), or when a ``before_send`` hook
+        raised an exception (``context.started`` is None). The error is raised after the hooks.
+
+        :param context: a :class:`RequestContext` with its ``error``
+        """
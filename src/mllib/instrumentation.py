@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+=====================
+mllib.instrumentation
+=====================
+
+Latency and volume measures of the requests sent by a :class:`mllib.restclient.RESTClient`
+
+.. code:: python
+
+   timing = TimingHook()
+   ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', hooks=[timing])
+   ...
+   for (verb, path), stats in sorted(timing.summary().items()):
+       print(verb, path, stats['count'], stats['mean'])
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import collections
+import socket
+import threading
+import timeit
+
+import requests.adapters
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from . import LOG
+from .config import TIMING_HISTORY_SIZE
+from .hooks import RequestHook
+from .utils import is_string
+
+timer = timeit.default_timer
+
+# DNS and connect times of the connections opened by the current request of each thread
+_connection_times = threading.local()
+
+
+def reset_connection_times():
+    _connection_times.dns = 0.0
+    _connection_times.connect = 0.0
+
+
+def get_connection_times():
+    """(dns, connect) seconds spent opening connections since :func:`reset_connection_times`, zeros when a
+    kept alive connection was reused
+    """
+    return getattr(_connection_times, 'dns', 0.0), getattr(_connection_times, 'connect', 0.0)
+
+
+class _TimedConnectionMixin(object):
+    """Measures the name resolution and the connection separately"""
+    def _new_conn(self):
+        # urllib3 connects to its private _dns_host since 1.21, to the host before
+        host_attr = '_dns_host' if hasattr(self, '_dns_host') else 'host'
+        host = getattr(self, host_attr)
+        started = timer()
+        try:
+            addresses = socket.getaddrinfo(host.strip('[]'), self.port, 0, socket.SOCK_STREAM)
+        except socket.error as exc:
+            raise NewConnectionError(self, "Failed to establish a new connection: {0}".format(exc))
+        resolved = timer()
+        error = NewConnectionError(self, "Failed to establish a new connection: no address for {0}".format(host))
+        try:
+            # Connecting to the resolved addresses, the first that accepts wins
+            for address in addresses:
+                setattr(self, host_attr, address[4][0])
+                try:
+                    conn = super(_TimedConnectionMixin, self)._new_conn()
+                    break
+                except Exception as exc:
+                    error = exc
+            else:
+                raise error
+        finally:
+            setattr(self, host_attr, host)
+        _connection_times.dns = getattr(_connection_times, 'dns', 0.0) + resolved - started
+        _connection_times.connect = getattr(_connection_times, 'connect', 0.0) + timer() - resolved
+        return conn
+
+
+class TimedHTTPConnection(_TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """An adapter which connections measure their DNS and connect times, see :func:`get_connection_times`"""
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+
+class RequestTiming(object):
+    """Measures of a request, times in seconds"""
+    __slots__ = ('verb', 'path', 'status_code', 'dns', 'connect', 'ttfb', 'total', 'bytes_sent', 'bytes_received',
+                 'error')
+
+    def __init__(self, verb, path, status_code, dns, connect, ttfb, total, bytes_sent, bytes_received, error):
+        """
+        :param verb: 'get', 'post'...
+        :param path: the normalized service path, see :func:`mllib.hooks.normalize_path`
+        :param status_code: the HTTP status or None without response
+        :param dns: name resolution time, 0 when a connection is reused
+        :param connect: TCP (and TLS) connection time, 0 when a connection is reused
+        :param ttfb: time to the response headers, connection and request body included, None without response
+        :param total: time of the request, without the reading of a streamed response body
+        :param bytes_sent: size of the request body
+        :param bytes_received: size of the response body, None for a streamed body of unknown length
+        :param error: the exception raised by the request or None
+        """
+        self.verb = verb
+        self.path = path
+        self.status_code = status_code
+        self.dns = dns
+        self.connect = connect
+        self.ttfb = ttfb
+        self.total = total
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.error = error
+
+    def __repr__(self):
+        return '<RequestTiming {0} {1} {2}: {3:.1f}ms>'.format(self.verb.upper(), self.path, self.status_code,
+                                                              self.total * 1000)
+
+
+class _ByteCounter(object):
+    """Counts the bytes of a streamed body while it is sent"""
+    def __init__(self, body):
+        self.body = body
+        self.count = 0
+
+    @property
+    def replayable(self):
+        return getattr(self.body, 'replayable', False)
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.count += len(chunk)
+            yield chunk
+
+
+def _body_size(body):
+    if body is None:
+        return 0
+    if is_string(body):
+        return len(body)
+    return None
+
+
+class TimingHook(RequestHook):
+    """Measures each request as a :class:`RequestTiming`, keeps the last ones in ``timings`` and a summary per
+    (verb, path) of all of them. A hook instance may be shared by several clients and threads.
+    """
+    def __init__(self, callback=None, history_size=TIMING_HISTORY_SIZE):
+        """
+        :param callback: a callable that gets the :class:`RequestTiming` of each request
+        :param history_size: number of timings kept in ``timings``
+        """
+        self.callback = callback
+        self.timings = collections.deque(maxlen=history_size)
+        self._summary = {}
+        self._lock = threading.Lock()
+
+    def before_send(self, context):
+        data = context.kwargs.get('data')
+        if (not hasattr(data, 'read') and (hasattr(data, 'next') or hasattr(data, '__next__'))
+                or getattr(data, 'replayable', False) and not isinstance(data, _ByteCounter)):
+            # Iterators (generators...) are sent chunked
+            data = context.kwargs['data'] = _ByteCounter(data)
+        context.data['timing_body'] = data
+        reset_connection_times()
+
+    def after_receive(self, context):
+        if context.response.ok:
+            self.record(self.make_timing(context))
+
+    def on_error(self, context):
+        if context.started is not None:
+            self.record(self.make_timing(context))
+
+    def make_timing(self, context):
+        """The :class:`RequestTiming` of a finished request"""
+        response = context.response
+        dns, connect = get_connection_times()
+        bytes_sent = bytes_received = ttfb = None
+        body = context.data.get('timing_body')
+        if isinstance(body, _ByteCounter):
+            bytes_sent = body.count
+        elif response is not None:
+            bytes_sent = _body_size(response.request.body)
+            if bytes_sent is None:
+                bytes_sent = int(response.request.headers.get('Content-Length', 0))
+        if response is not None:
+            ttfb = response.elapsed.total_seconds()
+            if response._content_consumed:
+                bytes_received = len(response.content or b'')
+            elif 'Content-Length' in response.headers:
+                bytes_received = int(response.headers['Content-Length'])
+        finished = context.finished if context.finished is not None else timer()
+        return RequestTiming(context.verb, context.path_tag, context.status_code, dns, connect, ttfb,
+                             finished - context.started, bytes_sent, bytes_received, context.error)
+
+    def record(self, timing):
+        """Stores a timing and passes it to the callback"""
+        key = (timing.verb, timing.path)
+        with self._lock:
+            self.timings.append(timing)
+            stats = self._summary.get(key)
+            if stats is None:
+                stats = self._summary[key] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+                                              'bytes_sent': 0, 'bytes_received': 0, 'status_codes': {}}
+            stats['count'] += 1
+            stats['errors'] += timing.error is not None
+            stats['total'] += timing.total
+            stats['max'] = max(stats['max'], timing.total)
+            stats['bytes_sent'] += timing.bytes_sent or 0
+            stats['bytes_received'] += timing.bytes_received or 0
+            codes = stats['status_codes']
+            codes[timing.status_code] = codes.get(timing.status_code, 0) + 1
+        if self.callback is not None:
+            try:
+                self.callback(timing)
+            except Exception:
+                LOG.exception("Timing callback %r failed", self.callback)
+
+    def summary(self):
+        """A snapshot of the measures per (verb, path): count, errors, total and max seconds, mean seconds,
+        bytes sent and received, count per status code
+        """
+        with self._lock:
+            result = {}
+            for key, stats in self._summary.iteritems():
+                stats = dict(stats, status_codes=dict(stats['status_codes']))
+                stats['mean'] = stats['total'] / stats['count']
+                result[key] = stats
+            return result
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self._summary.clear()
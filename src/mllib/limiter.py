@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+=============
+mllib.limiter
+=============
+
+Adaptive limit of the concurrent requests sent to a MarkLogic server
+
+The limit grows while the requests are fast and successful, and shrinks as soon as the server shows saturation
+signs (503 or 429 status, connection errors, latency well above its usual level): additive increase,
+multiplicative decrease (AIMD). The usual latency slowly follows the slow requests too, such that a lasting
+latency change does not keep the limit at its minimum. Threads wait for a free slot before sending their requests.
+
+.. code:: python
+
+   limiter = ConcurrencyLimiter(scope='endpoint', max_limit=64)
+   ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', hooks=[limiter], pool_maxsize=64)
+   loader = BulkLoader(ds, workers=64)  # The limiter finds how many of them may write at once
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+import time
+
+import requests
+
+from .config import LIMITER_INITIAL, LIMITER_MAX, LIMITER_MIN
+from .hooks import RequestHook
+
+SATURATION_CODES = frozenset((429, 503))
+
+
+class LimiterTimeout(Exception):
+    """No request slot got in time"""
+
+
+class AIMDLimit(object):
+    """An adaptive number of concurrent requests"""
+    def __init__(self, initial=LIMITER_INITIAL, min_limit=LIMITER_MIN, max_limit=LIMITER_MAX, backoff_ratio=0.9,
+                 latency_tolerance=2.0, smoothing=0.05, drift=0.005):
+        """
+        :param initial: limit at start
+        :param min_limit: the limit never goes below
+        :param max_limit: the limit never goes above
+        :param backoff_ratio: factor applied to the limit on saturation
+        :param latency_tolerance: a request slower than this factor times the usual latency is a saturation sign
+        :param smoothing: weight of each latency sample in the usual latency (exponential moving average)
+        :param drift: weight of the too slow latency samples in the usual latency, such that it follows a lasting
+          latency change (bigger documents, busier cluster) and the limit recovers
+        """
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.drift = drift
+        self.baseline = None  # Usual latency
+        self.inflight = 0
+        self.decreases = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        """Waits for a request slot
+
+        :param timeout: max seconds to wait, None to wait for ever
+        :raise: :class:`LimiterTimeout`
+        """
+        with self._cond:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while self.inflight >= self.limit:
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise LimiterTimeout("No request slot within {0} seconds (limit {1})".format(
+                            timeout, self.limit))
+                    self._cond.wait(remaining)
+            self.inflight += 1
+
+    def release(self, latency=None, saturated=False):
+        """Frees a request slot and adjusts the limit
+
+        :param latency: seconds of the request, None when unknown
+        :param saturated: True when the request showed a saturation of the server
+        """
+        with self._cond:
+            inflight = self.inflight
+            self.inflight -= 1
+            if latency is not None and not saturated:
+                if self.baseline is None:
+                    self.baseline = latency
+                elif latency > self.baseline * self.latency_tolerance:
+                    saturated = True
+                    self.baseline += self.drift * (latency - self.baseline)
+                else:
+                    self.baseline += self.smoothing * (latency - self.baseline)
+            if saturated:
+                self.limit = max(self.min_limit, int(self.limit * self.backoff_ratio))
+                self.decreases += 1
+            elif inflight * 2 >= self.limit and self.limit < self.max_limit:
+                # Only a well used limit is increased
+                self.limit += 1
+            self._cond.notify_all()
+
+
+class ConcurrencyLimiter(RequestHook):
+    """A hook that limits the concurrent requests of the clients that share it. There is one :class:`AIMDLimit`
+    per host (``scope='host'``) or per host, verb and service path (``scope='endpoint'``).
+    """
+    def __init__(self, scope='host', timeout=None, **limit_options):
+        """
+        :param scope: 'host' or 'endpoint'
+        :param timeout: max seconds waiting for a request slot, None to wait for ever
+        :param limit_options: options of the :class:`AIMDLimit` objects
+        """
+        if scope not in ('host', 'endpoint'):
+            raise ValueError("scope must be 'host' or 'endpoint', got: {0}".format(scope))
+        self.scope = scope
+        self.timeout = timeout
+        self.limit_options = limit_options
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def key(self, context):
+        if self.scope == 'host':
+            return context.base_url
+        return context.base_url, context.verb, context.path_tag
+
+    def get_limit(self, key):
+        """The :class:`AIMDLimit` of a key"""
+        limit = self._limits.get(key)
+        if limit is None:
+            with self._lock:
+                limit = self._limits.get(key)
+                if limit is None:
+                    limit = self._limits[key] = AIMDLimit(**self.limit_options)
+        return limit
+
+    @property
+    def stats(self):
+        """{key: {'limit': n, 'inflight': n, 'decreases': n}, ...}"""
+        return {key: {'limit': limit.limit, 'inflight': limit.inflight, 'decreases': limit.decreases}
+                for key, limit in self._limits.items()}
+
+    def before_send(self, context):
+        limit = self.get_limit(self.key(context))
+        limit.acquire(self.timeout)
+        context.data['limit'] = limit
+
+    def after_receive(self, context):
+        limit = context.data.pop('limit', None)
+        if limit is not None:
+            saturated = context.response.status_code in SATURATION_CODES
+            limit.release(context.finished - context.started, saturated)
+
+    def on_error(self, context):
+        limit = context.data.pop('limit', None)
+        if limit is not None:
+            # Released before the request was sent (failed hook), or on connection errors
+            saturated = isinstance(context.error, (requests.ConnectionError, requests.Timeout))
+            limit.release(None, saturated)
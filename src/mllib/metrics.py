@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+=============
+mllib.metrics
+=============
+
+In process counters and latency histograms, exported as a dict snapshot or in the Prometheus text format.
+
+Each thread records in its own shard of the registry, without lock. The shards are merged when the
+metrics are read.
+
+.. code:: python
+
+   ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', hooks=[MetricsHook()])
+   ...
+   print(REGISTRY.to_prometheus())
+
+Metrics of mllib:
+
+- ``mllib_requests_total{verb, path, status}``: requests sent to the REST server
+- ``mllib_request_duration_seconds{verb, path}``: histogram of the request times
+- ``mllib_request_ttfb_seconds{verb, path}``: histogram of the times to the response headers
+- ``mllib_request_sent_bytes_total{verb, path}`` and ``mllib_request_received_bytes_total{verb, path}``
+- ``mllib_errors_total{verb, path, mlcode}``: failed requests, by MarkLogic error code or exception class
+- ``mllib_multipart_parts_total``: parts of multipart/mixed responses parsed
+- ``mllib_retries_total{kind}``: requests sent again
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+
+from .config import METRICS_EXPORT_BUCKETS, METRICS_MAX_SHARDS
+from .instrumentation import TimingHook
+
+_SUB_BITS = 5  # Sub buckets per power of 2 of the histograms: 2 ** (_SUB_BITS - 1), relative error < 1/16
+_SUB_COUNT = 1 << _SUB_BITS
+_HALF_SUB_COUNT = _SUB_COUNT >> 1
+_RESOLUTION = 1e6  # Histograms count microseconds
+
+DESCRIPTIONS = {
+    'mllib_requests_total': "Requests sent to the REST server",
+    'mllib_request_duration_seconds': "Time of the requests",
+    'mllib_request_ttfb_seconds': "Time to the response headers",
+    'mllib_request_sent_bytes_total': "Bytes of the request bodies",
+    'mllib_request_received_bytes_total': "Bytes of the response bodies",
+    'mllib_errors_total': "Failed requests by MarkLogic error code or exception class",
+    'mllib_multipart_parts_total': "Parts of multipart/mixed responses parsed",
+    'mllib_retries_total': "Requests sent again"
+}
+
+
+def bucket_index(value):
+    """Index of the log-linear bucket of a positive integer
+
+    .. code:: pycon
+
+       >>> [bucket_index(v) for v in (0, 31, 32, 33, 63, 64, 1000)]
+       [0, 31, 32, 32, 47, 48, 111]
+    """
+    if value < _SUB_COUNT:
+        return value
+    shift = value.bit_length() - _SUB_BITS
+    return _SUB_COUNT + (shift - 1) * _HALF_SUB_COUNT + (value >> shift) - _HALF_SUB_COUNT
+
+
+def bucket_bounds(index):
+    """(lowest, highest) values of a bucket
+
+    .. code:: pycon
+
+       >>> [bucket_bounds(i) for i in (31, 32, 47, 111)]
+       [(31, 31), (32, 33), (62, 63), (992, 1023)]
+    """
+    if index < _SUB_COUNT:
+        return index, index
+    shift, sub = divmod(index - _SUB_COUNT, _HALF_SUB_COUNT)
+    shift += 1
+    low = (sub + _HALF_SUB_COUNT) << shift
+    return low, low + (1 << shift) - 1
+
+
+class Histogram(object):
+    """Counts of values in log-linear buckets (a poor man's HDR histogram), values in seconds"""
+    __slots__ = ('buckets', 'count', 'sum', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = {}  # {index: count, ...}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        index = bucket_index(int(value * _RESOLUTION))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def quantile(self, q):
+        """Approximate value (upper bound of its bucket) below which are ``q`` of the values, None if empty"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(bucket_bounds(index)[1] / _RESOLUTION, self.max)
+        return self.max
+
+    def cumulative_counts(self, bounds):
+        """Number of values not greater than each of the bounds (in seconds), within the precision of the
+        buckets
+        """
+        ordered = sorted(self.buckets.iteritems())
+        counts = []
+        seen = 0
+        i = 0
+        for bound in bounds:
+            limit = bound * _RESOLUTION
+            while i < len(ordered) and bucket_bounds(ordered[i][0])[0] <= limit:
+                seen += ordered[i][1]
+                i += 1
+            counts.append(seen)
+        return counts
+
+
+class _Shard(object):
+    """The metrics recorded by one thread"""
+    __slots__ = ('thread', 'counters', 'histograms')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}  # {(name, labels): value, ...}
+        self.histograms = {}  # {(name, labels): Histogram, ...}
+
+    def merge(self, other):
+        for key, value in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, histogram in other.histograms.items():
+            mine = self.histograms.get(key)
+            if mine is None:
+                mine = self.histograms[key] = Histogram()
+            mine.merge(histogram)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.iteritems())) if labels else ()
+
+
+class MetricsRegistry(object):
+    """Named counters and histograms with labels"""
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard(None)  # Merged shards of the dead threads
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                if len(self._shards) >= METRICS_MAX_SHARDS:
+                    self._retire_dead_shards()
+                self._shards.append(shard)
+            return shard
+
+    def _retire_dead_shards(self):
+        """Merges the metrics of the dead threads in one shard (lock held)"""
+        alive = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                self._retired.merge(shard)
+        self._shards = alive
+
+    def inc(self, name, value=1, **labels):
+        """Adds value to a counter"""
+        counters = self._shard().counters
+        key = (name, _labels_key(labels))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Records a value (seconds) in a histogram"""
+        histograms = self._shard().histograms
+        key = (name, _labels_key(labels))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.record(value)
+
+    def _merged(self):
+        """A :class:`_Shard` with the metrics of all threads"""
+        with self._lock:
+            self._retire_dead_shards()
+            merged = _Shard(None)
+            merged.merge(self._retired)
+            for shard in self._shards:
+                merged.merge(shard)
+        return merged
+
+    def snapshot(self):
+        """The metrics as a dict: {'counters': {name: [{'labels': {...}, 'value': n}, ...]},
+        'histograms': {name: [{'labels': {...}, 'count': n, 'sum': s, 'min': x, 'max': y, 'p50': z, 'p90': ...,
+        'p99': ...}, ...]}}
+        """
+        merged = self._merged()
+        counters = {}
+        for (name, labels), value in sorted(merged.counters.iteritems()):
+            counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        histograms = {}
+        for (name, labels), histogram in sorted(merged.histograms.iteritems()):
+            histograms.setdefault(name, []).append({
+                'labels': dict(labels),
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'min': histogram.min,
+                'max': histogram.max,
+                'p50': histogram.quantile(0.5),
+                'p90': histogram.quantile(0.9),
+                'p99': histogram.quantile(0.99)
+            })
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self, buckets=METRICS_EXPORT_BUCKETS):
+        """The metrics in the Prometheus text exposition format
+
+        :param buckets: upper bounds (seconds) of the exported histogram buckets
+        """
+        merged = self._merged()
+        lines = []
+        last_name = None
+        for (name, labels), value in sorted(merged.counters.iteritems()):
+            if name != last_name:
+                _prometheus_header(lines, name, 'counter')
+                last_name = name
+            lines.append('{0}{1} {2}'.format(name, _prometheus_labels(labels), _prometheus_value(value)))
+        for (name, labels), histogram in sorted(merged.histograms.iteritems()):
+            if name != last_name:
+                _prometheus_header(lines, name, 'histogram')
+                last_name = name
+            for bound, count in zip(buckets, histogram.cumulative_counts(buckets)):
+                le_labels = labels + (('le', _prometheus_value(bound)),)
+                lines.append('{0}_bucket{1} {2}'.format(name, _prometheus_labels(le_labels), count))
+            lines.append('{0}_bucket{1} {2}'.format(name, _prometheus_labels(labels + (('le', '+Inf'),)),
+                                                    histogram.count))
+            lines.append('{0}_sum{1} {2}'.format(name, _prometheus_labels(labels), _prometheus_value(histogram.sum)))
+            lines.append('{0}_count{1} {2}'.format(name, _prometheus_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """Forgets all metrics"""
+        with self._lock:
+            for shard in self._shards:
+                shard.counters.clear()
+                shard.histograms.clear()
+            self._retired = _Shard(None)
+
+
+def _prometheus_header(lines, name, type_):
+    if name in DESCRIPTIONS:
+        lines.append('# HELP {0} {1}'.format(name, DESCRIPTIONS[name]))
+    lines.append('# TYPE {0} {1}'.format(name, type_))
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _prometheus_escape(value)) for name, value in labels) + '}'
+
+
+def _prometheus_escape(value):
+    return '{0}'.format(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _prometheus_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return '{0}'.format(value)
+
+
+# The registry of the mllib metrics
+REGISTRY = MetricsRegistry()
+
+
+class MetricsHook(TimingHook):
+    """Records the measures of the requests in a :class:`MetricsRegistry`"""
+    def __init__(self, registry=REGISTRY):
+        super(MetricsHook, self).__init__(history_size=0)
+        self.registry = registry
+
+    def record(self, timing):
+        registry = self.registry
+        verb, path = timing.verb, timing.path
+        registry.inc('mllib_requests_total', verb=verb, path=path, status=timing.status_code or '')
+        registry.observe('mllib_request_duration_seconds', timing.total, verb=verb, path=path)
+        if timing.ttfb is not None:
+            registry.observe('mllib_request_ttfb_seconds', timing.ttfb, verb=verb, path=path)
+        if timing.bytes_sent:
+            registry.inc('mllib_request_sent_bytes_total', timing.bytes_sent, verb=verb, path=path)
+        if timing.bytes_received:
+            registry.inc('mllib_request_received_bytes_total', timing.bytes_received, verb=verb, path=path)
+        if timing.error is not None:
+            mlcode = getattr(timing.error, 'mlcode', None) or type(timing.error).__name__
+            registry.inc('mllib_errors_total', verb=verb, path=path, mlcode=mlcode)
@@ -23,7 +23,8 @@ class MarkLogicServerError(Exception):
         :param response: a :class:`requests.Response` object with server error code
         """
         self.http_code = response.status_code
-        if response.headers['content-type'].startswith('application/json'):
+        self.headers = response.headers
+        if response.headers.get('content-type', '').startswith('application/json'):
             # Making the message from the response
             self.json_msg = json.loads(response.text).get('errorResponse', {})
         else:
@@ -33,3 +34,23 @@ class MarkLogicServerError(Exception):
 
     def __str__(self):
         return "HTTP code {0} ({1}): {2}".format(self.http_code, self.mlcode, self.mlmessage)
+
+
+class MarkLogicEvalError(Exception):
+    """The error of one of the inputs of a batched eval, see :meth:`mllib.eval.EvalService.eval_batch`"""
+    def __init__(self, index, mlcode, mlmessage):
+        """
+        :param index: position of the failed input in the batch
+        :param mlcode: the MarkLogic error code like 'XDMP-AS'
+        :param mlmessage: the MarkLogic error message
+        """
+        super(MarkLogicEvalError, self).__init__(index, mlcode, mlmessage)
+        self.index = index
+        self.mlcode = mlcode
+        self.mlmessage = mlmessage
+
+    def __str__(self):
+        return "Input {0} ({1}): {2}".format(self.index, self.mlcode, self.mlmessage)
+
+    def __repr__(self):
+        return "MarkLogicEvalError({0!r}, {1!r}, {2!r})".format(self.index, self.mlcode, self.mlmessage)
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+===============
+mllib.multipart
+===============
+
+multipart/mixed bodies as used by the MarkLogic REST API
+
+http://docs.marklogic.com/guide/rest-dev/bulk#id_51755
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import json
+import re
+import uuid
+
+from requests.structures import CaseInsensitiveDict
+
+from .config import DEFAULT_CHARSET, HAVE_PYTHON3, STREAM_CHUNK_SIZE
+from .metrics import REGISTRY
+from .retry import RewindableBody
+from .utils import guess_mimetype, is_string
+
+CRLF = b'\r\n'
+_DELIMITER_FOLLOWERS = frozenset(bytearray(b'-\r\n \t'))  # What may follow "--boundary"
+
+
+_filename_rx = re.compile(r'filename\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]+))')
+
+
+def part_filename(headers):
+    """The filename (the document URI with MarkLogic) of the Content-Disposition header of a part, or None
+
+    .. code:: pycon
+
+       >>> part_filename({'Content-Disposition': 'attachment; filename="/a/b.xml"; category=content'})
+       u'/a/b.xml'
+    """
+    disposition = headers.get('Content-Disposition')
+    if disposition is None:
+        return None
+    match = _filename_rx.search(disposition)
+    if match is None:
+        return None
+    if match.group(1) is not None:
+        return re.sub(r'\\(.)', r'\1', match.group(1))
+    return match.group(2)
+
+
+def make_boundary():
+    """A random multipart boundary"""
+    return uuid.uuid4().hex.encode('ascii')
+
+
+def _to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode(DEFAULT_CHARSET)
+
+
+def iter_content(content, chunk_size=STREAM_CHUNK_SIZE):
+    """Yields the bytes of a document content provided as string or file like object
+
+    :param content: a string or a file like object opened in 'rb' mode
+    :param chunk_size: max size of each chunk read from a file
+    """
+    if is_string(content):
+        yield _to_bytes(content)
+        return
+    while True:
+        chunk = content.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def metadata_body(metadata):
+    """The (content type, bytes) of a document metadata part
+
+    :param metadata: a mapping (sent as JSON) or an already serialized XML or JSON string
+    """
+    if is_string(metadata):
+        metadata = _to_bytes(metadata)
+        if metadata.lstrip().startswith(b'<'):
+            return 'application/xml', metadata
+        return 'application/json', metadata
+    return 'application/json', _to_bytes(json.dumps(metadata))
+
+
+def _part_header(boundary, content_type, disposition):
+    return b''.join((b'--', boundary, CRLF,
+                     b'Content-Type: ', _to_bytes(content_type), CRLF,
+                     b'Content-Disposition: ', _to_bytes(disposition), CRLF,
+                     CRLF))
+
+
+def iter_documents_body(documents, boundary, chunk_size=STREAM_CHUNK_SIZE):
+    """Yields a multipart/mixed body for a bulk write, one chunk at a time.
+    http://docs.marklogic.com/REST/POST/v1/documents
+
+    :param documents: iterable of (uri, content, metadata) tuples. ``content`` is a string or an opened file
+      object (see :func:`iter_content`) or None for a metadata only update. ``metadata`` is a mapping or a
+      serialized string (see :func:`metadata_body`) or None.
+    :param boundary: the boundary of the parts (bytes)
+    :param chunk_size: max size of chunks read from files
+    """
+    for uri, content, metadata in documents:
+        filename = 'attachment; filename="{0}"'.format(uri.replace('"', '\\"'))
+        if metadata is not None:
+            ct, body = metadata_body(metadata)
+            yield _part_header(boundary, ct, filename + '; category=metadata')
+            yield body
+            yield CRLF
+        if content is not None:
+            yield _part_header(boundary, guess_mimetype(uri), filename)
+            for chunk in iter_content(content, chunk_size):
+                yield chunk
+            yield CRLF
+    yield b'--' + boundary + b'--' + CRLF
+
+
+def rewindable_documents_body(documents, boundary, chunk_size=STREAM_CHUNK_SIZE):
+    """Like :func:`iter_documents_body` for a body that may be sent again: the file contents are rewound to their
+    initial position before each iteration.
+
+    :param documents: sequence of (uri, content, metadata) tuples
+    :return: a :class:`mllib.retry.RewindableBody`
+    """
+    positions = [(content, _tell(content)) for _, content, _ in documents]
+
+    def factory():
+        for content, position in positions:
+            if position is not None:
+                content.seek(position)
+        return iter_documents_body(documents, boundary, chunk_size)
+
+    return RewindableBody(factory)
+
+
+def _tell(content):
+    """Position of a file like content, None for strings"""
+    try:
+        return content.tell()
+    except AttributeError:
+        return None
+
+
+class MultipartReader(object):
+    """Parses a multipart/mixed body from raw chunks of bytes.
+
+    Delimiters are searched in a buffer of received bytes and the bodies are sliced from that buffer as they are,
+    with no line splitting. A body is closed by a CRLF or LF followed by ``--`` + boundary.
+
+    .. code:: pycon
+
+       >>> chunks = [b'--B\\r\\nContent-Type: text/plain\\r\\n\\r\\nhello\\r\\n--B\\r\\n\\r\\nwor', b'ld\\r\\n--B--\\r\\n']
+       >>> [(dict(headers), body) for headers, body in MultipartReader(chunks, b'B')]
+       [({'Content-Type': 'text/plain'}, 'hello'), ({}, 'world')]
+    """
+    def __init__(self, chunks, boundary):
+        """
+        :param chunks: iterable of bytes of the multipart body, like :meth:`requests.Response.iter_content`
+        :param boundary: the boundary of the parts (bytes)
+        """
+        self._chunks = iter(chunks)
+        # A leading LF lets the first delimiter match when there is no preamble
+        self._buffer = bytearray(b'\n')
+        self._pos = 0  # Start of unread bytes in buffer
+        self._delimiter = b'\n--' + boundary
+        self._eof = False
+        self._started = False  # Preamble skipped
+        self._in_body = False  # Reading a part body
+        self._done = False  # Closing delimiter seen
+
+    def _fill(self):
+        """Appends the next chunk to the buffer
+
+        :return: False at end of input
+        """
+        if self._eof:
+            return False
+        if self._pos > 0:
+            del self._buffer[:self._pos]
+            self._pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer += chunk
+                return True
+        self._eof = True
+        return False
+
+    def _scan(self, wanted=None):
+        """Looks for the end of the current body in the buffer, filling it as needed
+
+        :param wanted: return as soon as this number of body bytes are known, None to fill the buffer until the
+          delimiter is found
+        :return: (end, idx) where buffer[pos:end] are body bytes, idx is the index of the delimiter or -1 if not
+          yet found (or input ended without delimiter)
+        """
+        delimiter = self._delimiter
+        offset = 0  # From self._pos, bytes already searched
+        while True:
+            idx = self._buffer.find(delimiter, self._pos + offset)
+            if idx == -1:
+                # A partial delimiter (and its CR) may end the buffer
+                safe_end = len(self._buffer) - len(delimiter)
+                if wanted is not None and safe_end >= self._pos + wanted:
+                    return safe_end, -1
+                offset = max(0, len(self._buffer) - self._pos - len(delimiter) + 1)
+                if not self._fill():
+                    return len(self._buffer), -1
+                continue
+            end = idx + len(delimiter)
+            if end >= len(self._buffer):
+                # We need the next byte to validate the delimiter
+                offset = idx - self._pos
+                if self._fill():
+                    continue
+            elif self._buffer[end] not in _DELIMITER_FOLLOWERS:
+                # The boundary is the prefix of some other text
+                offset = idx + 1 - self._pos
+                continue
+            return self._body_end(idx), idx
+
+    def _read_line(self):
+        """The next line of the buffer without its terminator"""
+        while True:
+            idx = self._buffer.find(b'\n', self._pos)
+            if idx != -1:
+                line = bytes(self._buffer[self._pos:idx])
+                self._pos = idx + 1
+                return line.rstrip(b'\r')
+            if not self._fill():
+                line = bytes(self._buffer[self._pos:])
+                self._pos = len(self._buffer)
+                return line
+
+    def _body_end(self, idx):
+        """End of body before the delimiter at idx (drops the CR of CRLF)"""
+        if idx > self._pos and self._buffer[idx - 1] == 13:
+            return idx - 1
+        return idx
+
+    def _consume_delimiter(self, idx):
+        """Moves after the delimiter line at idx, notes the closing delimiter"""
+        self._pos = idx + len(self._delimiter)
+        line = self._read_line()
+        if line.startswith(b'--'):
+            self._done = True
+        self._in_body = False
+
+    def _skip_body(self):
+        """Skips the remaining body of current part (or the preamble)"""
+        while True:
+            end, idx = self._scan(1)
+            if idx != -1:
+                self._consume_delimiter(idx)
+                return
+            if self._eof:
+                self._end_of_input()
+                return
+            self._pos = end
+
+    def _end_of_input(self):
+        """Input ended without closing delimiter"""
+        self._pos = len(self._buffer)
+        self._done = True
+        self._in_body = False
+
+    def _slice(self, end):
+        """Bytes of the buffer from pos to end, moves pos to end"""
+        view = memoryview(self._buffer)
+        data = view[self._pos:end].tobytes()
+        del view
+        self._pos = end
+        return data
+
+    def next_part(self):
+        """Moves to the next part, skipping what's left of the current part
+
+        :return: the headers of the part as :class:`requests.structures.CaseInsensitiveDict` or None when
+          there are no more parts
+        """
+        if not self._done and (self._in_body or not self._started):
+            self._started = True
+            self._skip_body()
+        if self._done:
+            return None
+        headers = CaseInsensitiveDict()
+        while True:
+            line = self._read_line()
+            if line == b'':
+                break
+            name, value = line.split(b':', 1)
+            if HAVE_PYTHON3:
+                name, value = name.decode('latin-1'), value.decode('latin-1')
+            headers[name.strip()] = value.strip()
+        self._in_body = True
+        REGISTRY.inc('mllib_multipart_parts_total')
+        return headers
+
+    def read_body(self):
+        """The remaining body of the current part, in one slice of the buffer
+
+        :return: bytes
+        """
+        if not self._in_body:
+            return b''
+        end, idx = self._scan()
+        body = self._slice(end)
+        if idx == -1:
+            self._end_of_input()
+        else:
+            self._consume_delimiter(idx)
+        return body
+
+    def read(self, size=-1):
+        """At most size bytes of the current part body, with no more buffering than required
+
+        :param size: max number of bytes, -1 for the remaining body
+        :return: bytes, empty at the end of the part
+        """
+        if size is None or size < 0:
+            return self.read_body()
+        if not self._in_body or size == 0:
+            return b''
+        end, idx = self._scan(size)
+        end = min(end, self._pos + size)
+        if end > self._pos:
+            return self._slice(end)
+        if idx == -1:
+            self._end_of_input()
+        else:
+            self._consume_delimiter(idx)
+        return b''
+
+    def __iter__(self):
+        """Yields (headers, body) for each part"""
+        while True:
+            headers = self.next_part()
+            if headers is None:
+                return
+            yield headers, self.read_body()
+
+
+class PartStream(object):
+    """A read only file like object over the body of a part, valid until the reader moves to the next part"""
+    def __init__(self, reader, headers):
+        """
+        :param reader: a :class:`MultipartReader` which current part is this one
+        :param headers: headers of the part
+        """
+        self._reader = reader
+        self.headers = headers
+        self.closed = False
+
+    def read(self, size=-1):
+        """Reads at most size bytes, the remaining body if size is -1"""
+        if self.closed:
+            raise ValueError("I/O operation on closed part stream")
+        data = self._reader.read(size)
+        if size != 0 and not data:
+            self.closed = True
+        return data
+
+    def iter_chunks(self, chunk_size=STREAM_CHUNK_SIZE):
+        """Yields the body as bytes of at most chunk_size"""
+        while not self.closed:
+            data = self.read(chunk_size)
+            if data:
+                yield data
+
+    __iter__ = iter_chunks
+
+    def close(self):
+        """Skips the unread body"""
+        if not self.closed:
+            self.closed = True
+            while self._reader.read(STREAM_CHUNK_SIZE):
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def iter_part_streams(reader):
+    """Yields (headers, :class:`PartStream`) for each part of a :class:`MultipartReader`. The unread remainder of
+    a stream is skipped when the next part is requested.
+    """
+    while True:
+        headers = reader.next_part()
+        if headers is None:
+            return
+        stream = PartStream(reader, headers)
+        yield headers, stream
+        stream.closed = True
@@ -10,32 +10,72 @@ Global REST server access
 
 from __future__ import unicode_literals, print_function, absolute_import
 
+import copy
 import os
+import timeit
 from functools import partial as ft_partial
 
+import requests.adapters
 import requests.auth
 import requests
 
+from .auth import CachingDigestAuth
+from .balancer import Balancer, is_node_failure, request_txid
+from .config import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE
+from .hooks import RequestContext
+from .instrumentation import TimedHTTPAdapter
 from .mlexceptions import MarkLogicServerError
 
 
 class RESTClient(object):
     """The base RESTClient class (needs to be subclassed)"""
-    def __init__(self, hostname, port, username, password, authtype='digest'):
+    def __init__(self, hostname, port, username, password, authtype='digest',
+                 pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, pool_block=False,
+                 keep_alive=True, hooks=(), retry_policy=None, balancing='round-robin', **balancer_options):
         """
-        :param hostname: or IP address of the REST server
+        :param hostname: or IP address of the REST server, or the hosts of a cluster as sequence or comma separated
+          string. Each host may have its own port like 'node1:8010'.
         :param port: listening port of the REST server (int or str)
         :param username: an username that has granted to REST services with required privileges (depending on operation)
         :param password: for this username
         :param authtype: 'digest' (défault) or 'basic' depending on your ML REST server security settings
+        :param pool_connections: number of connection pools (one per host) cached by the session
+        :param pool_maxsize: max number of connections kept alive per host
+        :param pool_block: block when all ``pool_maxsize`` connections of a host are busy rather than opening
+          extra throw away connections
+        :param keep_alive: set to ``False`` to close the connection after each request
+        :param hooks: sequence of :class:`mllib.hooks.RequestHook` objects, see :meth:`add_hook`
+        :param retry_policy: a :class:`mllib.retry.RetryPolicy` for the failed requests, None for no retry
+        :param balancing: how requests are spread over several hosts, see :class:`mllib.balancer.Balancer`
+        :param balancer_options: other options of the :class:`mllib.balancer.Balancer` (``max_failures``,
+          ``ejection_time``...)
         """
         auth_classes = {
             'basic': requests.auth.HTTPBasicAuth,
-            'digest': requests.auth.HTTPDigestAuth,
+            'digest': CachingDigestAuth,
         }
-        auth_class = auth_classes.get(authtype, requests.auth.HTTPDigestAuth)
-        self.base_url = 'http://{0}:{1}'.format(hostname, port)
+        auth_class = auth_classes.get(authtype, CachingDigestAuth)
+        if isinstance(hostname, basestring):
+            hostname = hostname.split(',')
+        self.base_urls = [_base_url(host.strip(), port) for host in hostname]
+        self.base_url = self.base_urls[0]
+        if len(self.base_urls) > 1:
+            self.balancer = Balancer(self.base_urls, balancing, **balancer_options)
+        else:
+            self.balancer = None
         self.authentication = auth_class(username, password)
+        # One pool of connections per host
+        pool_connections = max(pool_connections, len(self.base_urls))
+        self.session = self.make_session(pool_connections, pool_maxsize, pool_block, keep_alive)
+        self.hooks = list(hooks)
+        self.retry_policy = retry_policy
+        self._bind_verbs()
+
+    # Names of the methods of the service that accept a ``txid`` argument, see
+    # :class:`mllib.transactions.TransactionView`
+    txid_methods = frozenset()
+
+    def _bind_verbs(self):
         self.rest_get = ft_partial(self.rest_do, 'get')
         self.rest_post = ft_partial(self.rest_do, 'post')
         self.rest_patch = ft_partial(self.rest_do, 'patch')
@@ -43,25 +83,144 @@ class RESTClient(object):
         self.rest_delete = ft_partial(self.rest_do, 'delete')
 
     @classmethod
-    def from_envvar(cls, varname):
+    def from_envvar(cls, varname, **kwargs):
         """Make a :class:`RESTClient` instance from infos in an env var structured like
-        "hostname:port:username:password[:authtype]"
+        "hostname:port:username:password[:authtype]" where hostname may be a comma separated list of hosts. These
+        hosts share the port, use the initializer for hosts with their own port.
 
         :param varname: Name of environment variable that holds connections info
+        :param kwargs: other named arguments for the initializer (``pool_maxsize``, ...)
         """
         features = os.environ[varname]
-        return cls(*features.split(':'))
+        return cls(*features.split(':'), **kwargs)
 
-    def rest_do(self, http_verb, service_path, *args, **kwargs):
-        """Generic HTTP access to the server"""
-        service_url = self.base_url + service_path
-        requests_func = getattr(requests, http_verb)
+    def make_session(self, pool_connections, pool_maxsize, pool_block, keep_alive):
+        """A :class:`requests.Session` that keeps the connections to the REST server alive and shares them
+        between all requests of this client.
+        """
+        session = requests.Session()
+        session.auth = self.authentication
+        adapter = TimedHTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                   pool_block=pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def add_hook(self, hook):
+        """Adds a hook to the requests of this client
+
+        :param hook: a :class:`mllib.hooks.RequestHook` object
+        """
+        self.hooks.append(hook)
+
+    def prime_authentication(self):
+        """Gets the digest challenge of the server upfront. Requests with a streamed body (generator) cannot be
+        replayed after a 401 challenge.
+        """
+        has_challenge_for = getattr(self.authentication, 'has_challenge_for', None)
+        if has_challenge_for is None:
+            return
+        for base_url in self.base_urls:
+            if not has_challenge_for(base_url):
+                self.session.head(base_url + '/v1/documents').close()
+
+    def pinned(self, base_url, session):
+        """A shallow copy of this client that sends all its requests to one host through another session, as the
+        requests of a multi-statement transaction must be
+
+        :param base_url: of the host, one of :attr:`base_urls`
+        :param session: a :class:`requests.Session` from :meth:`make_session`
+        """
+        client = copy.copy(self)
+        client.base_urls = [base_url]
+        client.base_url = base_url
+        client.balancer = None
+        client.session = session
+        client._bind_verbs()
+        return client
 
+    def close(self):
+        """Closes all connections kept alive by this client"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def rest_do(self, http_verb, service_path, *args, **kwargs):
+        """Generic HTTP access to the server, through the hooks and the retry policy"""
         # See http://docs.marklogic.com/guide/rest-dev/intro#id_34966 for ML error reporting
         rest_errors_format = {'X-Error-Accept': b'application/json'}
         kwargs.setdefault('headers', {}).update(rest_errors_format)
 
-        response = requests_func(service_url, *args, auth=self.authentication, **kwargs)
-        if not response.ok:
-            raise MarkLogicServerError(response)
+        if self.retry_policy is None:
+            return self._balanced_send(http_verb, service_path, args, kwargs)
+        return self.retry_policy.run(http_verb, kwargs,
+                                     lambda: self._balanced_send(http_verb, service_path, args, kwargs))
+
+    def _balanced_send(self, http_verb, service_path, args, kwargs):
+        """One attempt of a request, to the host chosen by the balancer"""
+        balancer = self.balancer
+        if balancer is None:
+            return self._send(http_verb, service_path, self.base_url + service_path, args, kwargs)
+
+        txid = request_txid(service_path, kwargs)
+        node = balancer.acquire(txid)
+        try:
+            response = self._send(http_verb, service_path, node.base_url + service_path, args, kwargs)
+        except Exception as exc:
+            balancer.release(node, failed=is_node_failure(exc))
+            raise
+        # Time to the response headers, without the hooks (limiter waits...)
+        balancer.release(node, response.elapsed.total_seconds())
+
+        # Transactions live in the host that created them
+        if txid is None:
+            if http_verb == 'post' and service_path == '/v1/transactions' and 'Location' in response.headers:
+                balancer.pin(response.headers['Location'].rsplit('/', 1)[-1], node)
+        elif (kwargs.get('params') or {}).get('result') in ('commit', 'rollback'):
+            balancer.unpin(txid)
         return response
+
+    def _send(self, http_verb, service_path, service_url, args, kwargs):
+        """One attempt of a request"""
+        session_func = getattr(self.session, http_verb)
+        hooks = self.hooks
+        if not hooks:
+            response = session_func(service_url, *args, **kwargs)
+            if not response.ok:
+                raise MarkLogicServerError(response)
+            return response
+
+        # Hooks may change the arguments of this attempt
+        kwargs = dict(kwargs, headers=dict(kwargs['headers']))
+        context = RequestContext(self, http_verb, service_path, service_url, args, kwargs)
+        try:
+            for hook in hooks:
+                hook.before_send(context)
+            context.started = timeit.default_timer()
+            context.response = session_func(context.url, *context.args, **context.kwargs)
+            context.finished = timeit.default_timer()
+            for hook in reversed(hooks):
+                hook.after_receive(context)
+            if not context.response.ok:
+                raise MarkLogicServerError(context.response)
+        except Exception as exc:
+            if context.started is not None and context.finished is None:
+                context.finished = timeit.default_timer()
+            context.error = exc
+            for hook in reversed(hooks):
+                hook.on_error(context)
+            raise
+        return context.response
+
+
+def _base_url(host, port):
+    """The base URL of a host that may have its own port"""
+    if ':' in host:
+        return 'http://{0}'.format(host)
+    return 'http://{0}:{1}'.format(host, port)
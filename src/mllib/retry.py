@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+===========
+mllib.retry
+===========
+
+Retries of the requests that failed with a transient error
+
+.. code:: python
+
+   policy = RetryPolicy(max_attempts=5, retry_verbs=IDEMPOTENT_VERBS | {'post'})
+   ds = DocumentsService.from_envvar('MLLIB_TEST_SERVER', retry_policy=policy)
+
+Only the idempotent requests (GET, HEAD, PUT, DELETE) are retried by default. Requests of a transaction
+(``txid`` parameter) are retried only when they could not be sent at all (connection refused...).
+
+A ``Retry-After`` header of the server is obeyed: the request is sent again after that delay, or the error is
+raised at once when the server asks to wait longer than ``max_backoff``.
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import random
+import threading
+import time
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from . import LOG
+from .config import RETRY_BACKOFF, RETRY_MAX_ATTEMPTS, RETRY_MAX_BACKOFF
+from .metrics import REGISTRY
+from .mlexceptions import MarkLogicServerError
+
+IDEMPOTENT_VERBS = frozenset(('get', 'head', 'put', 'delete', 'options'))
+TRANSIENT_HTTP_CODES = frozenset((502, 503, 504))
+TRANSIENT_MLCODES = frozenset((
+    'XDMP-DEADLOCK', 'XDMP-FORESTNOTOPEN', 'XDMP-FORESTMNT', 'XDMP-HOSTDOWN', 'XDMP-XDQPNOSESSION', 'XDMP-XDQPDISC'
+))
+
+
+class RewindableBody(object):
+    """A streamed request body that can be sent again: each iteration gets the chunks of a new iterator"""
+    replayable = True
+
+    def __init__(self, factory):
+        """
+        :param factory: a callable that returns an iterator of the chunks of the body, rewinding its sources
+        """
+        self.factory = factory
+
+    def __iter__(self):
+        return iter(self.factory())
+
+
+def not_sent(exc):
+    """True if the request of a failed exception could not reach the server"""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    if isinstance(exc, requests.ConnectionError) and exc.args and isinstance(exc.args[0], MaxRetryError):
+        return isinstance(exc.args[0].reason, NewConnectionError)
+    return False
+
+
+class RetryBudget(object):
+    """Limits the retries to a ratio of the requests, such that retries cannot flood an overloaded server. Each
+    request deposits ``ratio`` token, each retry takes one.
+    """
+    def __init__(self, ratio=0.2, reserve=10, max_tokens=100):
+        """
+        :param ratio: retries per request allowed in the long run
+        :param reserve: tokens available at start
+        :param max_tokens: cap of the saved tokens
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(reserve)
+        self.exhausted = 0  # Retries refused
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """Takes a token for a retry
+
+        :return: False if the budget is exhausted
+        """
+        with self._lock:
+            if self.tokens < 1:
+                self.exhausted += 1
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """Which failed requests are sent again, and when"""
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, backoff=RETRY_BACKOFF, max_backoff=RETRY_MAX_BACKOFF,
+                 jitter=True, retry_verbs=IDEMPOTENT_VERBS, http_codes=TRANSIENT_HTTP_CODES, mlcodes=TRANSIENT_MLCODES,
+                 budget=None, sleep=time.sleep):
+        """
+        :param max_attempts: max number of attempts of a request, first one included
+        :param backoff: seconds before the first retry, doubled for each other retry
+        :param max_backoff: max seconds between two attempts, errors with a longer ``Retry-After`` are not retried
+        :param jitter: wait a random time between 0 and the backoff ("full jitter") such that the clients that fail
+          together do not retry together
+        :param retry_verbs: verbs of the requests that may be retried after they reached the server, add 'post' or
+          'patch' for the services where they are idempotent
+        :param http_codes: status codes of the transient :class:`mllib.mlexceptions.MarkLogicServerError`
+        :param mlcodes: MarkLogic error codes of the transient :class:`mllib.mlexceptions.MarkLogicServerError`
+        :param budget: a :class:`RetryBudget` shared by the requests using this policy, None for no budget
+        :param sleep: a callable that waits some seconds
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_verbs = frozenset(retry_verbs)
+        self.http_codes = frozenset(http_codes)
+        self.mlcodes = frozenset(mlcodes)
+        self.budget = budget
+        self.sleep = sleep
+
+    def is_transient(self, exc):
+        """Errors that may not happen again"""
+        if isinstance(exc, MarkLogicServerError):
+            return exc.http_code in self.http_codes or exc.mlcode in self.mlcodes
+        return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+    def should_retry(self, verb, exc, in_transaction):
+        """Tells if a failed request may be sent again
+
+        :param verb: 'get', 'post'...
+        :param exc: the exception raised by the request
+        :param in_transaction: True for a request of a multi statements transaction
+        """
+        if not self.is_transient(exc):
+            return False
+        if not_sent(exc):
+            return True
+        return verb in self.retry_verbs and not in_transaction
+
+    def delay(self, attempt, exc=None):
+        """Seconds to wait before an attempt
+
+        :param attempt: number of the failed attempt (1 for the first one)
+        :param exc: the error, its ``Retry-After`` header is honored
+        :return: the seconds, None when the ``Retry-After`` of the server exceeds ``max_backoff``
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        retry_after = _retry_after(exc)
+        if retry_after is not None:
+            if retry_after > self.max_backoff:
+                return None
+            delay = max(delay, retry_after)
+        return delay
+
+    def run(self, verb, kwargs, send):
+        """Calls send() with retries
+
+        :param verb: 'get', 'post'...
+        :param kwargs: named arguments of the request (params, data...)
+        :param send: a callable that sends the request
+        :return: the response
+        """
+        body = kwargs.get('data')
+        position = _tell(body)
+        replayable = (body is None or isinstance(body, (bytes, unicode, dict, list, tuple)) or position is not None
+                      or getattr(body, 'replayable', False))
+        in_transaction = 'txid' in (kwargs.get('params') or {})
+        if self.budget is not None:
+            self.budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                return send()
+            except (MarkLogicServerError, requests.RequestException) as exc:
+                if (attempt >= self.max_attempts or not self.should_retry(verb, exc, in_transaction)
+                        or not (replayable or not_sent(exc))):
+                    raise
+                delay = self.delay(attempt, exc)
+                if delay is None:
+                    LOG.warning("Not retrying %s, the server asks to wait more than %ss", exc, self.max_backoff)
+                    raise
+                # A token is taken only for a retry that is made
+                if self.budget is not None and not self.budget.withdraw():
+                    LOG.warning("Retry budget exhausted, not retrying %s", exc)
+                    raise
+                LOG.warning("Attempt %s of %s failed (%s), retrying in %.3fs", attempt, verb.upper(), exc, delay)
+                REGISTRY.inc('mllib_retries_total', kind='request')
+                self.sleep(delay)
+                if position is not None:
+                    body.seek(position)
+                attempt += 1
+
+
+def _tell(body):
+    """Position of a file like body, None for other bodies"""
+    try:
+        return body.tell()
+    except (AttributeError, IOError):
+        return None
+
+
+def _retry_after(exc):
+    """Seconds of the ``Retry-After`` header of an error response"""
+    headers = getattr(exc, 'headers', None)
+    if headers is None:
+        return None
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
@@ -6,17 +6,55 @@ mllib.transactions
 
 http://docs.marklogic.com/REST/client/transaction-management
 Manages transactions on documents handling
+
+Multi-statement transactions are best used as context managers that commit on success and roll back on
+exceptions. The services bound to the transaction send their requests with its ``txid`` to the host that created
+it, through a connection of the transaction:
+
+.. code:: python
+
+   ts = TransactionsService('localhost', 8000, 'admin', 'admin')
+   ds = DocumentsService('localhost', 8000, 'admin', 'admin')
+   with ts.transaction(timeLimit=60) as tx:
+       tx_ds = tx.bind(ds)
+       for uri, path in files:
+           tx_ds.document_put(path, uri=uri)
+
+The status of a :class:`Transaction` is cached for a few seconds, and its ``heartbeat`` option extends its time
+limit in the background while a long job runs.
 """
 
 from __future__ import unicode_literals, print_function, absolute_import
 
+import functools
 import json
+import threading
+import timeit
 
+from . import LOG
+from .config import TRANSACTION_STATUS_MAX_AGE
+from .mlexceptions import MarkLogicServerError
 from .restclient import RESTClient
 from .utils import KwargsSerializer, guess_mimetype, is_sequence, ResponseAdapter
 
 
 class TransactionsService(RESTClient):
+    # Compiled once for all the requests
+    _transactions_post_params = KwargsSerializer({
+        'name': '?',
+        'timeLimit': '?',
+        'database': '?'
+    })
+
+    _transactions_txid_get_params = KwargsSerializer({
+        'format': '?',
+        'database': '?'
+    })
+
+    _transactions_txid_post_params = KwargsSerializer({
+        'result': '!',
+        'database': '?'
+    })
 
     def transactions_post(self, **kwargs):
         """Create a multi-statement transaction. The resulting transaction id may
@@ -24,39 +62,274 @@ class TransactionsService(RESTClient):
         evaluation to take place in the context of the created transaction.
         http://docs.marklogic.com/REST/POST/v1/transactions
 
-        :param kwargs: Named arguments from the dict ``requirements`` below
-        :return: A transaction identifier usable as "txid" parameter for all compatible REST commands or None (error)
+        :param kwargs: Named arguments from ``_transactions_post_params`` above
+        :return: A transaction identifier usable as "txid" parameter for all compatible REST commands
+        :raise: a :class:`mllib.mlexceptions.MarkLogicServerError` on bad requests
         """
-        requirements = {
-            'name': '?',
-            'timeLimit': '?',
-            'database': '?'
-        }
-        tool = KwargsSerializer(requirements)
-        params, ignored = tool.request_params(kwargs)
+        return transaction_id(self._create_transaction(kwargs))
+
+    def _create_transaction(self, kwargs):
+        """The 303 response that locates the new transaction, not followed"""
+        params, ignored = self._transactions_post_params.request_params(kwargs)
         headers = {'Content-Type': b'text/plain', 'Accept': 'application/json'}
         response = self.rest_post('/v1/transactions', params=params, headers=headers, allow_redirects=False)
-        assert response.status_code == 303, "We expected a 303 HTTP status code"
-        location_hdr = response.headers['Location']
-        return location_hdr.rsplit('/', 1)[-1]
+        if response.status_code != 303 or 'Location' not in response.headers:
+            raise MarkLogicServerError(response)
+        return response
 
     def transactions_txid_get(self, txid, **kwargs):
         """Retrieve status information for the transaction whose id matches the txid given in the request URI.
         http://docs.marklogic.com/REST/GET/v1/transactions/%5Btxid%5D
 
-        :param kwargs: Named arguments from the dict ``requirements`` below
-        :return:
+        :param kwargs: Named arguments from ``_transactions_txid_get_params`` above
+        :return: the status as a dict, or as XML text with ``format='xml'``
         """
-        requirements = {
-            'format': '?',
-            'database': '?'
-        }
-        tool = KwargsSerializer(requirements)
-        params, ignored = tool.request_params(kwargs)
+        params, ignored = self._transactions_txid_get_params.request_params(kwargs)
 
         # Default format will be JSON
-        if 'format' not in params:
-            params['format'] = 'json'
+        params.setdefault('format', 'json')
+        if params['format'] == 'json':
             headers = {'Accept': 'application/json'}
+        else:
+            headers = {'Accept': 'application/xml'}
         response = self.rest_get('/v1/transactions/{0}'.format(txid), params=params, headers=headers)
-        return json.loads(response.text)
+        if params['format'] == 'json':
+            return response.json()
+        return response.text
+
+    def transactions_txid_post(self, txid, **kwargs):
+        """Commit or rollback the transaction whose id matches the txid given in the request URI.
+        http://docs.marklogic.com/REST/POST/v1/transactions/%5Btxid%5D
+
+        :param kwargs: Named arguments from ``_transactions_txid_post_params`` above, ``result`` is 'commit' or
+          'rollback'
+        :return: a :class:`requests.Response` object
+        :raise: a :class:`mllib.mlexceptions.MarkLogicServerError` on bad requests
+        """
+        params, ignored = self._transactions_txid_post_params.request_params(kwargs)
+        headers = {'Content-Type': b'text/plain'}
+        return self.rest_post('/v1/transactions/{0}'.format(txid), params=params, headers=headers)
+
+    def transaction(self, heartbeat=None, **kwargs):
+        """A multi-statement transaction, created when entering the ``with`` block
+
+        :param heartbeat: seconds between the extensions of the time limit, see :class:`Transaction`
+        :param kwargs: Named arguments from ``_transactions_post_params`` above (``timeLimit``...)
+        :return: a :class:`Transaction`
+        """
+        return Transaction(self, heartbeat=heartbeat, **kwargs)
+
+
+def transaction_id(response):
+    """The id of a transaction from the response that created it"""
+    return response.headers['Location'].rstrip('/').rsplit('/', 1)[-1]
+
+
+# Extends the time limit of the transaction it runs in
+SET_TIME_LIMIT_XQY = """xquery version "1.0-ml";
+declare variable $limit as xs:unsignedInt external;
+xdmp:set-transaction-time-limit($limit)
+"""
+
+
+class Transaction(object):
+    """A multi-statement transaction, committed at the end of the ``with`` block or rolled back on exceptions.
+    Its requests go to the host that created it through one connection kept alive.
+
+    Its id, host and state come from the response that creates it. The status from the server is cached for
+    ``status_max_age`` seconds, and :attr:`alive` tells whether the transaction should still run without any
+    request.
+    """
+    def __init__(self, client, heartbeat=None, status_max_age=TRANSACTION_STATUS_MAX_AGE,
+                 clock=timeit.default_timer, **kwargs):
+        """
+        :param client: a :class:`TransactionsService`
+        :param heartbeat: seconds between the extensions of the time limit to ``timeLimit`` seconds from now,
+          by a background thread. None to let the transaction expire after ``timeLimit`` seconds.
+        :param status_max_age: seconds the status is cached by :meth:`status`
+        :param clock: the time source, in seconds
+        :param kwargs: Named arguments of :meth:`TransactionsService.transactions_post`
+        """
+        if heartbeat is not None and kwargs.get('timeLimit') is None:
+            raise ValueError("A heartbeat needs a timeLimit to extend")
+        self.client = client
+        self.kwargs = kwargs
+        self.heartbeat_interval = heartbeat
+        self.status_max_age = status_max_age
+        self.clock = clock
+        self.txid = None
+        self.base_url = None
+        self.state = None  # 'active', 'committed', 'rolled back' or 'expired'
+        self.deadline = None  # Clock value of the end of the time limit, None without limit
+        self.session = None
+        self._pinned_client = None
+        self._status = None
+        self._status_time = None
+        self._stopped = threading.Event()
+        self._heartbeat_thread = None
+        self._lock = threading.Lock()  # Guards the state changes, the heartbeat thread changes it too
+
+    @property
+    def finished(self):
+        return self.state not in (None, 'active')
+
+    @property
+    def alive(self):
+        """True while the transaction is active and within its time limit, without asking the server"""
+        if self.state != 'active':
+            return False
+        return self.deadline is None or self.clock() < self.deadline
+
+    def begin(self):
+        """Creates the transaction on the server
+
+        :return: the transaction id
+        """
+        if self.txid is not None:
+            raise RuntimeError("Transaction {0} already begun".format(self.txid))
+        started = self.clock()
+        response = self.client._create_transaction(self.kwargs)
+        self.txid = transaction_id(response)
+        self.base_url = response.url.split('/v1/', 1)[0]
+        self.state = 'active'
+        self._extend(started)
+        if self.client.balancer is not None:
+            # Its requests don't go through the balancer anymore
+            self.client.balancer.unpin(self.txid)
+        self.session = self.client.make_session(1, 1, False, True)
+        self._pinned_client = self.client.pinned(self.base_url, self.session)
+        if self.heartbeat_interval is not None:
+            self._heartbeat_thread = threading.Thread(target=self._beat, name='heartbeat-{0}'.format(self.txid))
+            self._heartbeat_thread.daemon = True
+            self._heartbeat_thread.start()
+        return self.txid
+
+    def bind(self, service):
+        """A view of a service that runs in this transaction
+
+        :param service: a :class:`mllib.documents.DocumentsService`, a :class:`mllib.eval.EvalService`...
+        :return: a :class:`TransactionView`
+        """
+        self._check_active()
+        return TransactionView(service.pinned(self.base_url, self.session), self.txid)
+
+    def status(self, refresh=False):
+        """The status of the transaction, see :meth:`TransactionsService.transactions_txid_get`
+
+        :param refresh: True to get it from the server even if the cached status is recent enough
+        """
+        self._check_active()
+        now = self.clock()
+        if refresh or self._status is None or now - self._status_time >= self.status_max_age:
+            self._status = self._pinned_client.transactions_txid_get(self.txid)
+            self._status_time = now
+        return self._status
+
+    def heartbeat(self):
+        """Extends the time limit of the transaction to ``timeLimit`` seconds from now, proves it is alive
+
+        :raise: a :class:`mllib.mlexceptions.MarkLogicServerError` when the transaction is gone
+        """
+        self._check_active()
+        started = self.clock()
+        try:
+            data = {'xquery': SET_TIME_LIMIT_XQY, 'vars': json.dumps({'limit': int(self.kwargs['timeLimit'])})}
+            headers = {'Accept': 'multipart/mixed', 'Content-type': 'application/x-www-form-urlencoded'}
+            self._pinned_client.rest_post('/v1/eval', params={'txid': self.txid}, data=data, headers=headers)
+        except MarkLogicServerError as exc:
+            if exc.http_code in (400, 404):
+                # Rolled back by the server or timed out
+                self._end('expired')
+            raise
+        self._extend(started)
+
+    def commit(self):
+        self._finish('commit', 'committed')
+
+    def rollback(self):
+        self._finish('rollback', 'rolled back')
+
+    def _extend(self, started):
+        time_limit = self.kwargs.get('timeLimit')
+        if time_limit is not None:
+            self.deadline = started + int(time_limit)
+
+    def _beat(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            if self.finished:
+                return
+            try:
+                self.heartbeat()
+            except Exception:
+                LOG.exception("Heartbeat of transaction %s failed", self.txid)
+                if self.state == 'expired':
+                    return
+
+    def _end(self, state):
+        """Changes the state of an active transaction"""
+        with self._lock:
+            if self.state == 'active':
+                self.state = state
+
+    def _finish(self, result, state):
+        with self._lock:
+            self._check_active()
+            if self._stopped.is_set():
+                raise RuntimeError("Transaction {0} already finishing".format(self.txid))
+            self._stopped.set()
+        thread = self._heartbeat_thread
+        if thread is not None and thread is not threading.current_thread():
+            # No heartbeat next to the result, nor after the session is closed
+            thread.join()
+        try:
+            self._pinned_client.transactions_txid_post(self.txid, result=result)
+        except Exception:
+            # Unknown outcome, the server rolls the transaction back when its time limit expires
+            self._end('expired')
+            raise
+        else:
+            self._end(state)
+        finally:
+            self.session.close()
+
+    def _check_active(self):
+        if self.txid is None:
+            raise RuntimeError("Transaction not begun")
+        if self.finished:
+            raise RuntimeError("Transaction {0} already {1}".format(self.txid, self.state))
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.finished:
+            return
+        if exc_type is None:
+            self.commit()
+            return
+        try:
+            self.rollback()
+        except Exception:
+            # The original exception matters more
+            LOG.exception("Rollback of transaction %s failed", self.txid)
+
+
+class TransactionView(object):
+    """A service bound to a transaction: the ``txid`` argument defaults to the transaction in the calls of the
+    methods listed in the ``txid_methods`` of the service. Other attributes are the ones of the service.
+    """
+    def __init__(self, service, txid):
+        self.service = service
+        self.txid = txid
+
+    def __getattr__(self, name):
+        attr = getattr(self.service, name)
+        if name not in self.service.txid_methods:
+            return attr
+
+        @functools.wraps(attr)
+        def in_transaction(*args, **kwargs):
+            kwargs.setdefault('txid', self.txid)
+            return attr(*args, **kwargs)
+        return in_transaction
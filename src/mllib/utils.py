@@ -10,14 +10,22 @@ Misc inner utilities
 from __future__ import unicode_literals, print_function, absolute_import
 
 import collections
+import copy
+import functools
+import itertools
 import mimetypes
+import mmap
+import os
+import Queue
 import re
+import stat as statmod
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 
-import enum
-from requests.structures import CaseInsensitiveDict
-
-from .config import HAVE_PYTHON3, UNKNOWN_MIMETYPE, STREAM_LINE_MAX_SIZE
+from .config import (HAVE_PYTHON3, UNKNOWN_MIMETYPE, STREAM_CHUNK_SIZE, MEMOIZE_CACHE_SIZE,
+                     MAPPED_UPLOAD_CHUNK_SIZE)
 
 if HAVE_PYTHON3:
     def is_string(obj):
@@ -50,12 +58,160 @@ def dict_pop(mapping, *keys):
     return {k: mapping.pop(k) for k in keys if k in mapping}
 
 
+CacheInfo = collections.namedtuple('CacheInfo', ('hits', 'misses', 'maxsize', 'currsize'))
+_memoized_functions = []
+_MISSING = object()
+
+
+def memoized(maxsize=MEMOIZE_CACHE_SIZE):
+    """Bounded memoization decorator for thread safe pure functions of one argument. Unhashable arguments are
+    not cached. Like :func:`functools.lru_cache` of Python 3, the decorated function has ``cache_info()`` and
+    ``cache_clear()`` functions.
+
+    This is an approximate LRU with two generations of at most ``maxsize / 2`` results: a new generation starts
+    when the current one is full, and results of the previous generation are moved to the current one when
+    used. Others are dropped with it. Cache hits in the current generation cost a dict lookup with no lock.
+
+    .. code:: pycon
+
+       >>> @memoized(maxsize=4)
+       ... def double(x):
+       ...     return x * 2
+       >>> double(1), double(1), double(2), double(3), double([4])
+       (2, 2, 4, 6, [4, 4])
+       >>> double.cache_info()
+       CacheInfo(hits=1, misses=3, maxsize=4, currsize=3)
+    """
+    generation_size = max(1, maxsize // 2)
+
+    def decorator(func):
+        generations = [{}, {}]  # Current and previous
+        lock = threading.Lock()
+        hits = [itertools.count()]  # Thread safe without lock
+        misses = [0]
+
+        @functools.wraps(func)
+        def wrapper(arg):
+            try:
+                result = generations[0][arg]
+            except KeyError:
+                pass
+            except TypeError:
+                # Unhashable
+                return func(arg)
+            else:
+                next(hits[0])
+                return result
+
+            with lock:
+                previous = generations[1]
+                if arg in previous:
+                    result = previous.pop(arg)
+                    next(hits[0])
+                else:
+                    result = _MISSING
+                    misses[0] += 1
+            if result is _MISSING:
+                result = func(arg)
+            with lock:
+                current = generations[0]
+                current[arg] = result
+                if len(current) >= generation_size:
+                    generations[:] = [{}, current]
+            return result
+
+        def cache_info():
+            # Copying the counter reads its value without incrementing it
+            currsize = len(generations[0]) + len(generations[1])
+            return CacheInfo(next(copy.copy(hits[0])), misses[0], maxsize, currsize)
+
+        def cache_clear():
+            with lock:
+                generations[:] = [{}, {}]
+                hits[0] = itertools.count()
+                misses[0] = 0
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        _memoized_functions.append(wrapper)
+        return wrapper
+    return decorator
+
+
+def memoized_stats():
+    """{function name: :class:`CacheInfo`, ...} for all memoized functions"""
+    return {func.__name__: func.cache_info() for func in _memoized_functions}
+
+
+def clear_memoized():
+    """Clears the caches of all memoized functions, needed after :func:`mimetypes.add_type`"""
+    for func in _memoized_functions:
+        func.cache_clear()
+
+
+def concurrent_map(func, iterable, workers, ordered=True, window=None):
+    """Yields func(item) for each item of iterable, computed by a pool of threads. At most ``window`` results
+    are computed ahead of the consumer.
+
+    .. code:: pycon
+
+       >>> list(concurrent_map(lambda x: x * 2, range(5), workers=3))
+       [0, 2, 4, 6, 8]
+
+    :param func: a callable of one argument
+    :param iterable: the arguments
+    :param workers: number of threads
+    :param ordered: yields the results in the order of ``iterable`` if True, as they are computed otherwise
+    :param window: max number of items processed or waiting for the consumer, defaults to twice ``workers``
+    :raise: the first exception raised by func
+    """
+    window = window or 2 * workers
+    pool = ThreadPool(workers)
+    try:
+        if ordered:
+            pending = collections.deque()
+            for item in iterable:
+                pending.append(pool.apply_async(func, (item,)))
+                if len(pending) >= window:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        else:
+            done = Queue.Queue()
+
+            def run(item):
+                try:
+                    return True, func(item)
+                except Exception:
+                    return False, sys.exc_info()[1]
+
+            def next_result():
+                ok, value = done.get()
+                if not ok:
+                    raise value
+                return value
+
+            outstanding = 0
+            for item in iterable:
+                pool.apply_async(run, (item,), callback=done.put)
+                outstanding += 1
+                if outstanding >= window:
+                    outstanding -= 1
+                    yield next_result()
+            while outstanding:
+                outstanding -= 1
+                yield next_result()
+    finally:
+        pool.terminate()
+
+
 def is_sequence(obj):
     """Determining a Pythonic ordered sequence of objects
     """
     return isinstance(obj, (list, tuple))
 
 
+@memoized()
 def guess_mimetype(filename):
     """The mimetype of a file name or path, 'application/octet-stream' if unknown
 
@@ -71,6 +227,12 @@ def guess_mimetype(filename):
 
 
 class KwargsSerializer(object):
+    """Validation and formatting of the named arguments of a REST request. Build it once per endpoint, as class
+    attribute of the service, then call :meth:`request_params` for each request.
+    """
+    _multiple_types = (list, tuple, dict, set, frozenset)
+    _mapped_names = frozenset(('perm', 'prop', 'trans'))  # Mappings that make 'name:key' parameters
+
     def __init__(self, specs):
         """
         :param specs: mapping of {name: req, ...} where name is the name of a parameter, req is one of :
@@ -81,6 +243,10 @@ class KwargsSerializer(object):
         """
         assert frozenset(specs.values()) <= {'!', '?', '+', '*'}
         self.specs = specs
+        self.required = frozenset(name for name, req in specs.iteritems() if req in ('!', '+'))
+        # {name: (accepts a sequence, validator), ...}
+        self.validators = {name: (req in ('*', '+'), unit_validators[name]) for name, req in specs.iteritems()}
+        self.mapped = self._mapped_names.intersection(specs)
 
     def request_params(self, kwargs, params=None):
         """Builds params suitable to request.get/post/...
@@ -94,43 +260,31 @@ class KwargsSerializer(object):
         ignored = {}
 
         # Checking required parameters
-        for name, req in self.specs.iteritems():
-            if req not in ('!', '+'):
-                continue
-            if name not in kwargs:
-                raise ValueError("{0} keyword argument must be provided".format(name))
+        missing = self.required.difference(kwargs)
+        if missing:
+            raise ValueError("{0} keyword argument must be provided".format(sorted(missing)[0]))
 
+        validators = self.validators
         for name, value in kwargs.iteritems():
-            if name not in self.specs:
+            try:
+                multiple, validator = validators[name]
+            except KeyError:
                 ignored[name] = value
                 continue
 
-            value_spec = self.specs[name]
-
-            if value_spec in ('!', '?'):
-                if not unit_validators[name](value):
+            if multiple and isinstance(value, self._multiple_types):
+                for elem in value:
+                    if not validator(elem):
+                        raise ValueError("Invalid value for {0}, got: {1}".format(name, elem))
+                if len(value) > 0:
+                    params[name] = tuple(value)
+            else:
+                if not validator(value):
                     raise ValueError("Invalid value for {0}, got: {1}".format(name, value))
                 params[name] = value
 
-            elif value_spec in ('*', '+'):
-                if isinstance(value, (list, tuple, dict, set, frozenset)):
-                    param_values = []
-                    for elem in value:
-                        if not unit_validators[name](elem):
-                            raise ValueError("Invalid value for {0}, got: {1}".format(name, elem))
-                        param_values.append(elem)
-                    if len(param_values) > 0:
-                        params[name] = tuple(param_values)
-                else:
-                    if not unit_validators[name](value):
-                        raise ValueError("Invalid value for {0}, got: {1}".format(name, value))
-                    params[name] = value
-
-            else:
-                raise ValueError("Invalid count spec for {0}: {1}".format(name, value_spec))
-
             # Special effect for 'perm', 'prop' and 'trans' parameters
-            if name in ('perm', 'prop', 'trans'):
+            if name in self.mapped:
                 for subname, subvalue in value.iteritems():
                     new_key = "{0}:{1}".format(name, subname)
                     if new_key in params:
@@ -147,12 +301,14 @@ ident_rx = re.compile(r"^[_A-Za-z]\w*$")
 filename_rx = re.compile(r"^([_\w](\w|\-)*)(\.(\w*))?$")
 
 
+@memoized()
 def is_identifier(obj):
     if not is_string(obj):
         return False
     return ident_rx.match(obj) is not None
 
 
+@memoized()
 def is_path(obj):
     if not is_string(obj):
         return False
@@ -163,6 +319,7 @@ def is_path(obj):
     return filename_rx.match(parts[-1]) is not None
 
 
+@memoized()
 def is_fn_uri(obj):
     if not is_string(obj):
         return False
@@ -173,6 +330,7 @@ def is_fn_uri(obj):
     return parsed.path is not None
 
 
+@memoized()
 def is_mimetype(obj):
     if not is_string(obj):
         return False
@@ -332,11 +490,15 @@ unit_validators = {
     'temporal-collection': is_identifier,
     'vars': is_mapping(allowed_values=lambda x: True),
     'system_time': is_datetime,
+    'system-time': is_datetime,
+    'lang': is_string,
     'txid': is_string,
     'xquery': is_string,
     'javascript': is_string,
+    'module': is_string,
     'name': is_string,
-    'timeLimit': is_positive_or_zero_int
+    'timeLimit': is_positive_or_zero_int,
+    'result': lambda result: result in ('commit', 'rollback')
 }
 
 
@@ -393,42 +555,115 @@ class ResponseAdapter(object):
     def is_multipart_mixed(self):
         return (self.maintype, self.subtype) == ('multipart', 'mixed')
 
-    def iter_parts(self):
-        """Yields tuples of (headers, body) for each part of the response
-        """
+    def _reader(self):
+        """A :class:`mllib.multipart.MultipartReader` over the response body or None if it is empty"""
+        from .multipart import MultipartReader
+
         # WTF, we do not always have a Content-Length response header. Why ?
         headers = self.response.headers
         if 'content-length' in headers and int(headers['content-length']) == 0:
-            raise StopIteration
-
-        part_start_marker = b'--' + self.boundary
-        parts_end_marker = b'--' + self.boundary + b'--'
-        states = enum.Enum('states', ('BOUNDARY', 'HEADERS', 'BODY'))
-        state = states.BOUNDARY
-        for line in self.response.iter_lines(chunk_size=STREAM_LINE_MAX_SIZE):
-            if state == states.BOUNDARY:
-                # Waiting for headers
-                if line.strip() == part_start_marker:
-                    state = states.HEADERS
-                    headers = CaseInsensitiveDict()
-
-            elif state == states.HEADERS:
-                line = line.strip()
-                if line == '':
-                    state = states.BODY
-                    chunks = []
-                else:
-                    name, value = line.split(':', 1)
-                    headers[name.strip()] = value.strip()
-
-            elif state == states.BODY:
-                if line.strip() == part_start_marker:
-                    yield headers, b''.join(chunks).strip()  # Lines have their \n terminator
-                    state = states.HEADERS
-                    headers = CaseInsensitiveDict()
-                    chunks = []
-                elif line.strip() == parts_end_marker:
-                    yield headers, b''.join(chunks).strip()  # Lines have their \n terminator
-                    raise StopIteration
-                else:
-                    chunks.append(line)
+            return None
+        return MultipartReader(self.response.iter_content(chunk_size=STREAM_CHUNK_SIZE), self.boundary)
+
+    def iter_parts(self):
+        """Yields tuples of (headers, body) for each part of the response
+        """
+        reader = self._reader()
+        if reader is None:
+            return
+        for part in reader:
+            yield part
+
+    def iter_part_streams(self):
+        """Yields tuples of (headers, stream) for each part of the response, where stream is a read only file like
+        :class:`mllib.multipart.PartStream` object. Parts are not buffered, and the unread remainder of a stream is
+        skipped when the next part is requested, so huge documents may be copied to a file in constant memory:
+
+        .. code:: python
+
+           for headers, stream in response.iter_part_streams():
+               with open(local_path(headers), 'wb') as fh:
+                   shutil.copyfileobj(stream, fh)
+        """
+        from .multipart import iter_part_streams
+
+        reader = self._reader()
+        if reader is None:
+            return
+        for part in iter_part_streams(reader):
+            yield part
+
+    def close(self):
+        """Releases the connection when the parts are not all consumed"""
+        self.response.close()
+
+
+class MappedFile(object):
+    """A request body that memory maps a file from its current position. Its length gives the Content-Length of
+    the request, and its reads return zero copy slices of the map of at least ``chunk_size`` bytes whatever size
+    is asked, such that the socket gets big chunks straight from the page cache. It can be rewound for retries.
+
+    .. code:: python
+
+       with open('/data/big.bin', 'rb') as fh, MappedFile(fh, progress=print) as body:
+           requests.put(url, data=body)
+    """
+    def __init__(self, file_, chunk_size=MAPPED_UPLOAD_CHUNK_SIZE, progress=None):
+        """
+        :param file_: a file object opened in 'rb' mode, not empty
+        :param chunk_size: min bytes returned by each read
+        :param progress: a callable that gets (bytes sent, total bytes) before each read
+        """
+        self.name = getattr(file_, 'name', None)
+        self.start = file_.tell()
+        self.map = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        self.length = max(0, len(self.map) - self.start)
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.position = 0
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if self.progress is not None:
+            self.progress(self.position, self.length)
+        if size is None or size < 0:
+            size = self.length
+        size = min(max(size, self.chunk_size), self.length - self.position)
+        if size <= 0:
+            return b''
+        chunk = buffer(self.map, self.start + self.position, size)
+        self.position += size
+        return chunk
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = min(max(offset, 0), self.length)
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def mappable_size(obj):
+    """The size of the rest of a regular file from its current position, None for other objects"""
+    try:
+        stat_ = os.fstat(obj.fileno())
+        position = obj.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if not statmod.S_ISREG(stat_.st_mode):
+        return None
+    return max(0, stat_.st_size - position)
@@ -2,11 +2,98 @@
 """Misc fixtures and helpers for all tests"""
 from __future__ import unicode_literals, print_function, absolute_import
 
+import BaseHTTPServer
 import functools
 import os
+import SocketServer
+import threading
+import unittest
 
 tests_directory = os.path.dirname(os.path.abspath(__file__))
 tests_abs_path = functools.partial(os.path.join, tests_directory)
 
 if 'MLLIB_TEST_SERVER' not in os.environ:
     os.environ['MLLIB_TEST_SERVER'] = 'localhost:8000:admin:admin'
+
+
+class Clock(object):
+    """A clock for the ``clock`` options, tests move its ``now`` by hand"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Base of the request handlers of the local fake servers"""
+    protocol_version = 'HTTP/1.1'
+
+    def read_body(self):
+        """The request body, with or without chunked transfer encoding"""
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if size == 0:
+                return b''.join(chunks)
+
+    def reply(self, status, body=b'', headers=None):
+        """Sends a response, JSON unless ``headers`` has a Content-Type"""
+        headers = dict(headers or {})
+        headers.setdefault('Content-Type', 'application/json')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server on a free local port, handlers read their settings and record the requests in
+    attributes of the server
+    """
+    daemon_threads = True
+
+    def __init__(self, handler_class):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler_class)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Serves in a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeServerTestCase(unittest.TestCase):
+    """Tests against ``servers_count`` :class:`FakeServer` of ``handler_class``, started once per class, the first
+    one is ``server``
+    """
+    handler_class = FakeHandler
+    servers_count = 1
+
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = [FakeServer(cls.handler_class).start() for i in range(cls.servers_count)]
+        cls.server = cls.servers[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.stop()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+=========================
+Testing mllib.asyncclient
+=========================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+import time
+import traceback
+import unittest
+
+import requests
+
+import mllib.asyncclient
+from mllib.utils import ResponseAdapter
+
+
+class ExecutorTest(unittest.TestCase):
+    def test_results(self):
+        """Results and exceptions go to the futures"""
+        executor = mllib.asyncclient.Executor(2)
+        ok = executor.submit(lambda x: x * 2, 21)
+        ko = executor.submit(lambda: 1 / 0)
+        self.assertEqual(ok.result(1), 42)
+        self.assertIsInstance(ko.exception(1), ZeroDivisionError)
+        with self.assertRaises(ZeroDivisionError):
+            ko.result()
+        # The traceback of the worker is kept
+        try:
+            ko.result()
+        except ZeroDivisionError:
+            self.assertIn('1 / 0', traceback.format_exc())
+        executor.shutdown()
+        with self.assertRaises(RuntimeError):
+            executor.submit(lambda: None)
+
+    def test_concurrency_limit(self):
+        """No more than max_workers calls run at once"""
+        executor = mllib.asyncclient.Executor(3)
+        lock = threading.Lock()
+        running = [0, 0]  # current, max
+
+        def job():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+
+        futures = [executor.submit(job) for _ in range(12)]
+        self.assertEqual(len(list(mllib.asyncclient.as_completed(futures, timeout=5))), 12)
+        self.assertEqual(running[1], 3)
+        executor.shutdown()
+
+    def test_callbacks(self):
+        """Done callbacks are called once done"""
+        future = mllib.asyncclient.Future()
+        called = []
+        future.add_done_callback(called.append)
+        self.assertEqual(called, [])
+        future.set_result(1)
+        future.add_done_callback(called.append)
+        self.assertEqual(called, [future, future])
+        with self.assertRaises(mllib.asyncclient.TimeoutError):
+            mllib.asyncclient.Future().result(0.01)
+
+
+MULTIPART = b'--B\r\n\r\none\r\n--B\r\n\r\ntwo\r\n--B\r\n\r\nthree\r\n--B--\r\n'
+
+
+class FakeResponse(object):
+    headers = requests.structures.CaseInsensitiveDict({'content-type': 'multipart/mixed; boundary=B'})
+    closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(len(MULTIPART)):
+            yield MULTIPART[i:i + 1]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDocumentsService(object):
+    """Stands for a DocumentsService"""
+    def __init__(self, *args, **kwargs):
+        self.init_args = args, kwargs
+        self.base_url = 'http://fake'
+
+    def document_get(self, **kwargs):
+        if 'uri' not in kwargs:
+            raise ValueError("uri keyword argument must be provided")
+        return ResponseAdapter(FakeResponse())
+
+    def close(self):
+        pass
+
+
+class AsyncDocumentsServiceTest(unittest.TestCase):
+    def setUp(self):
+        class Service(mllib.asyncclient.AsyncDocumentsService):
+            service_class = FakeDocumentsService
+        self.client = Service('localhost', 8000, 'foo', 'bar', max_concurrency=4)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_service(self):
+        """Synchronous service is built with a connections pool sized for the workers"""
+        self.assertEqual(self.client.service.init_args[1], {'pool_maxsize': 4})
+        self.assertEqual(self.client.executor.max_workers, 4)
+
+    def test_errors(self):
+        """Validation errors are raised by the futures"""
+        with self.assertRaises(ValueError):
+            self.client.document_get().result(1)
+
+    def test_parts(self):
+        """Multipart responses are iterated while they are read"""
+        adapter = self.client.document_get(uri=['a', 'b', 'c']).result(1)
+        self.assertIsInstance(adapter, mllib.asyncclient.AsyncResponseAdapter)
+        self.assertEqual([body for headers, body in adapter.iter_parts()], [b'one', b'two', b'three'])
+
+        adapter = self.client.document_get(uri=['a', 'b', 'c']).result(1)
+        self.assertEqual([body for headers, body in adapter.parts().result(1)], [b'one', b'two', b'three'])
+
+    def test_parts_reader(self):
+        """Parts are read by their own thread, the workers run other requests meanwhile"""
+        class Service(mllib.asyncclient.AsyncDocumentsService):
+            service_class = FakeDocumentsService
+        client = Service('localhost', 8000, 'foo', 'bar', max_concurrency=1)
+        try:
+            adapter = client.document_get(uri=['a', 'b', 'c']).result(1)
+            adapter.max_pending = 1
+            parts = adapter.iter_parts()
+            self.assertEqual(next(parts)[1], b'one')
+            self.assertIsInstance(client.document_get(uri='a').result(1), mllib.asyncclient.AsyncResponseAdapter)
+            self.assertEqual([body for headers, body in parts], [b'two', b'three'])
+        finally:
+            client.close()
+
+    def test_abandoned_parts(self):
+        """Stopping the iteration releases the reader"""
+        adapter = self.client.document_get(uri=['a', 'b', 'c']).result(1)
+        adapter.max_pending = 1
+        for headers, body in adapter.iter_parts():
+            break
+        self.assertTrue(adapter.response.closed)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+==================
+Testing mllib.auth
+==================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import unittest
+
+import requests
+
+from mllib.auth import CachingDigestAuth
+
+# See RFC 2617 section 3.5
+RFC_CHALLENGE = {
+    'realm': 'testrealm@host.com',
+    'qop': 'auth,auth-int',
+    'nonce': 'dcd98b7102dd2f0e8b11d0f600bfb0c093',
+    'opaque': '5ccc069c403ebaf9f0171e9517f40e41'
+}
+
+
+class FixedCnonceDigestAuth(CachingDigestAuth):
+    def make_cnonce(self, nonce_count):
+        return '0a4f113b'
+
+
+class CachingDigestAuthTest(unittest.TestCase):
+    def test_rfc_2617_example(self):
+        """Response digest of the RFC 2617 example"""
+        auth = FixedCnonceDigestAuth('Mufasa', 'Circle Of Life')
+        header = auth.build_digest_header('GET', 'http://www.nowhere.org/dir/index.html', RFC_CHALLENGE, 1)
+        self.assertTrue(header.startswith('Digest '))
+        self.assertIn('response="6629fae49393a05397450978507c4ef1"', header)
+        self.assertIn('nc=00000001', header)
+        self.assertIn('uri="/dir/index.html"', header)
+
+    def test_unsupported_algorithm(self):
+        """Unknown digest algorithms are not answered"""
+        auth = CachingDigestAuth('Mufasa', 'Circle Of Life')
+        chal = dict(RFC_CHALLENGE, algorithm='FOO')
+        self.assertIsNone(auth.build_digest_header('GET', 'http://www.nowhere.org/', chal, 1))
+
+    def test_nonce_reuse(self):
+        """The cached nonce is sent upfront with an incremented nonce count"""
+        auth = FixedCnonceDigestAuth('Mufasa', 'Circle Of Life')
+
+        # No challenge yet: no Authorization header
+        prep = requests.Request('GET', 'http://www.nowhere.org/dir/index.html').prepare()
+        prep = auth(prep)
+        self.assertNotIn('Authorization', prep.headers)
+
+        auth._store_challenge(RFC_CHALLENGE, 'www.nowhere.org')
+        for expected_nc in ('nc=00000001', 'nc=00000002'):
+            prep = requests.Request('GET', 'http://www.nowhere.org/dir/index.html').prepare()
+            prep = auth(prep)
+            self.assertIn(expected_nc, prep.headers['Authorization'])
+        self.assertDictEqual(auth.stats, {'challenges': 1, 'reused_nonces': 2, 'stale_nonces': 0})
+
+        # Other servers have their own challenges
+        self.assertFalse(auth.has_challenge_for('http://other.nowhere.org/'))
+        prep = auth(requests.Request('GET', 'http://other.nowhere.org/dir/index.html').prepare())
+        self.assertNotIn('Authorization', prep.headers)
+
+        auth.reset()
+        prep = auth(requests.Request('GET', 'http://www.nowhere.org/').prepare())
+        self.assertNotIn('Authorization', prep.headers)
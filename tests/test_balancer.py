@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+======================
+Testing mllib.balancer
+======================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import time
+import unittest
+
+import requests
+
+from mllib.balancer import Balancer, is_node_failure
+from mllib.hooks import RequestHook
+from mllib.mlexceptions import MarkLogicServerError
+from mllib.restclient import RESTClient
+from mllib.retry import RetryPolicy
+from resources import Clock, FakeHandler, FakeServerTestCase
+
+
+class NodeHandler(FakeHandler):
+    """A cluster node that answers its status, and creates transactions"""
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path))
+        self.reply(self.server.status, b'{}')
+
+    def do_POST(self):
+        self.read_body()
+        self.server.requests.append(('POST', self.path))
+        if self.path.split('?')[0] == '/v1/transactions':
+            self.reply(303, b'{}', {'Location': '/v1/transactions/{0}'.format(self.server.port)})
+        else:
+            self.reply(self.server.status, b'{}')
+
+
+class BalancerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def balancer(self, strategy='round-robin', **kwargs):
+        return Balancer(['http://a:8000', 'http://b:8000', 'http://c:8000'], strategy, clock=self.clock, **kwargs)
+
+    def test_round_robin(self):
+        balancer = self.balancer()
+        nodes = [balancer.acquire() for i in range(6)]
+        self.assertEqual([node.base_url[7] for node in nodes], list('abcabc'))
+
+    def test_least_inflight(self):
+        balancer = self.balancer('least-inflight')
+        first, second = balancer.acquire(), balancer.acquire()
+        self.assertNotEqual(first, second)
+        balancer.release(first, 0.01)
+        third = balancer.acquire()
+        self.assertNotEqual(third, second)
+
+    def test_latency(self):
+        balancer = self.balancer('latency')
+        latencies = {'http://a:8000': 0.3, 'http://b:8000': 0.01, 'http://c:8000': 0.2}
+        for i in range(3):
+            # Nodes without latency are tried first
+            node = balancer.acquire()
+            self.assertIsNone(node.latency)
+            balancer.release(node, latencies[node.base_url])
+        self.assertEqual(balancer.acquire().base_url, 'http://b:8000')
+
+    def test_ejection(self):
+        balancer = self.balancer(max_failures=2, ejection_time=10)
+        bad = balancer.nodes[0]
+        for i in range(2):
+            bad.inflight += 1
+            balancer.release(bad, failed=True)
+        self.assertTrue(balancer.stats['http://a:8000']['ejected'])
+        self.assertNotIn(bad, [balancer.acquire() for i in range(4)])
+
+        # Comes back after the ejection time
+        self.clock.now += 10
+        self.assertIn(bad, [balancer.acquire() for i in range(3)])
+
+    def test_all_ejected(self):
+        balancer = self.balancer(max_failures=1)
+        for i, node in enumerate(balancer.nodes):
+            self.clock.now += i
+            node.inflight += 1
+            balancer.release(node, failed=True)
+        self.assertIs(balancer.acquire(), balancer.nodes[0])
+
+    def test_transactions(self):
+        balancer = self.balancer()
+        node = balancer.acquire()
+        balancer.pin('123', node)
+        self.assertTrue(all(balancer.acquire('123') is node for i in range(4)))
+        balancer.unpin('123')
+        self.assertEqual(len(set(balancer.acquire('123') for i in range(3))), 3)
+
+    def test_node_failure(self):
+        self.assertTrue(is_node_failure(requests.ConnectionError()))
+        self.assertFalse(is_node_failure(ValueError()))
+
+    def test_bad_strategy(self):
+        with self.assertRaises(ValueError):
+            self.balancer('random')
+
+
+class MultiHostClientTest(FakeServerTestCase):
+    handler_class = NodeHandler
+    servers_count = 2
+
+    def setUp(self):
+        for server in self.servers:
+            server.requests = []
+            server.status = 200
+        hosts = ','.join('127.0.0.1:{0}'.format(server.port) for server in self.servers)
+        self.client = RESTClient(hosts, 8000, 'admin', 'admin', authtype='basic',
+                                 retry_policy=RetryPolicy(sleep=lambda delay: None))
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_hosts(self):
+        self.assertEqual(len(self.client.base_urls), 2)
+        self.assertEqual(self.client.base_url, self.client.base_urls[0])
+        single = RESTClient('localhost', 8000, 'admin', 'admin')
+        self.assertIsNone(single.balancer)
+        self.assertEqual(single.base_urls, ['http://localhost:8000'])
+
+    def test_spread(self):
+        for i in range(4):
+            self.client.rest_get('/v1/documents')
+        self.assertEqual([len(server.requests) for server in self.servers], [2, 2])
+
+    def test_failover(self):
+        """Retried requests go to the healthy nodes, the failing node is ejected"""
+        self.servers[0].status = 503
+        for i in range(6):
+            self.assertEqual(self.client.rest_get('/v1/documents').status_code, 200)
+        stats = self.client.balancer.stats[self.client.base_urls[0]]
+        self.assertTrue(stats['ejected'])
+        self.assertLess(len(self.servers[0].requests), 6)
+
+        self.servers[1].status = 404
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_get('/v1/documents')
+
+    def test_latency(self):
+        """The latency of the nodes does not include the time spent in the hooks"""
+        class SlowHook(RequestHook):
+            def before_send(self, context):
+                time.sleep(0.2)
+
+        self.client.add_hook(SlowHook())
+        self.client.rest_get('/v1/documents')
+        latencies = [stats['latency'] for stats in self.client.balancer.stats.values()]
+        self.assertLess(max(latency for latency in latencies if latency is not None), 0.1)
+
+    def test_transaction(self):
+        """The requests of a transaction go to its node"""
+        response = self.client.rest_post('/v1/transactions', allow_redirects=False)
+        txid = response.headers['Location'].rsplit('/', 1)[-1]
+        server = [server for server in self.servers if '{0}'.format(server.port) == txid][0]
+        for i in range(3):
+            self.client.rest_get('/v1/documents', params={'uri': '/a.xml', 'txid': txid})
+        self.client.rest_post('/v1/transactions/' + txid, params={'result': 'commit'})
+        self.assertEqual(len(server.requests), 5)
+        self.assertEqual(self.client.balancer._transactions, {})
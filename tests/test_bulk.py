@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+==================
+Testing mllib.bulk
+==================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+
+import mllib.bulk
+from mllib.documents import DocumentsService
+
+
+class FakeDocumentsService(object):
+    """Records the batches, fails the first attempt of the batches which first URI is in ``failing``"""
+    def __init__(self, failing=(), always_failing=()):
+        self.failing = set(failing)
+        self.always_failing = set(always_failing)
+        self.written = []
+        self.lock = threading.Lock()
+
+    def prime_authentication(self):
+        pass
+
+    def document_post(self, documents, batch_size=None, **kwargs):
+        documents = list(documents)
+        uri = documents[0][0]
+        with self.lock:
+            # Failures happen after the request body is sent
+            contents = [content.read() if hasattr(content, 'read') else content for _, content, _ in documents]
+            if uri in self.always_failing:
+                raise requests.ConnectionError("Boom")
+            if uri in self.failing:
+                self.failing.remove(uri)
+                raise requests.ConnectionError("Boom")
+            for (uri, _, _), content in zip(documents, contents):
+                self.written.append((uri, content, kwargs))
+        return ['response']
+
+
+class BulkLoaderTest(unittest.TestCase):
+    def test_load(self):
+        """All documents are written in batches"""
+        client = FakeDocumentsService()
+        results = []
+        loader = mllib.bulk.BulkLoader(client, workers=3, batch_size=4, callback=results.append, database='foo')
+        documents = (('/doc{0}.txt'.format(i), 'content {0}'.format(i), None) for i in range(10))
+        report = loader.load(documents)
+        self.assertTrue(report.ok)
+        self.assertEqual(report.batches, 3)
+        self.assertEqual(report.documents, 10)
+        self.assertEqual(len(client.written), 10)
+        self.assertEqual(client.written[0][2], {'database': 'foo'})
+        self.assertEqual(sorted(r.index for r in results), [0, 1, 2])
+        self.assertEqual(sorted(len(r.uris) for r in results), [2, 4, 4])
+
+    def test_retry(self):
+        """Failed batches are retried with rewound files"""
+        client = FakeDocumentsService(failing=['/doc0.txt'], always_failing=['/doc2.txt'])
+        loader = mllib.bulk.BulkLoader(client, workers=2, batch_size=2, retries=1, retry_delay=0)
+        documents = [('/doc{0}.txt'.format(i), io.BytesIO(b'content'), None) for i in range(4)]
+        report = loader.load(documents)
+        self.assertFalse(report.ok)
+        self.assertEqual(report.documents, 2)
+        self.assertEqual(report.retries, 2)
+        self.assertEqual(len(report.failed), 1)
+        self.assertEqual(report.failed[0].uris, ['/doc2.txt', '/doc3.txt'])
+        self.assertEqual(report.failed[0].attempts, 2)
+        self.assertEqual(sorted(written[:2] for written in client.written),
+                         [('/doc0.txt', b'content'), ('/doc1.txt', b'content')])
+
+    def test_unexpected_errors(self):
+        """Other errors fail their batch, the load goes on"""
+        client = FakeDocumentsService()
+        loader = mllib.bulk.BulkLoader(client, workers=1, batch_size=1, max_pending=1, retries=3, retry_delay=0)
+        documents = [('/doc{0}.txt'.format(i), mllib.bulk.LazyFile('/no/such/file'), None) for i in range(5)]
+        documents[2] = ('/doc2.txt', 'content', None)
+        report = loader.load(documents)
+        self.assertEqual(report.documents, 1)
+        self.assertEqual(len(report.failed), 4)
+        self.assertIsInstance(report.failed[0].error, IOError)
+
+    def test_bad_options(self):
+        """Invalid document_post options fail at once"""
+        with self.assertRaises(ValueError):
+            mllib.bulk.BulkLoader(DocumentsService('localhost', 8000, 'admin', 'admin'), database='not valid!')
+
+    def test_no_retry_on_client_errors(self):
+        """4xx errors are not transient"""
+        class Error(mllib.bulk.MarkLogicServerError):
+            def __init__(self, http_code):
+                self.http_code = http_code
+
+        self.assertFalse(mllib.bulk.is_transient(Error(400)))
+        self.assertTrue(mllib.bulk.is_transient(Error(503)))
+        self.assertTrue(mllib.bulk.is_transient(requests.ConnectionError()))
+
+
+class IterDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, 'sub'))
+        for path in ('a.xml', os.path.join('sub', 'b.json')):
+            with open(os.path.join(self.root, path), 'wb') as fh:
+                fh.write(b'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_iter_directory(self):
+        """Files of a tree with their URIs"""
+        documents = list(mllib.bulk.iter_directory(self.root, uri_prefix='/docs/'))
+        self.assertEqual([d[0] for d in documents], ['/docs/a.xml', '/docs/sub/b.json'])
+        content = documents[0][1]
+        self.assertEqual(content.read(), b'data')
+        self.assertEqual(content.read(), b'')
+        content.seek(0)
+        self.assertEqual(content.read(2), b'da')
+        content.close()
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+    def test_coalesce(self):
+        """Only the latest write of a URI is sent, on explicit flushes and on close"""
+        client = FakeDocumentsService()
+        buffer = mllib.bulk.WriteBehindBuffer(client, interval=60, batch_size=2, database='foo')
+        for i in range(3):
+            buffer.put('/counter.json', '{0}'.format(i))
+        buffer.put('/other.json', 'x')
+        self.assertEqual((len(buffer), buffer.coalesced), (2, 2))
+        results = buffer.flush()
+        self.assertEqual([result.uris for result in results], [['/counter.json', '/other.json']])
+        self.assertEqual(client.written, [('/counter.json', '2', {'database': 'foo'}),
+                                          ('/other.json', 'x', {'database': 'foo'})])
+        buffer.put('/last.json', 'y')
+        self.assertEqual(buffer.close()[0].uris, ['/last.json'])
+        self.assertEqual(buffer.report.documents, 3)
+        with self.assertRaises(RuntimeError):
+            buffer.put('/late.json', 'z')
+
+    def test_background(self):
+        """Flushed in the background when full or after the interval, failures are reported"""
+        client = FakeDocumentsService(always_failing=['/doc0.txt'])
+        flushed = threading.Event()
+        results = []
+
+        def callback(result):
+            results.append(result)
+            flushed.set()
+
+        with mllib.bulk.WriteBehindBuffer(client, max_documents=3, interval=60, retries=0,
+                                          callback=callback) as buffer:
+            for i in range(3):
+                buffer.put('/doc{0}.txt'.format(i), 'content')
+            self.assertTrue(flushed.wait(5))
+            self.assertFalse(results[0].ok)
+            self.assertEqual(buffer.report.failed, results)
+
+        flushed.clear()
+        with mllib.bulk.WriteBehindBuffer(client, interval=0.01, callback=callback) as buffer:
+            buffer.put('/doc3.txt', 'content')
+            self.assertTrue(flushed.wait(5))
+            self.assertEqual(client.written[-1][0], '/doc3.txt')
+
+    def test_lost_documents(self):
+        """Unexpected errors are reported by the callback, and raised by close"""
+        client = FakeDocumentsService()
+        results = []
+        buffer = mllib.bulk.WriteBehindBuffer(client, interval=60, callback=results.append)
+        self.assertIn(buffer, mllib.bulk._open_buffers)
+        buffer.put('/vanished.txt', mllib.bulk.LazyFile('/no/such/file'))
+        with self.assertRaises(mllib.bulk.WriteBehindError) as cm:
+            buffer.close()
+        self.assertEqual(cm.exception.failed, results)
+        self.assertIsInstance(results[0].error, IOError)
+        self.assertNotIn(buffer, mllib.bulk._open_buffers)
+
+    def test_bounded(self):
+        """Writers wait while a full buffer cannot be flushed"""
+        client = FakeDocumentsService()
+        client.lock.acquire()
+        buffer = mllib.bulk.WriteBehindBuffer(client, max_bytes=10, interval=60)
+        buffer.put('/a.txt', 'a' * 10)
+        # The flush of /a.txt is blocked, /b.txt fills the buffer again
+        buffer.put('/b.txt', 'b' * 10)
+        writer = threading.Thread(target=buffer.put, args=('/c.txt', 'c'))
+        writer.start()
+        writer.join(0.1)
+        self.assertTrue(writer.is_alive())
+        client.lock.release()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        buffer.close()
+        self.assertEqual([written[0] for written in client.written], ['/a.txt', '/b.txt', '/c.txt'])
+
+    def test_callback_put(self):
+        """Callbacks put the documents of failed batches again, even when the buffer is full"""
+        client = FakeDocumentsService(failing=['/a.txt'])
+        client.lock.acquire()
+        called = threading.Event()
+
+        def callback(result):
+            if not result.ok:
+                buffer.put('/a.txt', 'again')
+            called.set()
+
+        buffer = mllib.bulk.WriteBehindBuffer(client, max_bytes=10, interval=60, retries=0, callback=callback)
+        buffer.put('/a.txt', 'a' * 10)
+        # The flush of /a.txt is blocked, /b.txt fills the buffer again
+        buffer.put('/b.txt', 'b' * 10)
+        client.lock.release()
+        self.assertTrue(called.wait(5))
+        buffer.close()
+        self.assertEqual(sorted(client.written)[0][:2], ('/a.txt', 'again'))
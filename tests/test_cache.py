@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+===================
+Testing mllib.cache
+===================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import unittest
+
+import mllib.cache
+import mllib.documents
+from resources import Clock
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content=b'', etag=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {} if etag is None else {'ETag': etag}
+
+
+class FakeServer(object):
+    """Versioned documents, records the request headers"""
+    def __init__(self):
+        self.documents = {}  # {uri: (content, version), ...}
+        self.requests = []
+
+    def write(self, uri, content):
+        version = self.documents.get(uri, (None, 0))[1] + 1
+        self.documents[uri] = (content, version)
+
+    def rest_get(self, path, params=None, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        content, version = self.documents[params['uri']]
+        etag = '"{0}"'.format(version)
+        if headers.get('If-None-Match') == etag:
+            return FakeResponse(304)
+        return FakeResponse(200, content, etag)
+
+
+class DocumentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.clock = Clock()
+
+    def get(self, cache, uri, **params):
+        params['uri'] = uri
+        return cache.get(cache.make_key(params), uri,
+                         lambda headers: self.server.rest_get('/v1/documents', params=params, headers=headers))
+
+    def test_revalidation(self):
+        """Expired entries are revalidated with their ETag"""
+        cache = mllib.cache.DocumentCache(ttl=10, clock=self.clock)
+        self.server.write('/a.xml', b'<a/>')
+        first = self.get(cache, '/a.xml')
+        self.assertEqual(first.content, b'<a/>')
+        self.assertIs(self.get(cache, '/a.xml'), first)
+        self.assertEqual(len(self.server.requests), 1)
+
+        self.clock.now += 11
+        self.assertIs(self.get(cache, '/a.xml'), first)
+        self.assertEqual(self.server.requests[-1], {'If-None-Match': '"1"'})
+
+        self.server.write('/a.xml', b'<b/>')
+        self.clock.now += 11
+        self.assertEqual(self.get(cache, '/a.xml').content, b'<b/>')
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['revalidated'], 1)
+        self.assertEqual(cache.stats['misses'], 2)
+
+    def test_keys(self):
+        """Other databases or categories are other entries"""
+        cache = mllib.cache.DocumentCache(clock=self.clock)
+        self.server.write('/a.xml', b'<a/>')
+        self.get(cache, '/a.xml')
+        self.get(cache, '/a.xml', database='foo')
+        self.get(cache, '/a.xml', category=('metadata',))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual([request.get('If-None-Match') for request in self.server.requests], [None] * 3)
+        cache.invalidate('/a.xml')
+        self.assertEqual(len(cache), 0)
+
+    def test_lru(self):
+        cache = mllib.cache.DocumentCache(max_entries=2, clock=self.clock)
+        for uri in ('/a', '/b', '/c'):
+            self.server.write(uri, b'x')
+        self.get(cache, '/a')
+        self.get(cache, '/b')
+        self.get(cache, '/a')  # /b is the least recently used
+        self.get(cache, '/c')
+        self.assertEqual(sorted(entry.uri for entry in cache._entries.values()), ['/a', '/c'])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_byte_budget(self):
+        cache = mllib.cache.DocumentCache(max_bytes=10, clock=self.clock)
+        self.server.write('/big', b'x' * 11)
+        self.server.write('/a', b'x' * 6)
+        self.server.write('/b', b'x' * 6)
+        self.get(cache, '/big')
+        self.assertEqual(len(cache), 0)
+        self.get(cache, '/a')
+        self.get(cache, '/b')
+        self.assertEqual(cache.stats['bytes'], 6)
+        self.assertEqual([entry.uri for entry in cache._entries.values()], ['/b'])
+
+    def test_invalidated_while_fetching(self):
+        """A response fetched before a write is not stored"""
+        cache = mllib.cache.DocumentCache(clock=self.clock)
+        self.server.write('/a', b'old')
+
+        def fetch(headers):
+            response = self.server.rest_get('/v1/documents', params={'uri': '/a'}, headers=headers)
+            cache.invalidate('/a')
+            return response
+
+        cache.get(cache.make_key({'uri': '/a'}), '/a', fetch)
+        self.assertEqual(len(cache), 0)
+
+
+class CachingDocumentsServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.server.write('/a.xml', b'<a/>')
+        self.cache = mllib.cache.DocumentCache(ttl=60)
+        self.ds = mllib.documents.DocumentsService('localhost', 8000, 'admin', 'admin', cache=self.cache)
+        self.ds.rest_get = self.server.rest_get
+        self.ds.rest_put = self.ds.rest_delete = lambda *args, **kwargs: FakeResponse(201)
+
+    def test_cached_reads(self):
+        self.ds.document_get(uri='/a.xml')
+        self.ds.document_get(uri='/a.xml')
+        self.assertEqual(len(self.server.requests), 1)
+        # Not cached in transactions
+        self.ds.document_get(uri='/a.xml', txid='123')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_invalidation(self):
+        """Writes invalidate the cache"""
+        self.ds.document_get(uri='/a.xml')
+        self.ds.document_put('<a>new</a>', uri='/a.xml')
+        self.assertEqual(len(self.cache), 0)
+        self.ds.document_get(uri='/a.xml')
+        self.ds.document_delete(uri=['/b.xml', '/a.xml'])
+        self.assertEqual(len(self.cache), 0)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+=========================
+Testing mllib.compression
+=========================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import io
+import os
+import tempfile
+import urlparse
+import zlib
+
+from mllib.compression import CompressionHook
+from mllib.documents import DocumentsService
+from resources import FakeHandler, FakeServerTestCase
+
+DOCUMENTS = {
+    '/a.xml': b'<a>' + b'<item>spam</item>' * 500 + b'</a>',
+    '/b.json': b'[' + b'{"egg": 1}, ' * 500 + b'{}]'
+}
+
+
+class CompressingHandler(FakeHandler):
+    """Serves compressed documents, records the decoded request bodies"""
+    def do_GET(self):
+        uris = [value for name, value in urlparse.parse_qsl(self.path.partition('?')[2]) if name == 'uri']
+        if len(uris) == 1:
+            body, content_type = DOCUMENTS[uris[0]], 'application/xml'
+        else:
+            parts = [b'--B\r\nContent-Type: text/plain\r\nContent-Disposition: attachment; filename="' +
+                     uri.encode('ascii') + b'"\r\n\r\n' + DOCUMENTS[uri] + b'\r\n' for uri in uris]
+            body = b''.join(parts) + b'--B--\r\n'
+            content_type = 'multipart/mixed; boundary=B'
+        headers = {'Content-Type': content_type}
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        self.reply(200, body, headers)
+
+    def do_PUT(self):
+        self.record()
+
+    def do_POST(self):
+        self.record()
+
+    def record(self):
+        body = self.read_body()
+        if self.headers.get('Content-Encoding') is not None:
+            body = zlib.decompress(body, 32 + zlib.MAX_WBITS)
+        self.server.uploads.append((self.headers.get('Content-Encoding'), body))
+        self.reply(204)
+
+
+class CompressionHookTest(FakeServerTestCase):
+    handler_class = CompressingHandler
+
+    def setUp(self):
+        self.server.uploads = []
+        self.hook = CompressionHook(encoding='gzip', compress_min_size=100)
+        self.ds = DocumentsService('127.0.0.1', self.server.port, 'admin', 'admin', authtype='basic',
+                                   hooks=[self.hook])
+
+    def tearDown(self):
+        self.ds.close()
+
+    def test_multipart_response(self):
+        """Compressed multipart responses are parsed as they are decoded"""
+        parts = list(self.ds.document_get(uri=['/a.xml', '/b.json']).iter_parts())
+        self.assertEqual([body for headers, body in parts], [DOCUMENTS['/a.xml'], DOCUMENTS['/b.json']])
+        stats = self.hook.stats['response']
+        self.assertEqual(stats['bodies'], 1)
+        self.assertLess(stats['ratio'], 0.1)
+        self.assertGreater(stats['raw_bytes'], sum(len(body) for body in DOCUMENTS.values()))
+
+    def test_response(self):
+        self.assertEqual(self.ds.document_get(uri='/a.xml').content, DOCUMENTS['/a.xml'])
+        self.assertEqual(self.hook.stats['response']['raw_bytes'], len(DOCUMENTS['/a.xml']))
+
+        # Not compressed
+        self.hook.accept_encoding = None
+        self.assertEqual(self.ds.document_get(uri='/a.xml').content, DOCUMENTS['/a.xml'])
+        self.assertEqual(self.hook.stats['response']['bodies'], 1)
+
+    def test_request(self):
+        self.ds.document_put(DOCUMENTS['/a.xml'], uri='/a.xml')
+        self.ds.document_put(b'<small/>', uri='/small.xml')
+        self.assertEqual(self.server.uploads, [('gzip', DOCUMENTS['/a.xml']), (None, b'<small/>')])
+        stats = self.hook.stats['request']
+        self.assertEqual((stats['bodies'], stats['raw_bytes']), (1, len(DOCUMENTS['/a.xml'])))
+        self.assertLess(stats['ratio'], 0.1)
+        self.assertGreaterEqual(stats['cpu_seconds'], 0.0)
+
+    def test_streamed_request(self):
+        """Files and iterables are compressed as they are sent"""
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.write(fd, DOCUMENTS['/b.json'])
+        os.close(fd)
+        try:
+            with open(path, 'rb') as fh:
+                self.ds.document_put(fh, uri='/b.json')
+        finally:
+            os.remove(path)
+        self.ds.document_put(io.BytesIO(DOCUMENTS['/a.xml']), uri='/a.xml')
+        self.ds.document_post([('/c.json', DOCUMENTS['/b.json'], None)])
+        self.assertEqual([upload[1] for upload in self.server.uploads[:2]], [DOCUMENTS['/b.json'], DOCUMENTS['/a.xml']])
+        self.assertIn(DOCUMENTS['/b.json'], self.server.uploads[2][1])
+        self.assertEqual(self.hook.stats['request']['bodies'], 3)
+
+    def test_form(self):
+        self.hook.encoding = 'deflate'
+        self.ds.rest_post('/v1/eval', data={'xquery': 'x' * 1000},
+                          headers={'Content-type': 'application/x-www-form-urlencoded'})
+        self.assertEqual(self.server.uploads, [('deflate', b'xquery=' + b'x' * 1000)])
+        self.ds.rest_post('/v1/eval', data=[('xquery', 'x' * 1000), ('database', 'Documents')])
+        self.assertEqual(self.server.uploads[1], ('deflate', b'xquery=' + b'x' * 1000 + b'&database=Documents'))
+        with self.assertRaises(ValueError):
+            CompressionHook(encoding='br')
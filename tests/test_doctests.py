@@ -34,8 +34,15 @@ def load_tests(loader, tests, ignore):
                                         globs=filedoctest_globs))
 
     # Run the doctests in the various modules
+    import mllib.balancer
+    import mllib.documents
+    import mllib.eval
+    import mllib.hooks
+    import mllib.metrics
+    import mllib.multipart
     import mllib.utils
-    modules_with_doctests = (mllib.utils,)
+    modules_with_doctests = (mllib.balancer, mllib.documents, mllib.eval, mllib.hooks, mllib.metrics,
+                             mllib.multipart, mllib.utils)
     for module in modules_with_doctests:
         tests.addTests(doctest.DocTestSuite(module))
     return tests
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+=======================
+Testing mllib.documents
+=======================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import os
+import tempfile
+import threading
+import unittest
+
+import mllib.documents
+from resources import FakeHandler, FakeServerTestCase
+
+
+class FakeDocumentsService(mllib.documents.DocumentsService):
+    """Serves the documents which URI contains no 'missing', in reverse order like a real server may do"""
+    def __init__(self):
+        super(FakeDocumentsService, self).__init__('localhost', 8000, 'admin', 'admin')
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def document_get(self, **kwargs):
+        with self.lock:
+            self.requests.append(kwargs)
+        return FakeAdapter([({'Content-Disposition': 'attachment; filename="{0}"; category=content'.format(uri)},
+                             uri.encode('utf-8'))
+                            for uri in reversed(kwargs['uri']) if 'missing' not in uri])
+
+
+class FakeAdapter(object):
+    def __init__(self, parts):
+        self.parts = parts
+
+    def iter_parts(self):
+        return iter(self.parts)
+
+
+class SplitUrisTest(unittest.TestCase):
+    def test_split(self):
+        uris = ['/doc{0}.xml'.format(i) for i in range(10)]
+        chunks = list(mllib.documents.split_uris(uris, 3, 10000))
+        self.assertEqual([len(chunk) for chunk in chunks], [3, 3, 3, 1])
+        self.assertEqual(sum(chunks, []), uris)
+
+    def test_url_length(self):
+        """Encoded lengths are taken into account, a too long URI is alone"""
+        uris = ['/é', '/a b', 'x' * 50, '/c']
+        # "uri=%2F%C3%A9&" is 14 characters, "uri=%2Fa+b&" 11
+        chunks = list(mllib.documents.split_uris(uris, 100, 25))
+        self.assertEqual(chunks, [['/é', '/a b'], ['x' * 50], ['/c']])
+
+
+class DocumentGetManyTest(unittest.TestCase):
+    def test_ordered(self):
+        """The parts come in the order of the URIs, missing documents are skipped"""
+        ds = FakeDocumentsService()
+        uris = ['/doc{0}.xml'.format(i) for i in range(25)] + ['/missing.xml']
+        parts = list(ds.document_get_many(uris, workers=3, max_uris=4, database='foo'))
+        self.assertEqual([body for _, body in parts], [uri.encode('utf-8') for uri in uris[:-1]])
+        self.assertEqual(len(ds.requests), 7)
+        self.assertTrue(all(len(request['uri']) <= 4 and request['database'] == 'foo'
+                            for request in ds.requests))
+
+    def test_unordered(self):
+        ds = FakeDocumentsService()
+        uris = ['/doc{0}.xml'.format(i) for i in range(25)]
+        parts = list(ds.document_get_many(uris, ordered=False, workers=3, max_uris=4))
+        self.assertEqual(sorted(body for _, body in parts), sorted(uri.encode('utf-8') for uri in uris))
+
+    def test_url_length(self):
+        """Requests are split to keep the URL short"""
+        ds = FakeDocumentsService()
+        uris = ['/{0}/doc.xml'.format('x' * 100) for _ in range(20)]
+        list(ds.document_get_many(uris, max_url_length=500))
+        self.assertTrue(len(ds.requests) > 4)
+        self.assertEqual(sum(len(request['uri']) for request in ds.requests), 20)
+
+    def test_bad_arguments(self):
+        ds = FakeDocumentsService()
+        with self.assertRaises(ValueError):
+            list(ds.document_get_many(['/a.xml'], uri='/b.xml'))
+        with self.assertRaises(ValueError):
+            list(ds.document_get_many(['/a.xml'], category=['nonsense']))
+        self.assertEqual(ds.requests, [])
+
+
+class UploadHandler(FakeHandler):
+    """Records the headers and body of the PUT requests"""
+    def do_PUT(self):
+        self.server.uploads.append((dict(self.headers), self.read_body()))
+        self.reply(201)
+
+
+class MappedUploadTest(FakeServerTestCase):
+    handler_class = UploadHandler
+
+    def setUp(self):
+        self.server.uploads = []
+        self.ds = mllib.documents.DocumentsService('127.0.0.1', self.server.port, 'admin', 'admin',
+                                                   authtype='basic')
+        fd, self.path = tempfile.mkstemp(suffix='.bin')
+        os.write(fd, os.urandom(100000))
+        os.close(fd)
+
+    def tearDown(self):
+        self.ds.close()
+        os.remove(self.path)
+
+    def test_mapped(self):
+        progress = []
+        with open(self.path, 'rb') as fh:
+            fh.seek(10)
+            self.ds.document_put(fh, uri='/big.bin', progress=lambda sent, total: progress.append((sent, total)))
+            fh.seek(10)
+            expected = fh.read()
+        headers, body = self.server.uploads[0]
+        self.assertEqual(body, expected)
+        self.assertEqual(headers['content-length'], '99990')
+        self.assertEqual(headers['content-type'], 'application/octet-stream')
+        self.assertEqual(progress[0], (0, 99990))
+        self.assertEqual(progress[-1], (99990, 99990))
+
+    def test_small(self):
+        """Small files and strings are sent as is"""
+        with open(self.path, 'rb') as fh:
+            self.ds.document_put(fh, uri='/small.bin')
+        self.ds.document_put(b'<a/>', uri='/a.xml')
+        self.assertEqual([len(body) for headers, body in self.server.uploads], [100000, 4])
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+==================
+Testing mllib.eval
+==================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import decimal
+import json
+import math
+import unittest
+import urlparse
+
+import requests
+
+import mllib.eval
+from mllib.mlexceptions import MarkLogicEvalError
+from mllib.utils import ResponseAdapter
+from resources import FakeHandler, FakeServerTestCase
+
+
+def multipart_response(items, boundary=b'BOUNDARY'):
+    """A streamed :class:`requests.Response` like the ones of /v1/eval
+
+    :param items: sequence of (content type, X-Primitive, body)
+    """
+    chunks = []
+    for content_type, primitive, body in items:
+        chunks.append(b'--' + boundary + b'\r\nContent-Type: ' + content_type.encode('ascii') +
+                      b'\r\nX-Primitive: ' + primitive.encode('ascii') + b'\r\n\r\n' + body + b'\r\n')
+    chunks.append(b'--' + boundary + b'--\r\n')
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = 'multipart/mixed; boundary=' + boundary.decode('ascii')
+    response.raw = ClosableChunks(chunks)
+    return response
+
+
+class ClosableChunks(object):
+    """Just enough of an urllib3 response for :meth:`requests.Response.iter_content`"""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.closed = False
+        self.read_chunks = 0
+
+    def stream(self, chunk_size, decode_content=True):
+        for chunk in self.chunks:
+            self.read_chunks += 1
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+    def release_conn(self):
+        pass
+
+
+class ModulesHandler(FakeHandler):
+    """Installs modules and invokes them, the result is the module and its vars"""
+    def do_PUT(self):
+        body = self.read_body()
+        self.server.requests.append(('PUT', self.path, body))
+        self.server.modules[self.path[len('/v1'):]] = body
+        self.reply(204, b'', {'Content-Type': 'text/plain'})
+
+    def do_POST(self):
+        body = self.read_body()
+        self.server.requests.append(('POST', self.path, body))
+        form = dict(urlparse.parse_qsl(body))
+        if self.path.startswith('/v1/eval'):
+            self.batch(json.loads(form['vars']))
+            return
+        if form['module'] not in self.server.modules:
+            error = b'{"errorResponse": {"messageCode": "XDMP-MODNOTFOUND", "message": "Module not found"}}'
+            self.reply(500, error)
+            return
+        payload = b''.join((b'--B\r\nContent-Type: text/plain\r\nX-Primitive: string\r\n\r\n', form['module'],
+                            b'\r\n--B\r\nContent-Type: application/json\r\nX-Primitive: map\r\n\r\n',
+                            form.get('vars', b'{}'), b'\r\n--B--\r\n'))
+        self.reply(200, payload, {'Content-Type': 'multipart/mixed; boundary=B'})
+
+    def batch(self, wrapper_vars):
+        """Like the batch wrapper: the sum of the 'a' and 'b' vars, an error when they are missing"""
+        self.server.batches.append(wrapper_vars)
+        marker = wrapper_vars['marker']
+        payload = b''
+        for index, vars_ in enumerate(json.loads(wrapper_vars['inputs'])):
+            items = [('map', json.dumps({marker: index}))]
+            if 'a' in vars_ and 'b' in vars_:
+                items.append(('integer', '{0}'.format(int(vars_['a']) + int(vars_['b']))))
+            else:
+                items.append(('map', json.dumps({marker: index, 'code': 'XDMP-UNDEFVAR', 'message': 'Undefined'})))
+            for primitive, body in items:
+                part = '--B\r\nContent-Type: application/json\r\nX-Primitive: {0}\r\n\r\n{1}\r\n'.format(
+                    primitive, body)
+                payload += part.encode('ascii')
+        self.reply(200, payload + b'--B--\r\n', {'Content-Type': 'multipart/mixed; boundary=B'})
+
+
+class DecodeItemTest(unittest.TestCase):
+    def decode(self, primitive, body, content_type='text/plain'):
+        return mllib.eval.decode_item({'X-Primitive': primitive, 'Content-Type': content_type}, body)
+
+    def test_atomics(self):
+        self.assertEqual(self.decode('unsignedLong', b'18446744073709551615'), 18446744073709551615)
+        self.assertEqual(self.decode('decimal', b'1.10'), decimal.Decimal('1.10'))
+        self.assertEqual(self.decode('double', b'1.5E2'), 150.0)
+        self.assertTrue(math.isinf(self.decode('float', b'-INF')))
+        self.assertIs(self.decode('boolean', b'true'), True)
+        self.assertEqual(self.decode('string', 'héhé'.encode('utf-8')), 'héhé')
+        self.assertEqual(self.decode('date', b'2016-01-01'), '2016-01-01')
+
+    def test_nodes(self):
+        self.assertEqual(self.decode('element()', b'<a/>', 'application/xml'), '<a/>')
+        self.assertEqual(self.decode('array-node()', b'[1, null]', 'application/json'), [1, None])
+        self.assertEqual(self.decode('document-node()', b'{"a": 1}', 'application/json'), {'a': 1})
+        self.assertEqual(self.decode('binary()', b'\xff\x00', 'application/octet-stream'), b'\xff\x00')
+        self.assertEqual(self.decode('string', 'é'.encode('latin-1'), 'text/plain; charset=latin-1'), 'é')
+
+
+class IterItemsTest(unittest.TestCase):
+    def test_stream(self):
+        """Items are decoded as the chunks arrive"""
+        response = multipart_response([('text/plain', 'integer', str(i).encode('ascii')) for i in range(1000)])
+        items = mllib.eval.iter_items(ResponseAdapter(response))
+        self.assertEqual(next(items), 0)
+        self.assertLess(response.raw.read_chunks, 10)
+        self.assertEqual(sum(items), sum(range(1000)))
+        self.assertTrue(response.raw.closed)
+
+    def test_abandoned(self):
+        """The response is closed when the iteration is abandoned"""
+        response = multipart_response([('text/plain', 'string', b'a'), ('text/plain', 'string', b'b')])
+        items = mllib.eval.iter_items(ResponseAdapter(response))
+        self.assertEqual(next(items), 'a')
+        items.close()
+        self.assertTrue(response.raw.closed)
+
+
+class PreparedTest(FakeServerTestCase):
+    handler_class = ModulesHandler
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.modules = {}
+        self.server.batches = []
+        self.service = mllib.eval.EvalService('127.0.0.1', self.server.port, 'admin', 'admin',
+                                              authtype='basic')
+
+    def tearDown(self):
+        self.service.close()
+
+    def test_installed_once(self):
+        for i in range(3):
+            module, vars_ = self.service.eval_items(prepared=True, xquery=b'$x + 1', vars={'x': i})
+            self.assertEqual(vars_, {'x': i})
+        self.assertEqual([request[0] for request in self.server.requests], ['PUT', 'POST', 'POST', 'POST'])
+        self.assertEqual(self.server.modules, {module: b'$x + 1'})
+        self.assertTrue(module.endswith('.xqy'))
+
+        # Other languages or sources make other modules
+        self.assertNotEqual(self.service.prepare(javascript='$x + 1'), module)
+        self.assertNotEqual(self.service.prepare(xquery='$x + 2'), module)
+        with self.assertRaises(ValueError):
+            self.service.prepare()
+
+    def test_reinstall(self):
+        """Modules removed from the server are installed again"""
+        module = self.service.prepare(xquery='1')
+        self.server.modules.clear()
+        self.assertEqual(list(self.service.eval_items(prepared=True, xquery='1'))[0], module)
+        self.assertEqual([request[0] for request in self.server.requests], ['PUT', 'POST', 'PUT', 'POST'])
+
+    def test_batch(self):
+        vars_list = [{'a': i, 'b': 1} for i in range(5)]
+        vars_list[3] = {'a': 1}
+        results = list(self.service.eval_batch(vars_list, xquery='$a + $b', batch_size=2))
+        self.assertEqual(len(self.server.batches), 3)
+        self.assertEqual(self.server.batches[0]['script'], '$a + $b')
+        self.assertEqual(results[:3], [[1], [2], [3]])
+        self.assertIsInstance(results[3], MarkLogicEvalError)
+        self.assertEqual((results[3].index, results[3].mlcode), (3, 'XDMP-UNDEFVAR'))
+        self.assertEqual(results[4], [5])
+        with self.assertRaises(ValueError):
+            self.service.eval_batch(vars_list, xquery='1', javascript='1')
+
+    def test_batch_transaction(self):
+        """Updates of the scripts belong to the transaction of the batch"""
+        list(self.service.eval_batch([{'a': 1, 'b': 2}], xquery='$a + $b'))
+        self.assertEqual(self.server.batches[-1]['isolation'], 'different-transaction')
+        results = list(self.service.eval_batch([{'a': 1, 'b': 2}], xquery='$a + $b', txid='123'))
+        self.assertEqual(results, [[3]])
+        self.assertEqual(self.server.batches[-1]['isolation'], 'same-statement')
+        self.assertEqual(self.server.requests[-1][1], '/v1/eval?txid=123')
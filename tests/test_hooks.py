@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+=============================================
+Testing mllib.hooks and mllib.instrumentation
+=============================================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import requests
+
+import mllib.hooks
+import mllib.instrumentation
+from mllib.mlexceptions import MarkLogicServerError
+from mllib.restclient import RESTClient
+from resources import FakeHandler, FakeServerTestCase
+
+
+class Handler(FakeHandler):
+    """Echoes the request body, fails the paths that start with /fail"""
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        if self.path.startswith('/fail'):
+            self.reply(500, b'{"errorResponse": {"messageCode": "XDMP-BOOM", "message": "Boom"}}')
+        else:
+            self.reply(200, b'x' * 10)
+
+    def do_POST(self):
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        self.reply(200, self.read_body())
+
+
+class Recorder(mllib.hooks.RequestHook):
+    def __init__(self, name, calls):
+        self.name = name
+        self.calls = calls
+
+    def before_send(self, context):
+        self.calls.append((self.name, 'before_send'))
+        context.kwargs['headers']['X-' + self.name] = 'yes'
+
+    def after_receive(self, context):
+        self.calls.append((self.name, 'after_receive', context.status_code))
+
+    def on_error(self, context):
+        self.calls.append((self.name, 'on_error', type(context.error).__name__))
+
+
+class HooksTestBase(FakeServerTestCase):
+    handler_class = Handler
+
+    def setUp(self):
+        self.server.requests = []
+        self.client = RESTClient('127.0.0.1', self.server.port, 'admin', 'admin', authtype='basic')
+
+    def tearDown(self):
+        self.client.close()
+
+
+class HooksTest(HooksTestBase):
+    def test_order(self):
+        calls = []
+        self.client.add_hook(Recorder('A', calls))
+        self.client.add_hook(Recorder('B', calls))
+        self.client.rest_get('/v1/documents')
+        self.assertEqual(calls, [('A', 'before_send'), ('B', 'before_send'),
+                                 ('B', 'after_receive', 200), ('A', 'after_receive', 200)])
+        headers = self.server.requests[0][2]
+        self.assertEqual((headers['x-a'], headers['x-b']), ('yes', 'yes'))
+
+    def test_errors(self):
+        calls = []
+        self.client.add_hook(Recorder('A', calls))
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_get('/fail')
+        self.assertEqual(calls, [('A', 'before_send'), ('A', 'after_receive', 500),
+                                 ('A', 'on_error', 'MarkLogicServerError')])
+
+        del calls[:]
+        client = RESTClient('127.0.0.1', 1, 'admin', 'admin', hooks=[Recorder('A', calls)])
+        with self.assertRaises(requests.ConnectionError):
+            client.rest_get('/v1/documents')
+        self.assertEqual(calls, [('A', 'before_send'), ('A', 'on_error', 'ConnectionError')])
+
+    def test_normalize_path(self):
+        self.assertEqual(mllib.hooks.normalize_path('/v1/transactions/123/x'), '/v1/transactions/{id}/x')
+        self.assertEqual(mllib.hooks.normalize_path('/v1/documents'), '/v1/documents')
+
+
+class TimingHookTest(HooksTestBase):
+    def test_timings(self):
+        timing = mllib.instrumentation.TimingHook()
+        self.client.add_hook(timing)
+        self.client.rest_get('/v1/transactions/123')
+        self.client.rest_get('/v1/transactions/456')
+        first, second = timing.timings
+        self.assertEqual((first.verb, first.path, first.status_code), ('get', '/v1/transactions/{id}', 200))
+        self.assertTrue(first.connect > 0)
+        self.assertEqual((second.dns, second.connect), (0, 0))  # Kept alive connection
+        self.assertTrue(0 < first.ttfb <= first.total)
+        self.assertEqual(first.bytes_received, 10)
+        summary = timing.summary()[('get', '/v1/transactions/{id}')]
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['status_codes'], {200: 2})
+
+    def test_bytes_sent(self):
+        timing = mllib.instrumentation.TimingHook()
+        self.client.add_hook(timing)
+        self.client.rest_post('/v1/documents', data=b'abc')
+        self.client.rest_post('/v1/documents', data=(chunk for chunk in (b'abc', b'de')))
+        self.assertEqual([t.bytes_sent for t in timing.timings], [3, 5])
+        self.assertEqual([t.bytes_received for t in timing.timings], [3, 5])
+
+    def test_errors(self):
+        recorded = []
+        timing = mllib.instrumentation.TimingHook(callback=recorded.append)
+        self.client.add_hook(timing)
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_get('/fail')
+        self.assertEqual(len(recorded), 1)
+        self.assertEqual(recorded[0].status_code, 500)
+        self.assertIsInstance(recorded[0].error, MarkLogicServerError)
+        self.assertEqual(timing.summary()[('get', '/fail')]['errors'], 1)
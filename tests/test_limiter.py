@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+=====================
+Testing mllib.limiter
+=====================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+import time
+import unittest
+
+import requests
+
+import mllib.limiter
+from mllib.hooks import RequestContext
+
+
+class AIMDLimitTest(unittest.TestCase):
+    def test_increase(self):
+        """A well used limit grows by one per request"""
+        limit = mllib.limiter.AIMDLimit(initial=4, max_limit=6)
+        for _ in range(4):
+            limit.acquire()
+        for _ in range(4):
+            limit.release(0.01)
+        self.assertEqual(limit.limit, 6)
+        self.assertEqual(limit.inflight, 0)
+        # Not used enough
+        limit.acquire()
+        limit.release(0.01)
+        self.assertEqual(limit.limit, 6)
+
+    def test_decrease(self):
+        limit = mllib.limiter.AIMDLimit(initial=10, min_limit=8, backoff_ratio=0.5)
+        limit.acquire()
+        limit.release(0.01, saturated=True)
+        self.assertEqual(limit.limit, 8)
+        self.assertEqual(limit.decreases, 1)
+
+    def test_latency(self):
+        """Requests much slower than usual are a saturation sign"""
+        limit = mllib.limiter.AIMDLimit(initial=10, latency_tolerance=2.0)
+        for latency in (0.01, 0.012, 0.011):
+            limit.acquire()
+            limit.release(latency)
+        self.assertEqual(limit.decreases, 0)
+        limit.acquire()
+        limit.release(0.1)
+        self.assertEqual((limit.limit, limit.decreases), (9, 1))
+        self.assertTrue(limit.baseline < 0.012)
+
+    def test_latency_shift(self):
+        """The usual latency follows a lasting change, the limit recovers"""
+        limit = mllib.limiter.AIMDLimit(initial=10, max_limit=20)
+
+        def run(latency, rounds):
+            for _ in range(rounds):
+                slots = limit.limit
+                for _ in range(slots):
+                    limit.acquire()
+                for _ in range(slots):
+                    limit.release(latency)
+
+        run(0.01, 5)
+        self.assertEqual(limit.limit, 20)
+        run(0.05, 10)
+        self.assertEqual(limit.limit, 1)
+        run(0.05, 200)
+        self.assertEqual(limit.limit, 20)
+        self.assertTrue(limit.baseline > 0.025)
+
+    def test_wait(self):
+        limit = mllib.limiter.AIMDLimit(initial=1)
+        limit.acquire()
+        with self.assertRaises(mllib.limiter.LimiterTimeout):
+            limit.acquire(timeout=0.05)
+        threading.Timer(0.05, limit.release).start()
+        limit.acquire(timeout=5)
+        self.assertEqual(limit.inflight, 1)
+
+
+class FakeClient(object):
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+    def context(self, base_url='http://a:8000', verb='get', path='/v1/documents'):
+        return RequestContext(FakeClient(base_url), verb, path, base_url + path, (), {})
+
+    def request(self, limiter, context, status_code=200, error=None, latency=0.01):
+        limiter.before_send(context)
+        context.started = 0.0
+        context.finished = latency
+        if error is None:
+            context.response = FakeResponse(status_code)
+            limiter.after_receive(context)
+        else:
+            context.error = error
+            limiter.on_error(context)
+
+    def test_scopes(self):
+        limiter = mllib.limiter.ConcurrencyLimiter(scope='endpoint')
+        self.request(limiter, self.context())
+        self.request(limiter, self.context(verb='put'))
+        self.request(limiter, self.context(path='/v1/transactions/123'))
+        self.request(limiter, self.context(path='/v1/transactions/456'))
+        self.request(limiter, self.context(base_url='http://b:8000'))
+        self.assertEqual(len(limiter.stats), 4)
+        limiter = mllib.limiter.ConcurrencyLimiter()
+        self.request(limiter, self.context())
+        self.request(limiter, self.context(verb='put'))
+        self.assertEqual(list(limiter.stats), ['http://a:8000'])
+        with self.assertRaises(ValueError):
+            mllib.limiter.ConcurrencyLimiter(scope='nonsense')
+
+    def test_saturation(self):
+        limiter = mllib.limiter.ConcurrencyLimiter(initial=10, backoff_ratio=0.5)
+        self.request(limiter, self.context(), status_code=503)
+        self.request(limiter, self.context(), error=requests.ConnectionError())
+        self.request(limiter, self.context(), status_code=404)  # Not a saturation, 2 grows to 3
+        stats = limiter.stats['http://a:8000']
+        self.assertEqual((stats['limit'], stats['inflight'], stats['decreases']), (3, 0, 2))
+
+    def test_concurrency(self):
+        """Threads do not run more requests than the limit"""
+        limiter = mllib.limiter.ConcurrencyLimiter(initial=3, max_limit=3)
+        lock = threading.Lock()
+        running = [0, 0]  # current, max
+
+        def work():
+            context = self.context()
+            limiter.before_send(context)
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            context.started, context.finished = 0.0, 0.01
+            context.response = FakeResponse(200)
+            limiter.after_receive(context)
+
+        threads = [threading.Thread(target=work) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(running[1], 3)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+=====================
+Testing mllib.metrics
+=====================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+import unittest
+
+import mllib.metrics
+from mllib.instrumentation import RequestTiming
+from mllib.mlexceptions import MarkLogicServerError
+
+
+class HistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        """Each value is in the bounds of its bucket, within 1/16"""
+        for value in range(1, 100000, 7):
+            low, high = mllib.metrics.bucket_bounds(mllib.metrics.bucket_index(value))
+            self.assertTrue(low <= value <= high)
+            self.assertTrue(high - low <= low / 16.0)
+
+    def test_quantiles(self):
+        histogram = mllib.metrics.Histogram()
+        for ms in range(1, 101):
+            histogram.record(ms / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.sum, 5.05)
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.05, delta=0.05 / 16)
+        self.assertAlmostEqual(histogram.quantile(0.99), 0.099, delta=0.099 / 16)
+        self.assertEqual(histogram.quantile(1), 0.1)
+        self.assertEqual(histogram.cumulative_counts((0.0105, 1)), [10, 100])
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def test_threads(self):
+        """Metrics of all threads, dead or alive, are merged"""
+        registry = mllib.metrics.MetricsRegistry()
+
+        def work():
+            for _ in range(1000):
+                registry.inc('hits', kind='a')
+                registry.observe('latency', 0.01)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        registry.inc('hits', 5, kind='b')
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['counters']['hits'], [{'labels': {'kind': 'a'}, 'value': 4000},
+                                                        {'labels': {'kind': 'b'}, 'value': 5}])
+        latency = snapshot['histograms']['latency'][0]
+        self.assertEqual(latency['count'], 4000)
+        self.assertAlmostEqual(latency['p99'], 0.01, delta=0.01 / 16)
+        registry.reset()
+        self.assertEqual(registry.snapshot(), {'counters': {}, 'histograms': {}})
+
+    def test_prometheus(self):
+        registry = mllib.metrics.MetricsRegistry()
+        registry.inc('mllib_requests_total', verb='get', path='/v1/documents', status=200)
+        registry.inc('mllib_requests_total', verb='put', path='/v1/documents', status=201)
+        registry.observe('mllib_request_duration_seconds', 0.003, verb='get', path='/v1/"x"')
+        text = registry.to_prometheus(buckets=(0.001, 0.01))
+        self.assertEqual(text.splitlines(), [
+            '# HELP mllib_requests_total Requests sent to the REST server',
+            '# TYPE mllib_requests_total counter',
+            'mllib_requests_total{path="/v1/documents",status="200",verb="get"} 1',
+            'mllib_requests_total{path="/v1/documents",status="201",verb="put"} 1',
+            '# HELP mllib_request_duration_seconds Time of the requests',
+            '# TYPE mllib_request_duration_seconds histogram',
+            'mllib_request_duration_seconds_bucket{path="/v1/\\"x\\"",verb="get",le="0.001"} 0',
+            'mllib_request_duration_seconds_bucket{path="/v1/\\"x\\"",verb="get",le="0.01"} 1',
+            'mllib_request_duration_seconds_bucket{path="/v1/\\"x\\"",verb="get",le="+Inf"} 1',
+            'mllib_request_duration_seconds_sum{path="/v1/\\"x\\"",verb="get"} 0.003',
+            'mllib_request_duration_seconds_count{path="/v1/\\"x\\"",verb="get"} 1'])
+
+
+class FakeResponse(object):
+    status_code = 404
+    headers = {'content-type': 'application/json'}
+    text = '{"errorResponse": {"messageCode": "RESTAPI-NODOCUMENT", "message": "Not found"}}'
+
+
+class MetricsHookTest(unittest.TestCase):
+    def test_record(self):
+        registry = mllib.metrics.MetricsRegistry()
+        hook = mllib.metrics.MetricsHook(registry)
+        hook.record(RequestTiming('get', '/v1/documents', 200, 0, 0, 0.01, 0.02, 0, 100, None))
+        hook.record(RequestTiming('get', '/v1/documents', 404, 0, 0, 0.01, 0.02, 0, 80,
+                                  MarkLogicServerError(FakeResponse())))
+        hook.record(RequestTiming('get', '/v1/documents', None, 0, 0, None, 0.02, 0, None, IOError()))
+        counters = registry.snapshot()['counters']
+        self.assertEqual([c['value'] for c in counters['mllib_requests_total']], [1, 1, 1])
+        self.assertEqual(counters['mllib_request_received_bytes_total'][0]['value'], 180)
+        self.assertEqual(sorted(c['labels']['mlcode'] for c in counters['mllib_errors_total']),
+                         ['IOError', 'RESTAPI-NODOCUMENT'])
+        histograms = registry.snapshot()['histograms']
+        self.assertEqual(histograms['mllib_request_duration_seconds'][0]['count'], 3)
+        self.assertEqual(histograms['mllib_request_ttfb_seconds'][0]['count'], 2)
+
+    def test_multipart_parts(self):
+        from mllib.multipart import MultipartReader
+        before = mllib.metrics.REGISTRY.snapshot()['counters'].get('mllib_multipart_parts_total', [{'value': 0}])
+        list(MultipartReader([b'--B\r\n\r\na\r\n--B\r\n\r\nb\r\n--B--\r\n'], b'B'))
+        after = mllib.metrics.REGISTRY.snapshot()['counters']['mllib_multipart_parts_total']
+        self.assertEqual(after[0]['value'] - before[0]['value'], 2)
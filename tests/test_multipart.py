@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+=======================
+Testing mllib.multipart
+=======================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import io
+import unittest
+
+import mllib.multipart
+
+
+class DocumentsBodyTest(unittest.TestCase):
+    """multipart/mixed bodies for bulk writes"""
+
+    def test_iter_content(self):
+        """Strings and files are chunked"""
+        self.assertEqual(list(mllib.multipart.iter_content('héllo')), ['héllo'.encode('utf-8')])
+        chunks = list(mllib.multipart.iter_content(io.BytesIO(b'abcdefg'), chunk_size=3))
+        self.assertEqual(chunks, [b'abc', b'def', b'g'])
+
+    def test_metadata_body(self):
+        """Metadata from mappings or serialized strings"""
+        self.assertEqual(mllib.multipart.metadata_body({'quality': 2}), ('application/json', b'{"quality": 2}'))
+        self.assertEqual(mllib.multipart.metadata_body(' <metadata/>')[0], 'application/xml')
+        self.assertEqual(mllib.multipart.metadata_body('{}')[0], 'application/json')
+
+    def test_documents_body(self):
+        """Metadata parts precede the content parts of the same document"""
+        documents = [
+            ('/a.json', io.BytesIO(b'{"a": 1}'), {'collections': ['one']}),
+            ('/b.xml', '<b/>', None),
+            ('/c.xml', None, '<metadata/>')
+        ]
+        body = b''.join(mllib.multipart.iter_documents_body(documents, b'BOUNDARY', chunk_size=2))
+        expected = (
+            b'--BOUNDARY\r\n'
+            b'Content-Type: application/json\r\n'
+            b'Content-Disposition: attachment; filename="/a.json"; category=metadata\r\n'
+            b'\r\n'
+            b'{"collections": ["one"]}\r\n'
+            b'--BOUNDARY\r\n'
+            b'Content-Type: application/json\r\n'
+            b'Content-Disposition: attachment; filename="/a.json"\r\n'
+            b'\r\n'
+            b'{"a": 1}\r\n'
+            b'--BOUNDARY\r\n'
+            b'Content-Type: application/xml\r\n'
+            b'Content-Disposition: attachment; filename="/b.xml"\r\n'
+            b'\r\n'
+            b'<b/>\r\n'
+            b'--BOUNDARY\r\n'
+            b'Content-Type: application/xml\r\n'
+            b'Content-Disposition: attachment; filename="/c.xml"; category=metadata\r\n'
+            b'\r\n'
+            b'<metadata/>\r\n'
+            b'--BOUNDARY--\r\n'
+        )
+        self.assertEqual(body, expected)
+
+    def test_random_boundaries(self):
+        """Boundaries are not reused"""
+        self.assertNotEqual(mllib.multipart.make_boundary(), mllib.multipart.make_boundary())
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+BINARY_PART = b'\x00\r\n\r\n--BOUNDARYX\r\n\xff\n'
+
+MULTIPART_BODY = (
+    b'preamble\r\n'
+    b'--BOUNDARY\r\n'
+    b'Content-Type: application/octet-stream\r\n'
+    b'Content-Disposition: attachment; filename="/a.bin"\r\n'
+    b'\r\n' + BINARY_PART + b'\r\n'
+    b'--BOUNDARY  \r\n'
+    b'Content-Type: text/plain\r\n'
+    b'\r\n'
+    b'  spaces kept  \r\n'
+    b'--BOUNDARY\r\n'
+    b'\r\n'
+    b'\r\n'
+    b'--BOUNDARY--\r\n'
+    b'epilogue'
+)
+
+
+class MultipartReaderTest(unittest.TestCase):
+    """Parsing multipart/mixed bodies"""
+
+    def test_parts(self):
+        """Bodies are returned as is, whatever the chunks"""
+        for chunk_size in (1, 2, 3, 7, 11, len(MULTIPART_BODY)):
+            reader = mllib.multipart.MultipartReader(chunked(MULTIPART_BODY, chunk_size), b'BOUNDARY')
+            parts = list(reader)
+            self.assertEqual(len(parts), 3, chunk_size)
+            self.assertEqual(parts[0][0]['content-type'], 'application/octet-stream')
+            self.assertEqual(parts[0][0]['content-disposition'], 'attachment; filename="/a.bin"')
+            self.assertEqual(parts[0][1], BINARY_PART)
+            self.assertEqual(parts[1][1], b'  spaces kept  ')
+            self.assertEqual(len(parts[2][0]), 0)
+            self.assertEqual(parts[2][1], b'')
+
+    def test_next_part_skips_bodies(self):
+        """Unread bodies are skipped"""
+        reader = mllib.multipart.MultipartReader(chunked(MULTIPART_BODY, 5), b'BOUNDARY')
+        self.assertIsNotNone(reader.next_part())
+        headers = reader.next_part()
+        self.assertEqual(headers['content-type'], 'text/plain')
+        self.assertEqual(reader.read_body(), b'  spaces kept  ')
+        self.assertEqual(reader.read_body(), b'')
+        self.assertIsNotNone(reader.next_part())
+        self.assertIsNone(reader.next_part())
+
+    def test_truncated(self):
+        """A missing closing delimiter ends the last part"""
+        body = b'--B\nX-Foo: bar\n\nsome data'
+        parts = list(mllib.multipart.MultipartReader(chunked(body, 4), b'B'))
+        self.assertEqual(parts[0][1], b'some data')
+
+    def test_writer_roundtrip(self):
+        """Bodies made by iter_documents_body are parsed back"""
+        documents = [('/a.bin', BINARY_PART, None), ('/b.json', '{}', {'quality': 1})]
+        body = b''.join(mllib.multipart.iter_documents_body(documents, b'XYZ'))
+        parts = list(mllib.multipart.MultipartReader(chunked(body, 3), b'XYZ'))
+        self.assertEqual([p[1] for p in parts], [BINARY_PART, b'{"quality": 1}', b'{}'])
+
+
+class PartStreamTest(unittest.TestCase):
+    """Streaming the part bodies"""
+
+    def test_streams(self):
+        """Bodies are read piecewise, unread bodies are skipped"""
+        for chunk_size in (1, 4, len(MULTIPART_BODY)):
+            reader = mllib.multipart.MultipartReader(chunked(MULTIPART_BODY, chunk_size), b'BOUNDARY')
+            streams = mllib.multipart.iter_part_streams(reader)
+
+            headers, stream = next(streams)
+            self.assertEqual(headers['content-type'], 'application/octet-stream')
+            pieces = []
+            while True:
+                piece = stream.read(3)
+                if not piece:
+                    break
+                self.assertLessEqual(len(piece), 3)
+                pieces.append(piece)
+            self.assertEqual(b''.join(pieces), BINARY_PART)
+            self.assertTrue(stream.closed)
+
+            headers, stream = next(streams)
+            self.assertEqual(stream.read(4), b'  sp')
+            headers, stream = next(streams)  # Skipped the end of previous one
+            self.assertEqual(len(headers), 0)
+            self.assertEqual(b''.join(stream), b'')
+            self.assertEqual(list(streams), [])
+
+    def test_stale_stream(self):
+        """A stream cannot be read after moving to the next part"""
+        reader = mllib.multipart.MultipartReader([MULTIPART_BODY], b'BOUNDARY')
+        streams = mllib.multipart.iter_part_streams(reader)
+        headers, first = next(streams)
+        headers, second = next(streams)
+        with self.assertRaises(ValueError):
+            first.read()
+        with second:
+            pass
+        self.assertTrue(second.closed)
+        headers, third = next(streams)
+        self.assertEqual(third.read(), b'')
+
+    def test_large_body_constant_memory(self):
+        """Streamed bodies are not kept in the reader buffer"""
+        payload = b'x' * 100000
+        body = b''.join(mllib.multipart.iter_documents_body([('/big.bin', payload, None)], b'XYZ'))
+        reader = mllib.multipart.MultipartReader(chunked(body, 1000), b'XYZ')
+        headers, stream = next(mllib.multipart.iter_part_streams(reader))
+        total = 0
+        for chunk in stream.iter_chunks(500):
+            total += len(chunk)
+            self.assertLess(len(reader._buffer), 3000)
+        self.assertEqual(total, len(payload))
@@ -75,3 +75,25 @@ class RestClientTest(unittest.TestCase):
         self.assertTrue(response.ok)
         self.assertDictEqual(response.json(), {'authenticated': True, 'user': 'schtroumpf'})
 
+
+class SessionPoolTest(unittest.TestCase):
+    """Connections pooling of RESTClient"""
+
+    def test_pool_settings(self):
+        """The pool settings go to the session adapters"""
+        client = RESTClient('localhost', 8000, 'schtroumpf', 'schtroumpf', pool_connections=3, pool_maxsize=7)
+        adapter = client.session.get_adapter(client.base_url)
+        self.assertEqual(adapter._pool_connections, 3)
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertIs(client.session.auth, client.authentication)
+        self.assertEqual(client.session.headers['Connection'], 'keep-alive')
+
+    def test_no_keep_alive(self):
+        """Connections may be closed after each request"""
+        client = RESTClient('localhost', 8000, 'schtroumpf', 'schtroumpf', keep_alive=False)
+        self.assertEqual(client.session.headers['Connection'], 'close')
+
+    def test_from_envvar_options(self):
+        """Pool options are accepted by RESTClient.from_envvar"""
+        client = RESTClient.from_envvar('MLLIB_TEST_SERVER', pool_maxsize=20)
+        self.assertEqual(client.session.get_adapter(client.base_url)._pool_maxsize, 20)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+===================
+Testing mllib.retry
+===================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import io
+
+import requests
+
+import mllib.retry
+from mllib.documents import DocumentsService
+from mllib.mlexceptions import MarkLogicServerError
+from resources import FakeHandler, FakeServerTestCase
+
+
+class FlakyHandler(FakeHandler):
+    """Fails the requests while the server has failures for their path"""
+    def do_GET(self):
+        self.handle_any()
+
+    do_POST = do_PUT = do_GET
+
+    def handle_any(self):
+        body = self.read_body()
+        path = self.path.split('?')[0]
+        self.server.requests.append((self.command, path, body))
+        status, mlcode = self.server.failures.get(path, (0, None))
+        if status and self.server.remaining.get(path, 0) > 0:
+            self.server.remaining[path] -= 1
+            payload = '{{"errorResponse": {{"messageCode": "{0}", "message": "Failed"}}}}'.format(mlcode).encode()
+            self.reply(status, payload, {'Retry-After': self.server.retry_after} if status == 503 else {})
+        else:
+            self.reply(200, b'{}')
+
+
+class RetryTest(FakeServerTestCase):
+    handler_class = FlakyHandler
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.failures = {}
+        self.server.remaining = {}
+        self.server.retry_after = '0'
+        self.sleeps = []
+        self.policy = mllib.retry.RetryPolicy(max_attempts=3, backoff=0.1, sleep=self.sleeps.append)
+        self.client = self.make_client(DocumentsService, self.server.port)
+
+    def tearDown(self):
+        self.client.close()
+
+    def make_client(self, cls, port):
+        return cls('127.0.0.1', port, 'admin', 'admin', authtype='basic', retry_policy=self.policy)
+
+    def fail_next(self, path, count, status=503, mlcode='XDMP-UNAVAILABLE'):
+        self.server.failures[path] = (status, mlcode)
+        self.server.remaining[path] = count
+
+    def test_transient(self):
+        self.fail_next('/v1/documents', 2)
+        response = self.client.rest_get('/v1/documents')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(0 <= self.sleeps[1] <= 0.2)
+
+    def test_max_attempts(self):
+        self.fail_next('/v1/documents', 5)
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_get('/v1/documents')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_classification(self):
+        """Client errors are not retried, transient MarkLogic codes are"""
+        self.fail_next('/v1/documents', 1, status=400, mlcode='RESTAPI-INVALIDREQ')
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_get('/v1/documents')
+        self.fail_next('/v1/eval', 1, status=500, mlcode='XDMP-DEADLOCK')
+        self.client.rest_get('/v1/eval')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_idempotency(self):
+        """POST are retried on demand, requests of transactions are not"""
+        self.fail_next('/v1/eval', 1)
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_post('/v1/eval', data=b'1')
+        self.policy.retry_verbs |= {'post'}
+        self.fail_next('/v1/eval', 1)
+        self.client.rest_post('/v1/eval', data=b'1')
+        self.assertEqual(len(self.server.requests), 3)
+        self.fail_next('/v1/documents', 1)
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_get('/v1/documents', params={'uri': '/a.xml', 'txid': '123'})
+
+    def test_not_sent(self):
+        """Requests that did not reach the server are always retried"""
+        client = self.make_client(DocumentsService, 1)
+        with self.assertRaises(requests.ConnectionError):
+            client.rest_post('/v1/eval', data=b'1', params={'txid': '123'})
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_bodies(self):
+        """Files are rewound, generators are not sent again"""
+        self.fail_next('/v1/documents', 1)
+        content = io.BytesIO(b'xxhello')
+        content.read(2)
+        self.client.rest_put('/v1/documents', data=content)
+        self.assertEqual([body for _, _, body in self.server.requests], [b'hello', b'hello'])
+
+        self.fail_next('/v1/documents', 1)
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_put('/v1/documents', data=(chunk for chunk in [b'a', b'b']))
+
+        self.fail_next('/v1/documents', 1)
+        del self.server.requests[:]
+        self.client.rest_put('/v1/documents', data=mllib.retry.RewindableBody(lambda: iter([b'a', b'b'])))
+        self.assertEqual([body for _, _, body in self.server.requests], [b'ab', b'ab'])
+
+    def test_document_post(self):
+        """Batches are sent again in full"""
+        self.policy.retry_verbs |= {'post'}
+        self.fail_next('/v1/documents', 1)
+        documents = [('/a.txt', io.BytesIO(b'hello'), None), ('/b.txt', 'world', {'collections': ['c']})]
+        self.client.document_post(documents)
+        first, second = [body for _, _, body in self.server.requests]
+        self.assertEqual(first, second)
+        self.assertIn(b'hello', second)
+
+    def test_budget(self):
+        self.policy.budget = mllib.retry.RetryBudget(ratio=0.5, reserve=1)
+        self.fail_next('/v1/documents', 10)
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_get('/v1/documents')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.policy.budget.exhausted, 1)
+
+        # No token is taken when the retry is not made
+        self.policy.budget = mllib.retry.RetryBudget(ratio=0, reserve=1)
+        self.server.retry_after = '3600'
+        self.fail_next('/v1/documents', 1)
+        with self.assertRaises(MarkLogicServerError):
+            self.client.rest_get('/v1/documents')
+        self.assertEqual((self.policy.budget.tokens, self.policy.budget.exhausted), (1, 0))
+
+    def test_delay(self):
+        policy = mllib.retry.RetryPolicy(backoff=1, max_backoff=5, jitter=False)
+        self.assertEqual([policy.delay(attempt) for attempt in range(1, 6)], [1, 2, 4, 5, 5])
+
+        # The Retry-After of the server is obeyed, or not retried at all when too long
+        class Error(Exception):
+            def __init__(self, retry_after):
+                self.headers = {'Retry-After': retry_after}
+
+        self.assertEqual(policy.delay(1, Error('3')), 3)
+        self.assertIsNone(policy.delay(1, Error('60')))
+        self.assertNotIn('XDMP-NOTXNINPROGRESS', mllib.retry.TRANSIENT_MLCODES)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+==========================
+Testing mllib.transactions
+==========================
+"""
+
+from __future__ import unicode_literals, print_function, absolute_import
+
+import time
+import urlparse
+
+from mllib.documents import DocumentsService
+from mllib.eval import EvalService
+from mllib.mlexceptions import MarkLogicServerError
+from mllib.transactions import TransactionsService
+from resources import Clock, FakeHandler, FakeServerTestCase
+
+
+class TransactionHandler(FakeHandler):
+    """Creates transactions named after the port of the server, records the requests and their connection"""
+    def handle_request(self, verb):
+        self.read_body()
+        path, _, query = self.path.partition('?')
+        params = dict(urlparse.parse_qsl(query))
+        self.server.requests.append((verb, path, params, self.client_address[1]))
+        if verb == 'POST' and path == '/v1/transactions':
+            location = '/v1/transactions/{0}'.format(self.server.port)
+            self.reply(self.server.status, b'{}', {'Location': location})
+        elif verb == 'POST' and path == '/v1/eval':
+            self.server.inflight += 1
+            time.sleep(self.server.eval_delay)
+            self.server.inflight -= 1
+            self.reply(200, b'--B--\r\n', {'Content-Type': 'multipart/mixed; boundary=B'})
+        elif verb == 'POST' and path.startswith('/v1/transactions/'):
+            self.server.inflight_at_result.append(self.server.inflight)
+            self.reply(204)
+        elif verb == 'GET' and path.startswith('/v1/transactions/'):
+            self.reply(200, b'{"transaction-status": {"transaction-id": "1"}}')
+        else:
+            self.reply(204)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+
+class TransactionTest(FakeServerTestCase):
+    handler_class = TransactionHandler
+    servers_count = 2
+
+    def setUp(self):
+        for server in self.servers:
+            server.requests = []
+            server.status = 303
+            server.eval_delay = 0
+            server.inflight = 0
+            server.inflight_at_result = []
+            server.base_url = 'http://127.0.0.1:{0}'.format(server.port)
+        hosts = ','.join('127.0.0.1:{0}'.format(server.port) for server in self.servers)
+        self.ts = TransactionsService(hosts, 8000, 'admin', 'admin', authtype='basic')
+        self.ds = DocumentsService(hosts, 8000, 'admin', 'admin', authtype='basic')
+        self.es = EvalService(hosts, 8000, 'admin', 'admin', authtype='basic')
+
+    def tearDown(self):
+        for client in (self.ts, self.ds, self.es):
+            client.close()
+
+    def server_of(self, txid):
+        return [server for server in self.servers if '{0}'.format(server.port) == txid][0]
+
+    def test_commit(self):
+        with self.ts.transaction(timeLimit=10) as tx:
+            tx_ds, tx_es = tx.bind(self.ds), tx.bind(self.es)
+            for i in range(4):
+                tx_ds.document_put(b'<a/>', uri='/{0}.xml'.format(i))
+            list(tx_es.eval_items(xquery='1'))
+            self.assertEqual(tx.status(), {'transaction-status': {'transaction-id': '1'}})
+        requests = self.server_of(tx.txid).requests
+        other = [server for server in self.servers if server.requests is not requests][0]
+        self.assertEqual(other.requests, [])
+
+        self.assertEqual(requests[0][:3], ('POST', '/v1/transactions', {'timeLimit': '10'}))
+        self.assertTrue(all(request[2]['txid'] == tx.txid for request in requests[1:6]))
+        self.assertEqual(requests[-1][:3], ('POST', '/v1/transactions/' + tx.txid, {'result': 'commit'}))
+        # One connection for all the requests in the transaction
+        self.assertEqual(len(set(request[3] for request in requests[1:])), 1)
+        self.assertEqual(self.ts.balancer._transactions, {})
+
+    def test_rollback(self):
+        with self.assertRaises(KeyError):
+            with self.ts.transaction() as tx:
+                tx.bind(self.ds).document_put(b'<a/>', uri='/a.xml')
+                raise KeyError('a')
+        requests = self.server_of(tx.txid).requests
+        self.assertEqual(requests[-1][:3], ('POST', '/v1/transactions/' + tx.txid, {'result': 'rollback'}))
+        with self.assertRaises(RuntimeError):
+            tx.commit()
+
+    def test_explicit(self):
+        tx = self.ts.transaction()
+        with self.assertRaises(RuntimeError):
+            tx.bind(self.ds)
+        with tx:
+            # An explicit txid wins, other attributes are the ones of the service
+            tx.bind(self.ds).document_put(b'<a/>', uri='/a.xml', txid='other')
+            self.assertIs(tx.bind(self.ds).cache, None)
+            tx.rollback()
+        requests = self.server_of(tx.txid).requests
+        self.assertEqual([request[2].get('txid') for request in requests], [None, 'other', None])
+        self.assertEqual(requests[-1][2]['result'], 'rollback')
+        with self.assertRaises(ValueError):
+            self.ts.transactions_txid_post(tx.txid, result='abort')
+
+    def test_status_cache(self):
+        clock = Clock()
+        with self.ts.transaction(status_max_age=5, clock=clock, timeLimit=60) as tx:
+            self.assertEqual((tx.state, tx.base_url), ('active', self.server_of(tx.txid).base_url))
+            for i in range(3):
+                tx.status()
+            clock.now += 5
+            tx.status()
+            tx.status(refresh=True)
+            self.assertTrue(tx.alive)
+            clock.now += 60
+            self.assertFalse(tx.alive)
+        gets = [request for request in self.server_of(tx.txid).requests if request[0] == 'GET']
+        self.assertEqual(len(gets), 3)
+        self.assertEqual(tx.state, 'committed')
+        self.assertFalse(tx.alive)
+
+    def test_heartbeat(self):
+        clock = Clock()
+        with self.assertRaises(ValueError):
+            self.ts.transaction(heartbeat=10)
+        with self.ts.transaction(clock=clock, timeLimit=60) as tx:
+            clock.now += 50
+            tx.heartbeat()
+            clock.now += 50
+            self.assertTrue(tx.alive)
+        evals = [request for request in self.server_of(tx.txid).requests if request[1] == '/v1/eval']
+        self.assertEqual(evals[0][2], {'txid': tx.txid})
+
+        with self.ts.transaction(heartbeat=0.01, timeLimit=60) as tx:
+            server = self.server_of(tx.txid)
+            for i in range(100):
+                if any(request[1] == '/v1/eval' for request in server.requests):
+                    break
+                time.sleep(0.01)
+        self.assertTrue(any(request[1] == '/v1/eval' for request in server.requests))
+
+    def test_heartbeat_finish(self):
+        """The running heartbeat ends before the commit"""
+        for server in self.servers:
+            server.eval_delay = 0.2
+        with self.ts.transaction(heartbeat=0.01, timeLimit=60) as tx:
+            server = self.server_of(tx.txid)
+            for i in range(100):
+                if server.inflight:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(server.inflight_at_result, [0])
+        self.assertFalse(tx._heartbeat_thread.is_alive())
+        self.assertEqual(tx.state, 'committed')
+
+    def test_creation_error(self):
+        self.servers[0].status = 200
+        with TransactionsService(self.servers[0].base_url[7:], 8000, 'admin', 'admin', authtype='basic') as ts:
+            with self.assertRaises(MarkLogicServerError):
+                ts.transactions_post()
@@ -6,6 +6,9 @@ Testing mllib.utils
 """
 from __future__ import unicode_literals, print_function, absolute_import
 
+import os
+import tempfile
+import time
 import unittest
 
 import requests
@@ -46,6 +49,42 @@ class GuessMimetypeTest(unittest.TestCase):
         self.assertEqual(mllib.utils.guess_mimetype('foo.xqy'), 'application/xquery')
 
 
+class MemoizedTest(unittest.TestCase):
+    """Bounded memoization of validators and MIME types lookups"""
+
+    def test_lru(self):
+        """Recently used results are kept, the cache is bounded"""
+        calls = []
+
+        @mllib.utils.memoized(maxsize=4)
+        def func(x):
+            calls.append(x)
+            return x
+
+        for x in ('a', 'b', 'a', 'c', 'd', 'b', 'a'):
+            func(x)
+            self.assertLessEqual(func.cache_info().currsize, 4)
+        self.assertEqual(calls, ['a', 'b', 'c', 'd', 'b', 'a'])
+        self.assertEqual(func.cache_info(), (1, 6, 4, 3))
+        self.assertEqual(func(['unhashable']), ['unhashable'])
+        func.cache_clear()
+        self.assertEqual(func.cache_info(), (0, 0, 4, 0))
+
+    def test_validators_stats(self):
+        """Validators are memoized"""
+        mllib.utils.clear_memoized()
+        for _ in range(3):
+            mllib.utils.guess_mimetype('foo.xml')
+            mllib.utils.is_identifier('Documents')
+        stats = mllib.utils.memoized_stats()
+        self.assertEqual(stats['guess_mimetype'].hits, 2)
+        self.assertEqual(stats['guess_mimetype'].misses, 1)
+        self.assertEqual(stats['is_identifier'].currsize, 1)
+        self.assertIn('is_fn_uri', stats)
+        mllib.utils.clear_memoized()
+        self.assertEqual(mllib.utils.guess_mimetype.cache_info().currsize, 0)
+
+
 class KwargsSerializerTest(unittest.TestCase):
     def test_zero_or_one(self):
         """Zero or one parameter: '?'"""
@@ -184,6 +223,21 @@ class KwargsSerializerTest(unittest.TestCase):
         expected = {'perm:me': ['read'], 'prop:status': ['draft'], 'trans:foo': ['bar'], 'prop:author': ['joe']}
         self.assertDictEqual(params, expected)
 
+    def test_compiled_specs(self):
+        """Specs are checked once at creation"""
+        serializer = mllib.utils.KwargsSerializer({'uri': '+', 'database': '?', 'perm': '?'})
+        self.assertEqual(serializer.required, frozenset(['uri']))
+        self.assertEqual(serializer.mapped, frozenset(['perm']))
+        with self.assertRaises(KeyError):
+            mllib.utils.KwargsSerializer({'no-such-parameter': '?'})
+        with self.assertRaises(ValueError) as ctxt:
+            serializer.request_params({'database': 'foo'})
+        self.assertIn('uri', str(ctxt.exception))
+
+        # Empty sequences are dropped
+        params, ignored = serializer.request_params({'uri': 'foo', 'database': 'bar'})
+        self.assertDictEqual(params, {'uri': 'foo', 'database': 'bar'})
+
 
 class ValidatorsTest(unittest.TestCase):
     """Validators for unique value"""
@@ -296,14 +350,46 @@ class ParseMimetypesTest(unittest.TestCase):
             self.assertEqual(mllib.utils.parse_mimetype(mt_value), expected)
 
 
+class ConcurrentMapTest(unittest.TestCase):
+    def test_ordered(self):
+        def slow_square(x):
+            time.sleep(0.01 * (x % 3))
+            return x * x
+
+        self.assertEqual(list(mllib.utils.concurrent_map(slow_square, range(20), 4)), [x * x for x in range(20)])
+
+    def test_unordered(self):
+        results = mllib.utils.concurrent_map(lambda x: x * x, range(20), 4, ordered=False)
+        self.assertEqual(sorted(results), [x * x for x in range(20)])
+
+    def test_window(self):
+        """The iterable is not consumed much ahead of the results"""
+        consumed = []
+
+        def items():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        results = mllib.utils.concurrent_map(lambda x: x, items(), 2, window=3)
+        self.assertEqual(next(results), 0)
+        self.assertTrue(len(consumed) <= 4)
+
+    def test_exception(self):
+        for ordered in (True, False):
+            with self.assertRaises(ZeroDivisionError):
+                list(mllib.utils.concurrent_map(lambda x: 1 / x, [2, 1, 0, 3], 2, ordered=ordered))
+
+
 class FakeResponse(object):
     def __init__(self, headers, body):
         self.headers = requests.utils.CaseInsensitiveDict(headers)
         self.body = body
 
-    def iter_lines(self, chunk_size=None):
-        for line in self.body.splitlines():
-            yield line + b'\n'
+    def iter_content(self, chunk_size=1):
+        # Small chunks put delimiters across chunks
+        for i in range(0, len(self.body), 7):
+            yield self.body[i:i + 7]
 
 
 MULTIPART_RAW_RESPONSE = b"""
@@ -367,4 +453,39 @@ class ResponseAdapterTest(unittest.TestCase):
         self.assertEqual(count, 3)
         self.assertEqual(all_chunks[0], "hello")
         self.assertEqual(all_chunks[1], "world")
-        self.assertEqual(all_chunks[2], b"héllo\nworld")
+        self.assertEqual(all_chunks[2], b"héllo\nworld\n")
+
+    def test_empty_response(self):
+        headers = {'content-type': 'multipart/mixed; boundary=1176113105d6eaed', 'content-length': '0'}
+        response = FakeResponse(headers, b'')
+        self.assertEqual(list(mllib.utils.ResponseAdapter(response).iter_parts()), [])
+
+    def test_iterate_part_streams(self):
+        headers = {'content-type': 'multipart/mixed; boundary=1176113105d6eaed'}
+        response = FakeResponse(headers, MULTIPART_RAW_RESPONSE)
+        ad = mllib.utils.ResponseAdapter(response)
+        bodies = [stream.read() for _, stream in ad.iter_part_streams()]
+        self.assertEqual(bodies, [b"hello", b"world", b"héllo\nworld\n"])
+
+
+class MappedFileTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, b'0123456789')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read(self):
+        """Reads return chunks of at least chunk_size bytes from the position of the file"""
+        with open(self.path, 'rb') as fh:
+            fh.seek(2)
+            self.assertEqual(mllib.utils.mappable_size(fh), 8)
+            with mllib.utils.MappedFile(fh, chunk_size=3) as body:
+                self.assertEqual(len(body), 8)
+                self.assertEqual([bytes(body.read(1)) for i in range(4)], [b'234', b'567', b'89', b''])
+                body.seek(1)
+                self.assertEqual(body.tell(), 1)
+                self.assertEqual(bytes(body.read()), b'3456789')
+        self.assertIsNone(mllib.utils.mappable_size(b'data'))